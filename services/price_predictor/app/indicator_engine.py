@@ -0,0 +1,494 @@
+"""
+Technical indicators of many symbols at once.
+
+`add_technical_indicators` runs TA-Lib over the Series of one symbol and adds
+the indicator columns one by one. Here the candles of all the symbols form a
+panel, a symbols x time array per OHLCV field, and every indicator is computed
+for all the symbols with whole-array operations: the rolling windows from
+cumulative sums or sliding window views, and the recursive averages (EMA and
+Wilder's smoothing) as linear filters along the time axis with
+`scipy.signal.lfilter`. The values are written into one preallocated float32
+block, which becomes a DataFrame at the end.
+
+The indicators follow TA-Lib's definitions, warm-up and seeding, so the values
+match those of `add_technical_indicators` within float32 precision, with NaN
+in the same rows.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+INDICATOR_COLUMNS = [
+    "sma_7",
+    "sma_14",
+    "sma_28",
+    "ema_7",
+    "ema_14",
+    "ema_28",
+    "macd",
+    "macd_signal",
+    "macd_hist",
+    "bb_upper",
+    "bb_middle",
+    "bb_lower",
+    "stoch_k",
+    "stoch_d",
+    "obv",
+    "atr",
+    "cci",
+    "rsi",
+    "adx",
+    "cmf",
+]
+
+# TA_IS_ZERO of TA-Lib
+_EPSILON = 0.00000001
+
+
+@dataclass
+class OHLCVPanel:
+    """Candles of several symbols on a shared time axis, arrays of symbols x time."""
+
+    symbols: list[str]
+    timestamps_ms: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        symbol_column: str = "product_id",
+        time_column: str = "timestamp_ms",
+        window_ms: int | None = None,
+    ) -> "OHLCVPanel":
+        """
+        Pivots candles of several symbols, one row per symbol and timestamp,
+        into a panel. The indicators count candles, so the candles must form a
+        dense grid, e.g. that of `fill_candle_gaps`.
+
+        Args:
+            df (pd.DataFrame): The candles, with open, high, low, close and volume.
+            symbol_column (str): The column of the symbols.
+            time_column (str): The column of the candle timestamps.
+            window_ms (int | None): The window size of the candles; without it
+                the timestamps only have to be evenly spaced.
+
+        Returns:
+            OHLCVPanel: The panel, every symbol with a candle at every timestamp.
+        """
+        symbol_codes, symbols = pd.factorize(df[symbol_column], sort=True)
+        time_codes, timestamps_ms = pd.factorize(df[time_column], sort=True)
+        shape = (len(symbols), len(timestamps_ms))
+        positions = np.ravel_multi_index((symbol_codes, time_codes), shape)
+        steps_ms = np.diff(np.asarray(timestamps_ms, dtype=np.int64))
+        step_ms = window_ms if window_ms is not None else steps_ms[:1]
+        if (
+            len(df) != np.prod(shape)
+            or len(np.unique(positions)) != len(df)
+            or np.any(steps_ms != step_ms)
+        ):
+            raise ValueError(
+                "Every symbol needs one candle at every window of the panel, "
+                "fill the gaps of the candles with `fill_candle_gaps` first"
+            )
+        fields = {}
+        for field in ("open", "high", "low", "close", "volume"):
+            values = np.empty(shape)
+            values.ravel()[positions] = df[field].to_numpy(dtype=np.float64)
+            fields[field] = values
+        return cls(
+            symbols=list(symbols), timestamps_ms=np.asarray(timestamps_ms), **fields
+        )
+
+
+def fill_candle_gaps(
+    df: pd.DataFrame,
+    window_ms: int,
+    symbol_column: str = "product_id",
+    time_column: str = "timestamp_ms",
+) -> pd.DataFrame:
+    """
+    Puts the candles of all the symbols on a shared grid of one candle per
+    window, the dense grid of trade_to_ohlcv: a window without trades gets a
+    flat candle at the previous close with zero volume. The grid starts with
+    the latest first candle of the symbols, so no symbol has candles missing
+    before its first trade; the earlier candles are left out.
+
+    Args:
+        df (pd.DataFrame): The candles, with open, high, low, close and volume.
+        window_ms (int): The window size of the candles in milliseconds.
+        symbol_column (str): The column of the symbols.
+        time_column (str): The column of the candle timestamps.
+
+    Returns:
+        pd.DataFrame: The candles on the grid, sorted by symbol and time, the
+        other columns forward filled.
+    """
+    timestamps_ms = df[time_column].to_numpy(dtype=np.int64)
+    if np.any((timestamps_ms - timestamps_ms.min()) % window_ms):
+        raise ValueError(f"The candles are not on a grid of {window_ms}ms windows")
+    grid = pd.MultiIndex.from_product(
+        [
+            np.sort(df[symbol_column].unique()),
+            np.arange(timestamps_ms.min(), timestamps_ms.max() + 1, window_ms),
+        ],
+        names=[symbol_column, time_column],
+    )
+    candles = df.set_index([symbol_column, time_column]).reindex(grid)
+    is_gap = candles["close"].isna()
+    candles = candles.groupby(level=symbol_column).ffill()
+    for field in ("open", "high", "low"):
+        candles.loc[is_gap, field] = candles.loc[is_gap, "close"]
+    candles.loc[is_gap, "volume"] = 0.0
+    first_ms = df.groupby(symbol_column)[time_column].min().max()
+    candles = candles[candles.index.get_level_values(time_column) >= first_ms]
+    return candles.reset_index()
+
+
+def add_technical_indicators_panel(
+    panel: OHLCVPanel, symbol_column: str = "product_id"
+) -> pd.DataFrame:
+    """
+    Computes the technical indicators of `add_technical_indicators` for all the
+    symbols of the panel at once.
+
+    Args:
+        panel (OHLCVPanel): The candles of the symbols.
+        symbol_column (str): The name of the column of the symbols.
+
+    Returns:
+        pd.DataFrame: The candles with the technical indicators as float32,
+        one row per symbol and timestamp, sorted by symbol and time.
+    """
+    n_symbols, n_times = panel.close.shape
+    # one row per indicator, the layout of a pandas block of float32 columns
+    block = np.full(
+        (len(INDICATOR_COLUMNS), n_symbols, n_times), np.nan, dtype=np.float32
+    )
+    compute_technical_indicators(
+        np.asarray(panel.high, dtype=np.float64),
+        np.asarray(panel.low, dtype=np.float64),
+        np.asarray(panel.close, dtype=np.float64),
+        np.asarray(panel.volume, dtype=np.float64),
+        block,
+    )
+    candles = pd.DataFrame(
+        {
+            symbol_column: np.repeat(np.array(panel.symbols, dtype=object), n_times),
+            "timestamp_ms": np.tile(panel.timestamps_ms, n_symbols),
+            "open": panel.open.ravel(),
+            "high": panel.high.ravel(),
+            "low": panel.low.ravel(),
+            "close": panel.close.ravel(),
+            "volume": panel.volume.ravel(),
+        }
+    )
+    indicators = pd.DataFrame(
+        block.reshape(len(INDICATOR_COLUMNS), n_symbols * n_times).T,
+        columns=INDICATOR_COLUMNS,
+        copy=False,
+    )
+    return pd.concat([candles, indicators], axis=1, copy=False)
+
+
+def compute_technical_indicators(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    volume: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    """
+    Writes the technical indicators of a panel into a preallocated block.
+
+    Args:
+        high, low, close, volume (np.ndarray): symbols x time float64 arrays.
+        out (np.ndarray): indicators x symbols x time block, in the order of
+            INDICATOR_COLUMNS, filled with NaN. The warm-up rows stay NaN.
+    """
+    columns = dict(zip(INDICATOR_COLUMNS, out, strict=True))
+
+    for period in (7, 14, 28):
+        _write(columns[f"sma_{period}"], _rolling_mean(close, period))
+        _write(columns[f"ema_{period}"], _ema(close, period))
+
+    macd, macd_signal = _macd(close)
+    _write(columns["macd"], macd)
+    _write(columns["macd_signal"], macd_signal)
+    _write(columns["macd_hist"], macd - macd_signal)
+
+    middle, stddev = _bbands(close, 14)
+    _write(columns["bb_upper"], middle + stddev * 2.0)
+    _write(columns["bb_middle"], middle)
+    _write(columns["bb_lower"], middle - stddev * 2.0)
+
+    stoch_k, stoch_d = _stoch(high, low, close)
+    _write(columns["stoch_k"], stoch_k)
+    _write(columns["stoch_d"], stoch_d)
+
+    _write(columns["obv"], _obv(close, volume))
+    true_range = _true_range(high, low, close)
+    _write(columns["atr"], _atr(true_range, 14))
+    _write(columns["cci"], _cci(high, low, close, 14))
+    _write(columns["rsi"], _rsi(close, 14))
+    _write(columns["adx"], _adx(high, low, true_range, 14))
+    _write(columns["cmf"], _adosc(high, low, close, volume, 3, 14))
+
+
+def _write(column: np.ndarray, values: np.ndarray) -> None:
+    """Writes the values of the last timestamps, those after the warm-up."""
+    if values.shape[1]:
+        column[:, -values.shape[1] :] = values
+
+
+def _empty(x: np.ndarray) -> np.ndarray:
+    return np.empty((x.shape[0], 0))
+
+
+def _smooth(x: np.ndarray, previous: np.ndarray, alpha: float) -> np.ndarray:
+    """y[t] = alpha * x[t] + (1 - alpha) * y[t - 1], starting from `previous`."""
+    if not x.shape[1]:
+        return _empty(x)
+    y, _ = lfilter(
+        [alpha], [1.0, alpha - 1.0], x, axis=1, zi=((1.0 - alpha) * previous)[:, None]
+    )
+    return y
+
+
+def _rolling_mean(x: np.ndarray, period: int) -> np.ndarray:
+    """Means of the windows of `period` ending at every timestamp from period - 1."""
+    if x.shape[1] < period:
+        return _empty(x)
+    # sums of the values relative to the first one keep the cumulative sums small
+    first = x[:, :1]
+    sums = np.cumsum(x - first, axis=1)
+    window_sums = sums[:, period - 1 :].copy()
+    window_sums[:, 1:] -= sums[:, :-period]
+    return window_sums / period + first
+
+
+def _rolling_reduce(ufunc: np.ufunc, x: np.ndarray, period: int) -> np.ndarray:
+    """`ufunc`, e.g. np.maximum, over the windows of `period` from period - 1."""
+    n_windows = x.shape[1] - period + 1
+    result = x[:, :n_windows].copy()
+    for offset in range(1, period):
+        ufunc(result, x[:, offset : offset + n_windows], out=result)
+    return result
+
+
+def _ema(x: np.ndarray, period: int) -> np.ndarray:
+    """TA-Lib's EMA from period - 1, seeded with the mean of the first `period`."""
+    if x.shape[1] < period:
+        return _empty(x)
+    seed = x[:, :period].sum(axis=1) / period
+    ema = _smooth(x[:, period:], seed, 2.0 / (period + 1))
+    return np.concatenate([seed[:, None], ema], axis=1)
+
+
+def _macd(
+    close: np.ndarray, fast: int = 12, slow: int = 26, signal: int = 9
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    MACD and its signal from slow + signal - 2. As in TA-Lib, both averages
+    start with the slow one, the fast one seeded with the last `fast` of the
+    first `slow` values.
+    """
+    if close.shape[1] < slow + signal - 1:
+        return _empty(close), _empty(close)
+    macd = _ema(close[:, slow - fast :], fast) - _ema(close, slow)
+    macd_signal = _ema(macd, signal)
+    return macd[:, signal - 1 :], macd_signal
+
+
+def _bbands(close: np.ndarray, period: int) -> tuple[np.ndarray, np.ndarray]:
+    """The SMA and the population standard deviation, zero below TA-Lib's epsilon."""
+    if close.shape[1] < period:
+        return _empty(close), _empty(close)
+    middle = _rolling_mean(close, period)
+    # the variance doesn't depend on the offset of the values
+    centered = close - close[:, :1]
+    variance = (
+        _rolling_mean(centered * centered, period)
+        - _rolling_mean(centered, period) ** 2
+    )
+    stddev = np.sqrt(np.where(variance < _EPSILON, 0.0, variance))
+    return middle, stddev
+
+
+def _stoch(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    fastk_period: int = 14,
+    slowk_period: int = 3,
+    slowd_period: int = 3,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Slow stochastic %K and %D, SMAs of the fast %K, both from the first %D."""
+    if close.shape[1] < fastk_period + slowk_period + slowd_period - 2:
+        return _empty(close), _empty(close)
+    highest = _rolling_reduce(np.maximum, high, fastk_period)
+    lowest = _rolling_reduce(np.minimum, low, fastk_period)
+    diff = (highest - lowest) / 100.0
+    fast_k = np.divide(
+        close[:, fastk_period - 1 :] - lowest,
+        diff,
+        out=np.zeros_like(diff),
+        where=diff != 0.0,
+    )
+    slow_k = _rolling_mean(fast_k, slowk_period)
+    slow_d = _rolling_mean(slow_k, slowd_period)
+    return slow_k[:, slowd_period - 1 :], slow_d
+
+
+def _obv(close: np.ndarray, volume: np.ndarray) -> np.ndarray:
+    """On balance volume, starting at the volume of the first candle."""
+    signed_volume = np.sign(np.diff(close, axis=1)) * volume[:, 1:]
+    obv = np.empty_like(close)
+    obv[:, :1] = volume[:, :1]
+    obv[:, 1:] = volume[:, :1] + np.cumsum(signed_volume, axis=1)
+    return obv
+
+
+def _true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    """True ranges from the second candle on."""
+    previous_close = close[:, :-1]
+    return np.maximum.reduce(
+        [
+            high[:, 1:] - low[:, 1:],
+            np.abs(high[:, 1:] - previous_close),
+            np.abs(low[:, 1:] - previous_close),
+        ]
+    )
+
+
+def _atr(true_range: np.ndarray, period: int) -> np.ndarray:
+    """Average true range, Wilder's smoothing seeded with the mean of `period`."""
+    if true_range.shape[1] < period:
+        return _empty(true_range)
+    seed = true_range[:, :period].sum(axis=1) / period
+    atr = _smooth(true_range[:, period:], seed, 1.0 / period)
+    return np.concatenate([seed[:, None], atr], axis=1)
+
+
+def _cci(
+    high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int
+) -> np.ndarray:
+    """Commodity channel index, from the mean deviation of the typical prices."""
+    if close.shape[1] < period:
+        return _empty(close)
+    typical_price = (high + low + close) / 3
+    average = _rolling_mean(typical_price, period)
+    n_windows = average.shape[1]
+    deviation = np.zeros_like(average)
+    for offset in range(period):
+        deviation += np.abs(typical_price[:, offset : offset + n_windows] - average)
+    deviation /= period
+    difference = typical_price[:, period - 1 :] - average
+    # on a flat window both are rounding noise, zero below TA-Lib's epsilon
+    return np.divide(
+        difference,
+        0.015 * deviation,
+        out=np.zeros_like(difference),
+        where=(np.abs(difference) >= _EPSILON) & (deviation >= _EPSILON),
+    )
+
+
+def _rsi(close: np.ndarray, period: int) -> np.ndarray:
+    """Relative strength index, Wilder's averages of the gains and losses."""
+    if close.shape[1] <= period:
+        return _empty(close)
+    change = np.diff(close, axis=1)
+    averages = []
+    for moves in (np.maximum(change, 0.0), np.maximum(-change, 0.0)):
+        seed = moves[:, :period].sum(axis=1) / period
+        average = _smooth(moves[:, period:], seed, 1.0 / period)
+        averages.append(np.concatenate([seed[:, None], average], axis=1))
+    gain, loss = averages
+    total = gain + loss
+    return np.divide(
+        100.0 * gain, total, out=np.zeros_like(total), where=np.abs(total) >= _EPSILON
+    )
+
+
+def _adx(
+    high: np.ndarray, low: np.ndarray, true_range: np.ndarray, period: int
+) -> np.ndarray:
+    """
+    Average directional movement index from 2 * period - 1: Wilder's sums of
+    the directional movements and true ranges, the first ADX the mean of
+    `period` DX. Like TA-Lib, a DX without movement is left out.
+    """
+    if high.shape[1] < 2 * period:
+        return _empty(high)
+    diff_plus = np.diff(high, axis=1)
+    diff_minus = -np.diff(low, axis=1)
+    is_minus = (diff_minus > 0) & (diff_plus < diff_minus)
+    is_plus = ~is_minus & (diff_plus > 0) & (diff_plus > diff_minus)
+    sums = []
+    for moves in (
+        np.where(is_plus, diff_plus, 0.0),
+        np.where(is_minus, diff_minus, 0.0),
+        true_range,
+    ):
+        seed = moves[:, : period - 1].sum(axis=1)
+        sums.append(
+            _smooth(moves[:, period - 1 :], seed / period, 1.0 / period) * period
+        )
+    plus_dm, minus_dm, tr = sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        plus_di = 100.0 * (plus_dm / tr)
+        minus_di = 100.0 * (minus_dm / tr)
+        total = minus_di + plus_di
+        dx = 100.0 * (np.abs(minus_di - plus_di) / total)
+    has_dx = (np.abs(tr) >= _EPSILON) & (np.abs(total) >= _EPSILON)
+    dx = np.where(has_dx, dx, 0.0)
+    seed = dx[:, :period].sum(axis=1) / period
+    adx = np.empty((high.shape[0], dx.shape[1] - period + 1))
+    adx[:, 0] = seed
+    rows = has_dx[:, period:].all(axis=1)
+    adx[rows, 1:] = _smooth(dx[rows, period:], seed[rows], 1.0 / period)
+    # the ADX stays the same at the candles without a DX
+    for row in np.flatnonzero(~rows):
+        previous = seed[row]
+        for t, value in enumerate(dx[row, period:], start=1):
+            if has_dx[row, period - 1 + t]:
+                previous = (previous * (period - 1) + value) / period
+            adx[row, t] = previous
+    return adx
+
+
+def _adosc(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    volume: np.ndarray,
+    fast: int,
+    slow: int,
+) -> np.ndarray:
+    """
+    Chaikin A/D oscillator: the fast minus the slow EMA of the accumulation
+    distribution line, both seeded with its first value.
+    """
+    if close.shape[1] < max(fast, slow):
+        return _empty(close)
+    high_low = high - low
+    money_flow = np.divide(
+        ((close - low) - (high - close)) * volume,
+        high_low,
+        out=np.zeros_like(high_low),
+        where=high_low > 0.0,
+    )
+    ad = np.cumsum(money_flow, axis=1)
+    emas = []
+    for period in (fast, slow):
+        ema = _smooth(ad[:, 1:], ad[:, 0], 2.0 / (period + 1))
+        emas.append(np.concatenate([ad[:, :1], ema], axis=1))
+    fast_ema, slow_ema = emas
+    return (fast_ema - slow_ema)[:, max(fast, slow) - 1 :]
@@ -7,7 +7,12 @@ from .ohlcv_features_reader import (
     get_feature_view,
 )
 from app.models import CurrentPriceBaseline, MovingAverageBaseline, XGBoostModel
-from app.feature_engineering import add_technical_indicators
+from app.indicator_engine import (
+    INDICATOR_COLUMNS,
+    OHLCVPanel,
+    add_technical_indicators_panel,
+    fill_candle_gaps,
+)
 
 from sklearn.metrics import mean_absolute_error
 from datetime import datetime as dt
@@ -81,6 +86,12 @@ def train_model(
     dataset_hash = pd.util.hash_pandas_object(features).sum()
     experiment.log_parameter("ohlcv_dataset_hash", dataset_hash)
 
+    # the indicators and the forecast steps count candles, so windows without
+    # trades get flat candles, as on the dense grid of trade_to_ohlcv
+    window_ms = ohlcv_window_size_sec * 1000
+    features = fill_candle_gaps(features, window_ms)
+    experiment.log_parameter("num_grid_feature_rows", len(features))
+
     test_size = int(len(features) * percentage_test_data)
     # Calculate the effective test size, accounting for forecast steps
     effective_test_size = test_size + forecast_steps
@@ -89,6 +100,10 @@ def train_model(
     train_df = features.iloc[:-effective_test_size].copy()
     test_df = features.iloc[-test_size:].copy()
 
+    # Add technical indicators, before any row is dropped from the grid
+    train_df = add_technical_indicators_to_grid(train_df, window_ms)
+    test_df = add_technical_indicators_to_grid(test_df, window_ms)
+
     # Add target column with what we want to predict
     train_df.loc[:, "target_price"] = train_df["close"].shift(-forecast_steps)
     test_df.loc[:, "target_price"] = test_df["close"].shift(-forecast_steps)
@@ -98,7 +113,7 @@ def train_model(
             "num_test_feature_rows_before_drop_na": len(test_df),
         }
     )
-    # Remove rows with NaN targets
+    # Remove rows with NaN targets and the warm-up rows of the indicators
     train_df = train_df.dropna()
     test_df = test_df.dropna()
     experiment.log_parameters(
@@ -108,12 +123,6 @@ def train_model(
         }
     )
 
-    # Add technical indicators
-    train_df = add_technical_indicators(train_df)
-    test_df = add_technical_indicators(test_df)
-    train_df = train_df.dropna()
-    test_df = test_df.dropna()
-
     logger.info(f"Train size: {len(train_df)}")
     logger.info(f"Test size: {len(test_df)}")
 
@@ -201,6 +210,20 @@ def train_model(
     
 
 
+def add_technical_indicators_to_grid(df: pd.DataFrame, window_ms: int) -> pd.DataFrame:
+    """
+    Adds the technical indicators to candles on a dense grid, see
+    `fill_candle_gaps`; NaN until an indicator is warmed up.
+    """
+    indicators = add_technical_indicators_panel(
+        OHLCVPanel.from_frame(df, window_ms=window_ms)
+    )
+    return df.merge(
+        indicators[["product_id", "timestamp_ms", *INDICATOR_COLUMNS]],
+        on=["product_id", "timestamp_ms"],
+    )
+
+
 def convert_str_to_ms(date_str: str) -> int:
     # Convert
     # "2022-01-01T00:00:00Z"
@@ -0,0 +1,87 @@
+"""
+Compares the technical indicators of many symbols computed symbol by symbol
+with `add_technical_indicators`, TA-Lib over the Series of each symbol, with
+the panel of `add_technical_indicators_panel`, all the symbols at once.
+Both must produce the same indicators, within float32 precision.
+
+Run from the service root:
+    python -m benchmarks.bench_technical_indicators
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.feature_engineering import add_technical_indicators
+from app.indicator_engine import (
+    INDICATOR_COLUMNS,
+    OHLCVPanel,
+    add_technical_indicators_panel,
+)
+
+SYMBOLS = 300
+CANDLES = 2_000
+REPEATS = 3
+
+
+def build_candles() -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    shape = (SYMBOLS, CANDLES)
+    close = 42000 * np.exp(np.cumsum(rng.normal(0, 0.001, shape), axis=1))
+    spread = close * 0.001
+    return pd.DataFrame(
+        {
+            "product_id": np.repeat([f"SYM{i}/USD" for i in range(SYMBOLS)], CANDLES),
+            "timestamp_ms": np.tile(
+                1704067200000 + np.arange(CANDLES) * 60_000, SYMBOLS
+            ),
+            "open": close.ravel(),
+            "high": (close + spread * rng.random(shape)).ravel(),
+            "low": (close - spread * rng.random(shape)).ravel(),
+            "close": close.ravel(),
+            "volume": rng.exponential(10, shape).ravel(),
+        }
+    )
+
+
+def indicators_by_symbol(candles: pd.DataFrame) -> pd.DataFrame:
+    return pd.concat(
+        [
+            add_technical_indicators(symbol_candles.reset_index(drop=True))
+            for _, symbol_candles in candles.groupby("product_id")
+        ],
+        ignore_index=True,
+    )
+
+
+def indicators_of_panel(candles: pd.DataFrame) -> pd.DataFrame:
+    return add_technical_indicators_panel(OHLCVPanel.from_frame(candles))
+
+
+def measure(func, candles: pd.DataFrame) -> tuple[float, pd.DataFrame]:
+    best_s = float("inf")
+    for _ in range(REPEATS):
+        started_at = time.perf_counter()
+        indicators = func(candles)
+        best_s = min(best_s, time.perf_counter() - started_at)
+    return best_s, indicators
+
+
+if __name__ == "__main__":
+    candles = build_candles()
+    by_symbol_s, by_symbol = measure(indicators_by_symbol, candles)
+    panel_s, panel = measure(indicators_of_panel, candles)
+    for column in INDICATOR_COLUMNS:
+        expected = by_symbol[column].to_numpy()
+        scale = np.nanmax(np.abs(expected))
+        assert np.allclose(
+            panel[column].to_numpy(np.float64),
+            expected,
+            rtol=2e-7,
+            atol=1e-6 * scale,
+            equal_nan=True,
+        ), f"{column} differs"
+    print(f"{SYMBOLS} symbols x {CANDLES} candles")
+    print(f"symbol by symbol: {by_symbol_s * 1000:8.1f} ms")
+    print(f"panel:            {panel_s * 1000:8.1f} ms ({by_symbol_s / panel_s:.1f}x)")
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.indicator_engine import (
+    INDICATOR_COLUMNS,
+    OHLCVPanel,
+    add_technical_indicators_panel,
+    fill_candle_gaps,
+)
+
+WINDOW_MS = 60_000
+
+
+def get_candles(timestamps_ms: dict[str, list[int]]) -> pd.DataFrame:
+    rows = []
+    for symbol, symbol_timestamps_ms in timestamps_ms.items():
+        for i, timestamp_ms in enumerate(symbol_timestamps_ms):
+            close = 100.0 + i
+            rows.append(
+                {
+                    "product_id": symbol,
+                    "timestamp_ms": timestamp_ms,
+                    "open": close - 0.5,
+                    "high": close + 1.0,
+                    "low": close - 1.0,
+                    "close": close,
+                    "volume": 2.0,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def test_sparse_candles_are_rejected_by_the_panel():
+    candles = get_candles({"BTC/USD": [0, WINDOW_MS, 3 * WINDOW_MS]})
+    with pytest.raises(ValueError, match="fill_candle_gaps"):
+        OHLCVPanel.from_frame(candles, window_ms=WINDOW_MS)
+
+
+def test_gaps_get_flat_candles_at_the_previous_close():
+    candles = get_candles(
+        {
+            "BTC/USD": [0, WINDOW_MS, 4 * WINDOW_MS],
+            # starts later, the grid starts with it
+            "ETH/USD": [WINDOW_MS, 2 * WINDOW_MS, 4 * WINDOW_MS],
+        }
+    )
+    grid = fill_candle_gaps(candles, WINDOW_MS)
+
+    assert grid["timestamp_ms"].tolist() == [
+        timestamp_ms * WINDOW_MS for timestamp_ms in (1, 2, 3, 4) * 2
+    ]
+    btc = grid[grid["product_id"] == "BTC/USD"].reset_index(drop=True)
+    assert btc["close"].tolist() == [101.0, 101.0, 101.0, 102.0]
+    assert btc["volume"].tolist() == [2.0, 0.0, 0.0, 2.0]
+    for field in ("open", "high", "low"):
+        assert btc.loc[1:2, field].tolist() == [101.0, 101.0]
+    eth = grid[grid["product_id"] == "ETH/USD"].reset_index(drop=True)
+    assert eth["close"].tolist() == [100.0, 101.0, 101.0, 102.0]
+
+
+def test_candles_off_the_grid_are_rejected():
+    candles = get_candles({"BTC/USD": [0, WINDOW_MS + 1]})
+    with pytest.raises(ValueError, match="grid"):
+        fill_candle_gaps(candles, WINDOW_MS)
+
+
+def test_indicators_of_the_filled_grid():
+    rng = np.random.default_rng(7)
+    timestamps_ms = np.sort(rng.choice(200, size=120, replace=False)) * WINDOW_MS
+    candles = get_candles({"BTC/USD": timestamps_ms.tolist()})
+    grid = fill_candle_gaps(candles, WINDOW_MS)
+
+    panel = OHLCVPanel.from_frame(grid, window_ms=WINDOW_MS)
+    indicators = add_technical_indicators_panel(panel)
+
+    assert (
+        len(indicators)
+        == timestamps_ms[-1] // WINDOW_MS - timestamps_ms[0] // WINDOW_MS + 1
+    )
+    # warmed up after the longest window, that of the MACD signal
+    assert not indicators[INDICATOR_COLUMNS].iloc[40:].isna().any().any()
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_indicators_match_ta_lib_symbol_by_symbol(seed):
+    pytest.importorskip("talib")
+    from app.feature_engineering import add_technical_indicators
+
+    rng = np.random.default_rng(seed)
+    symbols, num_candles = ["BTC/USD", "ETH/USD", "SOL/USD"], 300
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (3, num_candles)), axis=1))
+    spread = close * 0.005
+    candles = pd.DataFrame(
+        {
+            "product_id": np.repeat(symbols, num_candles),
+            "timestamp_ms": np.tile(np.arange(num_candles) * WINDOW_MS, 3),
+            "open": close.ravel(),
+            "high": (close + spread * rng.random(close.shape)).ravel(),
+            "low": (close - spread * rng.random(close.shape)).ravel(),
+            "close": close.ravel(),
+            "volume": rng.random(close.size) * 10,
+        }
+    )
+    # 30 windows without trades of all but one symbol, flat candles on the grid
+    is_gap = (candles["product_id"] != "BTC/USD") & candles["timestamp_ms"].between(
+        100 * WINDOW_MS, 129 * WINDOW_MS
+    )
+    grid = fill_candle_gaps(candles[~is_gap], WINDOW_MS)
+
+    panel = add_technical_indicators_panel(
+        OHLCVPanel.from_frame(grid, window_ms=WINDOW_MS)
+    )
+
+    for symbol in symbols:
+        symbol_candles = grid[grid["product_id"] == symbol].reset_index(drop=True)
+        expected = add_technical_indicators(symbol_candles.copy())
+        got = panel[panel["product_id"] == symbol].reset_index(drop=True)
+        for column in INDICATOR_COLUMNS:
+            values = expected[column].to_numpy()
+            np.testing.assert_allclose(
+                got[column].to_numpy(np.float64),
+                values,
+                rtol=2e-7,
+                atol=1e-6 * np.nanmax(np.abs(values)),
+                err_msg=f"{symbol} {column}",
+            )
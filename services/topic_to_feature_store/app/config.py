@@ -43,6 +43,12 @@ class HopsworksSettings(BaseModel):
     PUSHING_BATCH_SIZE: int = int(os.getenv("FEATURE_GROUP_PUSHING_BATCH_SIZE", 1))
     PAUSE_BETWEEN_PUSHING: int = int(os.getenv("FEATURE_GROUP_PAUSE_BETWEEN_PUSHING", 0))
     START_OFFLINE_MATERIALIZATION: bool = os.getenv("FEATURE_GROUP_START_OFFLINE_MATERIALIZATION", False)
+    # background pushes, see app/feature_group_writer.py; the feature group
+    # client isn't known to be thread-safe, so one worker unless tested
+    WRITER_WORKERS: int = int(os.getenv("FEATURE_GROUP_WRITER_WORKERS", 1))
+    WRITER_MAX_PENDING_BATCHES: int = int(os.getenv("FEATURE_GROUP_WRITER_MAX_PENDING_BATCHES", 4))
+    PUSHING_MAX_RETRIES: int = int(os.getenv("FEATURE_GROUP_PUSHING_MAX_RETRIES", 5))
+    PUSHING_RETRY_BACKOFF_S: float = float(os.getenv("FEATURE_GROUP_PUSHING_RETRY_BACKOFF_S", 1.0))
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "Topic to Feature Store Hopsworks"
@@ -0,0 +1,158 @@
+"""
+Background inserts into the feature group, pipelined with the consumption.
+
+The consumer hands over every full batch with the offsets it ends at and goes
+on polling while worker threads insert the batches. The offsets of a batch are
+handed back for committing once it is inserted, and once all the batches
+before it are, so a restart re-reads any batch that wasn't, and the features
+are inserted at least once. The queue of pending batches is bounded: when the
+feature store falls behind, `submit` blocks, and the consumer with it, so the
+throughput is that of the inserts.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+from confluent_kafka import TopicPartition
+
+from app.config import settings
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+
+class FeatureGroupWriter:
+    """Inserts batches of features from worker threads, in the background."""
+
+    def __init__(
+        self,
+        insert: Callable[[list[dict]], None],
+        num_workers: int = 1,
+        max_pending_batches: int = 4,
+        max_retries: int = 5,
+        retry_backoff_s: float = 1.0,
+        max_retry_backoff_s: float = 60.0,
+        pause_between_inserts_s: float = 0.0,
+    ):
+        """
+        :param insert: Inserts a batch into the feature group.
+        :param num_workers: Threads inserting batches at the same time.
+        :param max_pending_batches: Batches queued before `submit` blocks.
+        :param max_retries: Retries of a failed insert before the writer fails.
+        :param retry_backoff_s: Wait before the first retry, doubled every time.
+        :param max_retry_backoff_s: Longest wait between two retries.
+        :param pause_between_inserts_s: Wait of a worker after every insert.
+        """
+        self._insert = insert
+        self._max_retries = max_retries
+        self._retry_backoff_s = retry_backoff_s
+        self._max_retry_backoff_s = max_retry_backoff_s
+        self._pause_between_inserts_s = pause_between_inserts_s
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending_batches)
+        self._lock = threading.Condition()
+        # sequence number of the next batch to submit and to hand back
+        self._submitted = 0
+        self._handed_back = 0
+        # offsets of the inserted batches, by sequence number
+        self._inserted: dict[int, list[TopicPartition]] = {}
+        self._error: Exception | None = None
+        self._workers = [
+            threading.Thread(
+                target=self._run, name=f"feature-group-writer-{i}", daemon=True
+            )
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, batch: list[dict], offsets: list[TopicPartition]) -> None:
+        """
+        Queues a batch for insertion, waiting for room in the queue.
+
+        :param batch: Features to insert.
+        :param offsets: Offsets to commit once the batch is inserted, those of the
+            messages after its last ones.
+        """
+        with self._lock:
+            sequence = self._submitted
+            self._submitted += 1
+        while True:
+            self.raise_error()
+            try:
+                self._queue.put((sequence, batch, offsets), timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def pop_inserted_offsets(self) -> list[TopicPartition]:
+        """
+        The offsets to commit of the batches inserted since the last call, up to
+        the first batch not inserted yet, the latest one of every partition.
+        """
+        self.raise_error()
+        offsets = {}
+        with self._lock:
+            while self._handed_back in self._inserted:
+                for offset in self._inserted.pop(self._handed_back):
+                    offsets[(offset.topic, offset.partition)] = offset
+                self._handed_back += 1
+        return list(offsets.values())
+
+    def wait(self) -> None:
+        """Waits for the submitted batches to be inserted."""
+        with self._lock:
+            while (
+                self._error is None
+                and self._handed_back + len(self._inserted) < self._submitted
+            ):
+                self._lock.wait()
+        self.raise_error()
+
+    def raise_error(self) -> None:
+        """Raises the error of an insert that failed all its retries."""
+        if self._error is not None:
+            raise RuntimeError("Inserting features failed") from self._error
+
+    def close(self) -> None:
+        """Waits for the submitted batches and stops the workers."""
+        self.wait()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            sequence, batch, offsets = item
+            try:
+                self._insert_with_retries(batch)
+            except Exception as e:
+                with self._lock:
+                    self._error = e
+                    self._lock.notify_all()
+                return
+            with self._lock:
+                self._inserted[sequence] = offsets
+                self._lock.notify_all()
+            time.sleep(self._pause_between_inserts_s)
+
+    def _insert_with_retries(self, batch: list[dict]) -> None:
+        backoff_s = self._retry_backoff_s
+        for retry in range(self._max_retries + 1):
+            try:
+                self._insert(batch)
+                return
+            except Exception as e:
+                if retry == self._max_retries or self._error is not None:
+                    raise
+                logger.warning(
+                    f"Inserting {len(batch)} features failed: {e}, "
+                    f"retrying in {backoff_s:.1f}s"
+                )
+                time.sleep(backoff_s)
+                backoff_s = min(backoff_s * 2, self._max_retry_backoff_s)
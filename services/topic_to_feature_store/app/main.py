@@ -1,4 +1,5 @@
 from app.config import settings
+from app.serializers import decode_record
 from app.hopsworks_api import (
     push_feature_to_feature_group,
     # push_feature_to_feature_store,
@@ -7,14 +8,20 @@ from app.hopsworks_api import (
     FeatureGroupCreds,
 )
 
+from app.feature_group_writer import FeatureGroupWriter
+
+from confluent_kafka import KafkaException, TopicPartition
 from quixstreams import Application
-import json
-import time
+from quixstreams.kafka import Consumer
 import logging
 from dataclasses import dataclass
 
 logger = logging.getLogger(settings.LOGGER_NAME)
 
+POLL_TIMEOUT_S = 1.0
+# without messages for this long, the batch is pushed, or the service exits
+IDLE_TIMEOUT_S = 300.0
+
 
 @dataclass
 class KafkaOptions:
@@ -30,12 +37,28 @@ def topic_to_feature_store(
     start_offline_materialization: bool,
     batch_size: int,
     pause_between_pushing: int = 0,
+    writer_workers: int = 1,
+    writer_max_pending_batches: int = 4,
+    push_max_retries: int = 5,
+    push_retry_backoff_s: float = 1.0,
 ) -> None:
     """
     Push feature from kafka to Hopsworks
-    :param kafka_broker_address: Kafka broker address
-    :param kafka_input_topic: Kafka topic to consume
-    :param kafka_consumer_group_id: Kafka consumer group ID
+
+    The batches are pushed by a `FeatureGroupWriter` in the background while
+    the consumer keeps polling, see app/feature_group_writer.py, and their
+    offsets are stored for committing once they are pushed.
+
+    :param kafka_options: Kafka options
+    :param feature_group_options: Feature group to push to
+    :param start_offline_materialization: Whether to start the materialization job
+    :param batch_size: Features pushed at once
+    :param pause_between_pushing: Pause of a writer worker after every push
+    :param writer_workers: Batches pushed at the same time
+    :param writer_max_pending_batches: Batches waiting for a writer worker before
+        the consumption pauses
+    :param push_max_retries: Retries of a failed push before the service stops
+    :param push_retry_backoff_s: Wait before the first retry, doubled every time
     """
     logger.info("Starting application")
     app = Application(
@@ -46,48 +69,87 @@ def topic_to_feature_store(
     feature_group = get_or_create_feature_group(
         options=feature_group_options,
     )
+    writer = FeatureGroupWriter(
+        insert=lambda value: push_feature_to_feature_group(
+            value=value,
+            feature_group=feature_group,
+            start_offline_materialization=start_offline_materialization,
+        ),
+        num_workers=writer_workers,
+        max_pending_batches=writer_max_pending_batches,
+        max_retries=push_max_retries,
+        retry_backoff_s=push_retry_backoff_s,
+        pause_between_inserts_s=pause_between_pushing,
+    )
 
     batch = []
+    # offsets after the last message of every partition of the batch
+    batch_offsets = {}
+    idle_s = 0.0
+
+    def submit_batch() -> None:
+        nonlocal batch, batch_offsets
+        writer.submit(batch, list(batch_offsets.values()))
+        batch = []
+        batch_offsets = {}
+
+    def store_inserted_offsets(consumer: Consumer) -> None:
+        offsets = writer.pop_inserted_offsets()
+        if not offsets:
+            return
+        try:
+            consumer.store_offsets(offsets=offsets)
+        except KafkaException as e:
+            # e.g. of a lost partition, whose features are pushed again
+            logger.warning(f"Failed to store offsets {offsets}: {e}")
+
+    def on_revoke(consumer: Consumer, topic_partitions: list[TopicPartition]) -> None:
+        # the features consumed so far are pushed, and their offsets committed
+        # with the revoked partitions, before another consumer gets them
+        if len(batch) > 0:
+            submit_batch()
+        writer.wait()
+        store_inserted_offsets(consumer)
+
     with app.get_consumer() as consumer:
-        consumer.subscribe(topics=[kafka_options.input_topic])
+        consumer.subscribe(topics=[kafka_options.input_topic], on_revoke=on_revoke)
 
         while True:
-            msg = consumer.poll(timeout=300.0)
+            store_inserted_offsets(consumer)
+            msg = consumer.poll(timeout=POLL_TIMEOUT_S)
             if msg is None:
+                idle_s += POLL_TIMEOUT_S
+                if idle_s < IDLE_TIMEOUT_S:
+                    continue
+                idle_s = 0.0
                 if len(batch) > 0:
                     logger.debug(f'Batch has size {len(batch)} > 0... Pushing data to Feature Store by Timeout')
-                    push_feature_to_feature_group(
-                        value=batch,
-                        feature_group=feature_group,
-                        start_offline_materialization=start_offline_materialization,
-                    )
-                    batch = []
-                    time.sleep(pause_between_pushing)
+                    submit_batch()
                     continue
                 else:
                     logger.info("No data received from Kafka. Exiting...")
                     break
+            idle_s = 0.0
             if msg.error():
                 logger.error(f"Kafka error: {msg.error()}")
                 continue
             
-            features = json.loads(msg.value().decode("utf-8"))
+            # OHLCV messages come either as JSON or in the binary format
+            features = decode_record(msg.value())
             batch.append(features)
+            batch_offsets[msg.partition()] = TopicPartition(
+                msg.topic(), msg.partition(), msg.offset() + 1
+            )
 
             if len(batch) < batch_size:
                 print(f'Batch has size {len(batch)} < {batch_size:,}...', end='\r')
                 continue
 
             logger.debug(f'Batch has size {len(batch)} >= {batch_size:,}... Pushing data to Feature Store')
-            push_feature_to_feature_group(
-                value=batch,
-                feature_group=feature_group,
-                start_offline_materialization=start_offline_materialization,
-            )
+            submit_batch()
 
-            batch = []
-            time.sleep(pause_between_pushing)
-            consumer.store_offsets(message=msg)
+        writer.close()
+        store_inserted_offsets(consumer)
 
 
 
@@ -116,6 +178,10 @@ def main():
         start_offline_materialization=settings.hopsworks.START_OFFLINE_MATERIALIZATION,
         batch_size=settings.hopsworks.PUSHING_BATCH_SIZE,
         pause_between_pushing=settings.hopsworks.PAUSE_BETWEEN_PUSHING,
+        writer_workers=settings.hopsworks.WRITER_WORKERS,
+        writer_max_pending_batches=settings.hopsworks.WRITER_MAX_PENDING_BATCHES,
+        push_max_retries=settings.hopsworks.PUSHING_MAX_RETRIES,
+        push_retry_backoff_s=settings.hopsworks.PUSHING_RETRY_BACKOFF_S,
     )
 
 
@@ -0,0 +1,5 @@
+import os
+
+# the settings of app.config are read on import
+os.environ.setdefault("KAFKA_OHLCV_TOPIC", "ohlcv")
+os.environ.setdefault("KAFKA_CONSUMER_GROUP", "topic_to_feature_store")
@@ -0,0 +1,140 @@
+import threading
+
+import pytest
+from confluent_kafka import TopicPartition
+
+from app.feature_group_writer import FeatureGroupWriter
+
+TIMEOUT_S = 5.0
+
+
+class FakeInsert:
+    """Inserts a batch once it is released, failing its first `failures` calls."""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.calls = 0
+        self.inserted: list[list[dict]] = []
+        self.started = threading.Semaphore(0)
+        self._released: dict[int, threading.Event] = {}
+        self._lock = threading.Condition()
+
+    def wait_inserted(self, num_batches: int) -> None:
+        with self._lock:
+            assert self._lock.wait_for(
+                lambda: len(self.inserted) >= num_batches, TIMEOUT_S
+            )
+
+    def release(self, batch_id: int) -> None:
+        self._get_event(batch_id).set()
+
+    def __call__(self, batch: list[dict]) -> None:
+        with self._lock:
+            self.calls += 1
+            fails = self.calls <= self.failures
+        self.started.release()
+        if fails:
+            raise ConnectionError("feature store unavailable")
+        assert self._get_event(batch[0]["id"]).wait(TIMEOUT_S)
+        with self._lock:
+            self.inserted.append(batch)
+            self._lock.notify_all()
+
+    def _get_event(self, batch_id: int) -> threading.Event:
+        with self._lock:
+            return self._released.setdefault(batch_id, threading.Event())
+
+
+def get_batch(batch_id: int) -> list[dict]:
+    return [{"id": batch_id}]
+
+
+def get_offsets(partition: int, offset: int) -> list[TopicPartition]:
+    return [TopicPartition("ohlcv", partition, offset)]
+
+
+def as_tuples(offsets: list[TopicPartition]) -> list[tuple]:
+    return sorted((offset.partition, offset.offset) for offset in offsets)
+
+
+def test_offsets_are_handed_back_in_submission_order():
+    insert = FakeInsert()
+    writer = FeatureGroupWriter(insert, num_workers=2)
+    writer.submit(get_batch(0), get_offsets(0, 10))
+    writer.submit(get_batch(1), get_offsets(1, 20))
+    writer.submit(get_batch(2), get_offsets(0, 30))
+    for _ in range(2):
+        assert insert.started.acquire(timeout=TIMEOUT_S)
+
+    # the second batch is inserted before the first one
+    insert.release(1)
+    insert.wait_inserted(1)
+    assert writer.pop_inserted_offsets() == []
+
+    insert.release(0)
+    insert.release(2)
+    writer.wait()
+    assert as_tuples(writer.pop_inserted_offsets()) == [(0, 30), (1, 20)]
+    assert writer.pop_inserted_offsets() == []
+    writer.close()
+
+
+def test_failed_inserts_are_retried():
+    insert = FakeInsert(failures=2)
+    insert.release(0)
+    writer = FeatureGroupWriter(
+        insert, max_retries=2, retry_backoff_s=0.01, max_retry_backoff_s=0.01
+    )
+    writer.submit(get_batch(0), get_offsets(0, 10))
+    writer.close()
+
+    assert insert.calls == 3
+    assert insert.inserted == [get_batch(0)]
+    assert as_tuples(writer.pop_inserted_offsets()) == [(0, 10)]
+
+
+def test_writer_fails_once_the_retries_are_exhausted():
+    insert = FakeInsert(failures=3)
+    writer = FeatureGroupWriter(
+        insert, max_retries=2, retry_backoff_s=0.01, max_retry_backoff_s=0.01
+    )
+    writer.submit(get_batch(0), get_offsets(0, 10))
+
+    with pytest.raises(RuntimeError) as error:
+        writer.wait()
+    assert isinstance(error.value.__cause__, ConnectionError)
+    assert insert.calls == 3
+    # the offsets of the batch are never committed
+    with pytest.raises(RuntimeError):
+        writer.pop_inserted_offsets()
+    with pytest.raises(RuntimeError):
+        writer.submit(get_batch(1), get_offsets(0, 20))
+
+
+def test_wait_returns_once_the_submitted_batches_are_inserted():
+    # as on a revoke: the pending batches are inserted before their offsets
+    # are committed
+    insert = FakeInsert()
+    writer = FeatureGroupWriter(insert, num_workers=2)
+    writer.submit(get_batch(0), get_offsets(0, 10))
+    writer.submit(get_batch(1), get_offsets(1, 20))
+    waiter = threading.Thread(target=writer.wait)
+    waiter.start()
+
+    insert.release(1)
+    insert.wait_inserted(1)
+    waiter.join(0.1)
+    assert waiter.is_alive()
+
+    insert.release(0)
+    waiter.join(TIMEOUT_S)
+    assert not waiter.is_alive()
+    assert as_tuples(writer.pop_inserted_offsets()) == [(0, 10), (1, 20)]
+    writer.close()
+
+
+def test_wait_returns_without_pending_batches():
+    writer = FeatureGroupWriter(FakeInsert())
+    writer.wait()
+    assert writer.pop_inserted_offsets() == []
+    writer.close()
@@ -1,8 +1,14 @@
+import asyncio
+import inspect
 from abc import ABC, abstractmethod
 from typing import Callable
 
 
 class TradesConnector(ABC):
+	# the event loop and the task of a running `stream_trades`, used by `stop()`
+	_loop: asyncio.AbstractEventLoop | None = None
+	_task: asyncio.Task | None = None
+
 	@abstractmethod
 	def __init__(self): ...
 
@@ -19,4 +25,74 @@ class TradesConnector(ABC):
 		historical_start_ms: int | None = None,
 		historical_end_ms: int | None = None,
 	) -> None:
+		"""
+		Streams trades of the symbols to the callback.
+		Blocks until the source is exhausted or stopped, raises if it fails.
+		"""
 		raise NotImplementedError
+
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		"""
+		Coroutine version of `subscribe_to_trades`, so many sources share one event loop.
+
+		The callback may be a coroutine function, it is then awaited, so a full
+		queue of the producer holds back the source and not the event loop.
+
+		By default the blocking `subscribe_to_trades` runs in a worker thread and
+		every callback call is handed over to the event loop, so callback-style SDKs
+		never call into the producer from their own threads. The SDK thread waits
+		for the call to finish.
+		Cancelling the coroutine stops the source.
+		"""
+		loop = asyncio.get_running_loop()
+
+		def handoff_to_loop(*args, **kwargs) -> None:
+			asyncio.run_coroutine_threadsafe(
+				self._emit(callback, *args, **kwargs), loop
+			).result()
+
+		try:
+			await asyncio.to_thread(
+				self.subscribe_to_trades,
+				symbols,
+				handoff_to_loop,
+				historical_start_ms,
+				historical_end_ms,
+			)
+		finally:
+			self.stop()
+
+	@abstractmethod
+	def stop(self) -> None:
+		"""Makes a running `subscribe_to_trades` return. Safe to call from any thread."""
+		raise NotImplementedError
+
+	def close(self) -> None:
+		self.stop()
+
+	@staticmethod
+	async def _emit(callback: Callable, *args, **kwargs) -> None:
+		"""Calls the callback of `stream_trades`, awaiting it if it is a coroutine."""
+		result = callback(*args, **kwargs)
+		if inspect.isawaitable(result):
+			await result
+
+	def _bind_stream_task(self) -> None:
+		"""Remembers the running task, so `_cancel_stream_task` can stop it."""
+		self._loop = asyncio.get_running_loop()
+		self._task = asyncio.current_task()
+
+	def _cancel_stream_task(self) -> None:
+		if self._loop is None or self._task is None:
+			return
+		try:
+			self._loop.call_soon_threadsafe(self._task.cancel)
+		except RuntimeError:
+			# the event loop is already closed, nothing to cancel
+			pass
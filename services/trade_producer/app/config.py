@@ -1,10 +1,12 @@
 import logging
 import os
 from pathlib import Path
+from typing import Literal
 
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
+from quixstreams.models import TopicConfig
 
 from app.enums import TradeSourceName
 
@@ -13,26 +15,189 @@ DOTENV_PATH = os.path.join(BASE_DIR, ".env")
 load_dotenv(f"{DOTENV_PATH}")
 print("JOB_ID: ", os.getenv("BACKFILL_JOB_ID"))
 
-def get_kafka_trades_topic_name() -> str:
+
+def get_trades_source_names() -> list[TradeSourceName]:
+	# several sources in one process, e.g. TRADES_SOURCE__NAMES=kraken_spot,bybit_spot
+	names = os.getenv("TRADES_SOURCE__NAMES") or os.getenv(
+		"TRADES_SOURCE__NAME", "kraken_spot"
+	)
+	return [TradeSourceName(name.strip()) for name in names.split(",") if name.strip()]
+
+
+def get_kafka_trades_topic_name(source_name: TradeSourceName | None = None) -> str:
 	env_topic = os.getenv("KAFKA_TRADES_TOPIC")
+	if source_name is not None:
+		# KAFKA_TRADES_TOPIC__<SOURCE> routes the trades of a source to its own topic
+		env_topic = os.getenv(
+			f"KAFKA_TRADES_TOPIC__{source_name.value.upper()}", env_topic
+		)
 	print(f"env_topic: {env_topic}")
 	if "historical" in env_topic:
 		return f"{env_topic}_{os.getenv('BACKFILL_JOB_ID')}"
 	return env_topic
 
 
+def get_trades_source_symbols(source_name: TradeSourceName) -> list[str]:
+	symbols = os.getenv(
+		f"TRADES_SOURCE__SYMBOLS__{source_name.value.upper()}",
+		os.getenv("TRADES_SOURCE__SYMBOLS", ""),
+	)
+	return symbols.split(",")
+
+
+def get_kafka_trades_symbol_weights() -> dict[str, float]:
+	# relative trade rates of the hot symbols, e.g. BTC/USD:20,ETH/USD:8
+	weights = os.getenv("KAFKA_TRADES_SYMBOL_WEIGHTS", "")
+	return {
+		symbol.strip(): float(weight)
+		for symbol, _, weight in (
+			item.rpartition(":") for item in weights.split(",") if item.strip()
+		)
+	}
+
+
 class KafkaSettings(BaseModel):
 	BROKER_ADDRESS: str = os.getenv("KAFKA_BROKER_ADDRESS", "localhost:19092")
 	TRADES_TOPIC: str = get_kafka_trades_topic_name()
+	SOURCE_TRADES_TOPICS: dict[TradeSourceName, str] = {
+		name: get_kafka_trades_topic_name(name) for name in get_trades_source_names()
+	}
+	# json or binary, see app/serializers.py
+	TRADES_TOPIC_FORMAT: Literal["json", "binary"] = os.getenv(
+		"KAFKA_TRADES_TOPIC_FORMAT", "json"
+	)
+	PRODUCER_LINGER_MS: int = int(os.getenv("KAFKA_PRODUCER_LINGER_MS", 20))
+	PRODUCER_BATCH_SIZE: int = int(os.getenv("KAFKA_PRODUCER_BATCH_SIZE", 1_000_000))
+	# none, gzip, snappy, lz4 or zstd
+	PRODUCER_COMPRESSION_TYPE: str = os.getenv("KAFKA_PRODUCER_COMPRESSION_TYPE", "lz4")
+	# all, 1 or 0; anything but "all" disables the idempotent producer
+	PRODUCER_ACKS: str = os.getenv("KAFKA_PRODUCER_ACKS", "all")
+	PRODUCER_QUEUE_MAX_MESSAGES: int = int(
+		os.getenv("KAFKA_PRODUCER_QUEUE_MAX_MESSAGES", 100_000)
+	)
+	# trades buffered between the sources and the publisher thread
+	HANDOFF_QUEUE_MAX_TRADES: int = int(
+		os.getenv("KAFKA_HANDOFF_QUEUE_MAX_TRADES", 200_000)
+	)
+	# block, drop_oldest or spill, what the sources do when the queue is full
+	HANDOFF_QUEUE_OVERFLOW_POLICY: Literal["block", "drop_oldest", "spill"] = os.getenv(
+		"KAFKA_HANDOFF_QUEUE_OVERFLOW_POLICY", "block"
+	)
+	# directory of the spill file, the temp dir by default
+	HANDOFF_QUEUE_SPILL_DIR: str | None = os.getenv("KAFKA_HANDOFF_QUEUE_SPILL_DIR")
+	# partitions and replicas of the trades topics created by the producer,
+	# 1 when unset; existing topics are left as they are
+	TOPIC_PARTITIONS: int | None = (
+		int(os.getenv("KAFKA_TOPIC_PARTITIONS"))
+		if os.getenv("KAFKA_TOPIC_PARTITIONS")
+		else None
+	)
+	TOPIC_REPLICATION_FACTOR: int | None = (
+		int(os.getenv("KAFKA_TOPIC_REPLICATION_FACTOR"))
+		if os.getenv("KAFKA_TOPIC_REPLICATION_FACTOR")
+		else None
+	)
+	# key: hash of the symbol, balanced: hot symbols spread by weight,
+	# see app/partitioner.py
+	TRADES_PARTITIONING: Literal["key", "balanced"] = os.getenv(
+		"KAFKA_TRADES_PARTITIONING", "key"
+	)
+	TRADES_SYMBOL_WEIGHTS: dict[str, float] = get_kafka_trades_symbol_weights()
+
+	def producer_extra_config(self) -> dict:
+		config = {
+			"linger.ms": self.PRODUCER_LINGER_MS,
+			"batch.size": self.PRODUCER_BATCH_SIZE,
+			"compression.type": self.PRODUCER_COMPRESSION_TYPE,
+			"acks": self.PRODUCER_ACKS,
+			"queue.buffering.max.messages": self.PRODUCER_QUEUE_MAX_MESSAGES,
+		}
+		if self.PRODUCER_ACKS not in ("all", "-1"):
+			config["enable.idempotence"] = False
+		return config
+
+	def topic_config(self) -> TopicConfig | None:
+		if not self.TOPIC_PARTITIONS and not self.TOPIC_REPLICATION_FACTOR:
+			return None
+		return TopicConfig(
+			num_partitions=self.TOPIC_PARTITIONS or 1,
+			replication_factor=self.TOPIC_REPLICATION_FACTOR or 1,
+		)
 
 
 class TradesSourceSettings(BaseModel):
 	NAME: TradeSourceName = TradeSourceName(
 		os.getenv("TRADES_SOURCE__NAME", "kraken_spot")
 	)
+	NAMES: list[TradeSourceName] = get_trades_source_names()
+	LIVE_RECONNECT_MAX_DELAY_S: float = float(
+		os.getenv("TRADES_SOURCE__LIVE_RECONNECT_MAX_DELAY_S", 60.0)
+	)
+	LIVE_HEARTBEAT_TIMEOUT_S: float = float(
+		os.getenv("TRADES_SOURCE__LIVE_HEARTBEAT_TIMEOUT_S", 10.0)
+	)
+	# fetch the trades missed while the websocket was disconnected from the REST API
+	LIVE_GAP_REPAIR: bool = (
+		os.getenv("TRADES_SOURCE__LIVE_GAP_REPAIR", "true") == "true"
+	)
+	# larger symbol lists of a live source are sharded over several connections
+	LIVE_SYMBOLS_PER_CONNECTION: int = int(
+		os.getenv("TRADES_SOURCE__LIVE_SYMBOLS_PER_CONNECTION", 100)
+	)
+	# processes sharing the symbols of the live sources, each with its own producer
+	LIVE_WORKER_PROCESSES: int = int(
+		os.getenv("TRADES_SOURCE__LIVE_WORKER_PROCESSES", 1)
+	)
+	# files, directories or glob patterns of the trades replayed by the replay source
+	REPLAY_PATHS: list[str] = os.getenv("TRADES_SOURCE__REPLAY_PATHS", "").split(",")
+	# 1 keeps the original timing between trades, N is N times faster, 0 is max speed
+	REPLAY_SPEED: float = float(os.getenv("TRADES_SOURCE__REPLAY_SPEED", 0.0))
+	# Kraken or Bybit trade archives (CSV, gzip or zip) imported by the archive source
+	ARCHIVE_PATHS: list[str] = os.getenv("TRADES_SOURCE__ARCHIVE_PATHS", "").split(",")
+	# auto, kraken or bybit
+	ARCHIVE_FORMAT: str = os.getenv("TRADES_SOURCE__ARCHIVE_FORMAT", "auto")
+	# records the trades of every source to JSON lines files in this directory
+	RECORD_DIR: str | None = os.getenv("TRADES_SOURCE__RECORD_DIR")
 	HISTORICAL_SINCE: str | None = os.getenv("TRADES_SOURCE__HISTORICAL_SINCE")
 	HISTORICAL_END: str | None = os.getenv("TRADES_SOURCE__HISTORICAL_END")
 	SYMBOLS: list[str] = os.getenv("TRADES_SOURCE__SYMBOLS", "").split(",")
+	SOURCE_SYMBOLS: dict[TradeSourceName, list[str]] = {
+		name: get_trades_source_symbols(name) for name in get_trades_source_names()
+	}
+	HISTORICAL_SHARDS_PER_SYMBOL: int = int(
+		os.getenv("TRADES_SOURCE__HISTORICAL_SHARDS_PER_SYMBOL", 4)
+	)
+	HISTORICAL_MAX_CONCURRENCY: int = int(
+		os.getenv("TRADES_SOURCE__HISTORICAL_MAX_CONCURRENCY", 4)
+	)
+	HISTORICAL_REQUESTS_PER_SECOND: float = float(
+		os.getenv("TRADES_SOURCE__HISTORICAL_REQUESTS_PER_SECOND", 1.0)
+	)
+	HISTORICAL_MAX_REQUESTS_PER_SECOND: float = float(
+		os.getenv("TRADES_SOURCE__HISTORICAL_MAX_REQUESTS_PER_SECOND", 3.0)
+	)
+	HISTORICAL_MAX_RETRIES: int = int(
+		os.getenv("TRADES_SOURCE__HISTORICAL_MAX_RETRIES", 5)
+	)
+	# rate limited requests, retried more slowly, are counted apart
+	HISTORICAL_MAX_RATE_LIMITED_RETRIES: int = int(
+		os.getenv("TRADES_SOURCE__HISTORICAL_MAX_RATE_LIMITED_RETRIES", 30)
+	)
+	# empty value disables the on-disk cache of downloaded historical pages
+	HISTORICAL_CACHE_DIR: str = os.getenv(
+		"TRADES_SOURCE__HISTORICAL_CACHE_DIR",
+		os.path.join(BASE_DIR, "state", "trades_page_cache"),
+	)
+	HISTORICAL_CACHE_MAX_BYTES: int = int(
+		os.getenv("TRADES_SOURCE__HISTORICAL_CACHE_MAX_BYTES", 2 * 1024**3)
+	)
+	# empty value disables resuming the historical download after a restart
+	HISTORICAL_CHECKPOINT_PATH: str = os.getenv(
+		"TRADES_SOURCE__HISTORICAL_CHECKPOINT_PATH",
+		os.path.join(
+			BASE_DIR, "state", f"checkpoints_{os.getenv('BACKFILL_JOB_ID')}.json"
+		),
+	)
 
 
 class Settings(BaseSettings):
@@ -1,22 +1,45 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import signal
+import sys
+import threading
 from datetime import datetime as dt
+from typing import Callable
 
 import structlog
 from quixstreams import Application
+from quixstreams.models import Topic, TopicAdmin, TopicConfig
 
 from app.abstract.trades_connector import TradesConnector
 from app.config import settings
 from app.enums import TradeSourceName
-from app.schemas.trade_schema import Trade
+from app.partitioner import SymbolPartitioner
+from app.schemas.trade_schema import Trade, TradeRecord
+from app.serializers import (
+	TRADE_V2,
+	TopicFormat,
+	get_object_encoder,
+	get_value_serializer,
+)
 from app.trades_connectors import (
+	ArchiveTradesConnector,
 	BybitSpotTradesConnector,
 	KrakenHistoricalTradesConnector,
 	KrakenTradesConnector,
+	ReplayTradesConnector,
+	TradesRecorder,
 )
+from app.trades_connectors.checkpoint_store import CheckpointStore
+from app.trades_connectors.page_cache import TradesPageCache
+from app.trades_publisher import TradesPublisher
+from app.trades_queue import TradesQueue
 
 logger = structlog.getLogger(settings.LOGGER_NAME)
 
-
-
+# the sources whose symbols are shared by the worker processes
+LIVE_SOURCES = (TradeSourceName.KRAKEN_SPOT, TradeSourceName.BYBIT_SPOT)
 
 
 class TradesProducer:
@@ -33,14 +56,55 @@ class TradesProducer:
 		self,
 		kafka_broker_address: str,
 		kafka_topic: str,
+		producer_extra_config: dict | None = None,
+		topic_format: TopicFormat = "json",
+		handoff_queue: TradesQueue | None = None,
+		topic_config: TopicConfig | None = None,
+		symbol_weights: dict[str, float] | None = None,
 	) -> None:
+		"""
+		:param topic_config: Partitions and replicas of the topics created
+			by the producer.
+		:param symbol_weights: Relative trade rates of the hot symbols for the
+			balanced partitioning of app/partitioner.py, None to partition by
+			the hash of the symbol.
+		"""
 		logger.info("Initializing trades producer")
 		logger.debug(kafka_broker_address)
 		self.sources = []
+		self._subscriptions: list[dict] = []
 		self.kafka_broker_address = kafka_broker_address
-		self.kafka = Application(self.kafka_broker_address)
-		self.topic = self.kafka.topic(kafka_topic, value_serializer="json")
-		self.producer = self.kafka.get_producer()
+		self.kafka = Application(
+			self.kafka_broker_address, producer_extra_config=producer_extra_config
+		)
+		self._topics: dict[str, Topic] = {}
+		self._topic_format = topic_format
+		self._topic_config = topic_config
+		self._symbol_weights = symbol_weights
+		# trades are encoded straight from the records, bypassing Topic.serialize()
+		self._encode_trade = get_object_encoder(topic_format, TRADE_V2)
+		self.topic = self._get_topic(kafka_topic)
+		# created by run() once the topics of all sources are declared,
+		# as the producer creates the missing topics on start
+		self.producer = None
+		self.publisher: TradesPublisher | None = None
+		# the sources only hand their trades over to the queue, a dedicated
+		# thread publishes them, so a slow broker never stalls a websocket
+		self.queue = handoff_queue or TradesQueue()
+		self._publisher_thread: threading.Thread | None = None
+		self._publisher_error: Exception | None = None
+		self._loop: asyncio.AbstractEventLoop | None = None
+		self._stop_event: asyncio.Event | None = None
+		self._stop_requested = False
+
+	def _get_topic(self, name: str) -> Topic:
+		if name not in self._topics:
+			self._topics[name] = self.kafka.topic(
+				name,
+				value_serializer=get_value_serializer(self._topic_format, TRADE_V2),
+				config=self._topic_config,
+			)
+		return self._topics[name]
 
 	def subscribe_to_trades(
 		self,
@@ -48,42 +112,255 @@ class TradesProducer:
 		source: TradesConnector,
 		historical_start_ms: int | None = None,
 		historical_end_ms: int | None = None,
+		topic: str | None = None,
+		partition_symbols: list[str] | None = None,
 	) -> None:
+		"""
+		Adds the source to the producer, its trades are streamed to Kafka by `run()`.
+		All sources share one event loop and one Kafka producer;
+		`topic` routes the trades of the source to its own topic.
+		`partition_symbols` are all the symbols of the source the balanced
+		partitions are assigned from, by default `symbols`; a worker process
+		streaming a share of them passes all of them.
+		"""
 		self.sources.append(source)
-		source.subscribe_to_trades(
-			symbols=symbols,
-			callback=self.push_trade_to_queue,
-			historical_start_ms=historical_start_ms,
-			historical_end_ms=historical_end_ms,
+		self._subscriptions.append(
+			{
+				"source": source,
+				"symbols": symbols,
+				"historical_start_ms": historical_start_ms,
+				"historical_end_ms": historical_end_ms,
+				"topic": self._get_topic(topic) if topic else self.topic,
+				"partition_symbols": partition_symbols or symbols,
+			}
+		)
+
+	def run(self, poll_interval_s: float = 0.5) -> None:
+		"""
+		Blocks until all sources are finished, one of them fails or `stop()` is called.
+		Re-raises a source or publisher failure.
+		"""
+		asyncio.run(self._run(poll_interval_s))
+		if self._publisher_error is not None:
+			raise self._publisher_error
+
+	async def _run(self, poll_interval_s: float) -> None:
+		self._loop = asyncio.get_running_loop()
+		self._stop_event = asyncio.Event()
+		if self._stop_requested:
+			return
+		self.producer = self.kafka.get_producer()
+		self.publisher = TradesPublisher(
+			self.producer,
+			handoff_queue=self.queue,
+			partitioners=self._get_partitioners(),
+		)
+		self._publisher_thread = threading.Thread(
+			target=self._publish_queued_trades,
+			args=(poll_interval_s,),
+			name="trades_publisher",
+			daemon=True,
 		)
+		self._publisher_thread.start()
+		tasks = {
+			asyncio.create_task(
+				subscription["source"].stream_trades(
+					symbols=subscription["symbols"],
+					callback=functools.partial(
+						self.push_trade_to_queue_async, topic=subscription["topic"]
+					),
+					historical_start_ms=subscription["historical_start_ms"],
+					historical_end_ms=subscription["historical_end_ms"],
+				),
+				name=type(subscription["source"]).__name__,
+			)
+			for subscription in self._subscriptions
+		}
+		stop_task = asyncio.create_task(self._stop_event.wait())
+		pending = set(tasks)
+		try:
+			while pending and not self._stop_event.is_set():
+				done, _ = await asyncio.wait(
+					pending | {stop_task}, return_when=asyncio.FIRST_COMPLETED
+				)
+				for task in done & pending:
+					pending.discard(task)
+					if not task.cancelled() and task.exception() is not None:
+						e = task.exception()
+						logger.error(f"{task.get_name()} failed: {e} [{type(e)}]")
+						raise e
+					logger.info(f"{task.get_name()} finished")
+		finally:
+			for task in (*pending, stop_task):
+				task.cancel()
+			await asyncio.gather(*pending, stop_task, return_exceptions=True)
 
-	def push_trade_to_queue(self, trades: list[Trade]):
-		for trade in trades:
-			serialized_trade = self.topic.serialize(
-				key=trade.symbol, value=trade.model_dump()
+	def _get_partitioners(self) -> dict[str, SymbolPartitioner]:
+		"""
+		The balanced partitioners of the topics, by the partition counts of
+		the topics on the broker, which may predate `topic_config`.
+		"""
+		if self._symbol_weights is None:
+			return {}
+		symbols_by_topic: dict[str, list[str]] = {}
+		for subscription in self._subscriptions:
+			symbols_by_topic.setdefault(subscription["topic"].name, []).extend(
+				subscription["partition_symbols"]
+			)
+		topic_configs = TopicAdmin(self.kafka_broker_address).inspect_topics(
+			list(symbols_by_topic)
+		)
+		partitioners = {}
+		for topic_name, symbols in symbols_by_topic.items():
+			partitioner = SymbolPartitioner(
+				symbols,
+				num_partitions=topic_configs[topic_name].num_partitions,
+				weights=self._symbol_weights,
 			)
-			self.producer.produce(
-				topic=self.topic.name,
-				value=serialized_trade.value,
-				key=serialized_trade.key,
+			logger.info(
+				f"Balanced partitions of {topic_name}, loads by partition: "
+				f"{partitioner.loads}"
 			)
-			# logger.debug(f"Pushed trade to Kafka: {trade}")
-			print(f"Pushed trade to Kafka: {trade}", flush=True, end="\r")
+			partitioners[topic_name] = partitioner
+		return partitioners
+
+	def _publish_queued_trades(self, poll_interval_s: float) -> None:
+		"""
+		Publishes the queued trades until the queue is closed and drained.
+		Serves Kafka delivery callbacks meanwhile.
+		"""
+		try:
+			while True:
+				batch = self.queue.get(timeout=poll_interval_s)
+				if batch is not None:
+					self.publisher.publish(
+						batch.topic_name,
+						batch.trades,
+						encode=self._encode_trade,
+						on_delivered=batch.on_delivered,
+					)
+				elif self.queue.closed:
+					return
+				self.publisher.poll(0)
+		except Exception as e:
+			logger.error(f"Publishing trades failed: {e} [{type(e)}]")
+			self._publisher_error = e
+			self.queue.close()
+			self.stop()
+
+	def stop(self) -> None:
+		"""Makes `run()` return. Safe to call from a signal handler or any thread."""
+		self._stop_requested = True
+		if self._loop is None or self._stop_event is None:
+			return
+		try:
+			self._loop.call_soon_threadsafe(self._stop_event.set)
+		except RuntimeError:
+			# the event loop is already closed, run() has returned
+			pass
+
+	def push_trade_to_queue(
+		self,
+		trades: list[Trade | TradeRecord],
+		on_delivered: Callable[[], None] | None = None,
+		topic: Topic | None = None,
+	):
+		"""
+		Queues a batch of trades for the publisher thread. Safe to call from any
+		thread but the one of the event loop, as it blocks while the queue is full.
+		`on_delivered` is called once the broker has acknowledged all of them.
+		"""
+		topic = topic or self.topic
+		self.queue.put(topic.name, trades, on_delivered)
+
+	async def push_trade_to_queue_async(
+		self,
+		trades: list[Trade | TradeRecord],
+		on_delivered: Callable[[], None] | None = None,
+		topic: Topic | None = None,
+	):
+		"""
+		`push_trade_to_queue` for the sources on the event loop: awaits room in
+		the queue instead of blocking the loop.
+		"""
+		topic = topic or self.topic
+		await self.queue.put_async(topic.name, trades, on_delivered)
 
 	def close(self) -> None:
-		self.producer.flush()
+		"""
+		Stops all sources, publishes the queued trades, delivers them and closes
+		the sources. Sources are closed after the flush, as they may persist
+		delivery results.
+		"""
+		for source in self.sources:
+			source.stop()
+		self.queue.close()
+		if self._publisher_thread is not None:
+			self._publisher_thread.join()
+		if self.publisher is not None:
+			self.publisher.flush()
+		for source in self.sources:
+			source.close()
 
 
-def get_trades_connector() -> TradesConnector:
-	if settings.trades_source.NAME == TradeSourceName.KRAKEN_SPOT:
+def get_trades_connector(
+	name: TradeSourceName = settings.trades_source.NAME,
+) -> TradesConnector:
+	if name == TradeSourceName.KRAKEN_SPOT:
 		# settings.kafka.TRADES_TOPIC = "trades_kraken_spot"
-		return KrakenTradesConnector()
-	elif settings.trades_source.NAME == TradeSourceName.KRAKEN_SPOT_HISTORICAL:
+		return KrakenTradesConnector(
+			reconnect_max_delay_s=settings.trades_source.LIVE_RECONNECT_MAX_DELAY_S,
+			heartbeat_timeout_s=settings.trades_source.LIVE_HEARTBEAT_TIMEOUT_S,
+			symbols_per_connection=settings.trades_source.LIVE_SYMBOLS_PER_CONNECTION,
+			rest_connector=(
+				KrakenHistoricalTradesConnector(
+					requests_per_second=settings.trades_source.HISTORICAL_REQUESTS_PER_SECOND,
+					max_requests_per_second=settings.trades_source.HISTORICAL_MAX_REQUESTS_PER_SECOND,
+					max_retries=settings.trades_source.HISTORICAL_MAX_RETRIES,
+					max_rate_limited_retries=settings.trades_source.HISTORICAL_MAX_RATE_LIMITED_RETRIES,
+				)
+				if settings.trades_source.LIVE_GAP_REPAIR
+				else None
+			),
+		)
+	elif name == TradeSourceName.KRAKEN_SPOT_HISTORICAL:
 		# settings.kafka.TRADES_TOPIC = "trades_kraken_spot_historical"
-		return KrakenHistoricalTradesConnector()
-	elif settings.trades_source.NAME == TradeSourceName.BYBIT_SPOT:
+		return KrakenHistoricalTradesConnector(
+			shards_per_symbol=settings.trades_source.HISTORICAL_SHARDS_PER_SYMBOL,
+			max_concurrency=settings.trades_source.HISTORICAL_MAX_CONCURRENCY,
+			requests_per_second=settings.trades_source.HISTORICAL_REQUESTS_PER_SECOND,
+			max_requests_per_second=settings.trades_source.HISTORICAL_MAX_REQUESTS_PER_SECOND,
+			max_retries=settings.trades_source.HISTORICAL_MAX_RETRIES,
+			max_rate_limited_retries=settings.trades_source.HISTORICAL_MAX_RATE_LIMITED_RETRIES,
+			page_cache=(
+				TradesPageCache(
+					cache_dir=settings.trades_source.HISTORICAL_CACHE_DIR,
+					max_bytes=settings.trades_source.HISTORICAL_CACHE_MAX_BYTES,
+				)
+				if settings.trades_source.HISTORICAL_CACHE_DIR
+				else None
+			),
+			checkpoint_store=(
+				CheckpointStore(settings.trades_source.HISTORICAL_CHECKPOINT_PATH)
+				if settings.trades_source.HISTORICAL_CHECKPOINT_PATH
+				else None
+			),
+		)
+	elif name == TradeSourceName.BYBIT_SPOT:
 		# settings.kafka.TRADES_TOPIC = "trades_bybit_spot"
-		return BybitSpotTradesConnector()
+		return BybitSpotTradesConnector(
+			symbols_per_connection=settings.trades_source.LIVE_SYMBOLS_PER_CONNECTION,
+		)
+	elif name == TradeSourceName.REPLAY:
+		return ReplayTradesConnector(
+			paths=settings.trades_source.REPLAY_PATHS,
+			speed=settings.trades_source.REPLAY_SPEED,
+		)
+	elif name == TradeSourceName.ARCHIVE:
+		return ArchiveTradesConnector(
+			paths=settings.trades_source.ARCHIVE_PATHS,
+			archive_format=settings.trades_source.ARCHIVE_FORMAT,
+		)
 	raise NotImplementedError
 
 
@@ -96,10 +373,28 @@ def convert_str_to_ms(date_str: str) -> int:
 	return timestamp_ms
 
 
-if __name__ == "__main__":
-	trades_connector = get_trades_connector()
+def run_trades_producer(worker_index: int = 0, worker_count: int = 1) -> None:
+	"""
+	Streams the trades of all configured sources to Kafka until stopped.
+	With several workers every worker streams its share of the symbols of the
+	live sources; the other sources are streamed by the first worker only.
+	"""
 	producer = TradesProducer(
-		settings.kafka.BROKER_ADDRESS, settings.kafka.TRADES_TOPIC
+		settings.kafka.BROKER_ADDRESS,
+		settings.kafka.TRADES_TOPIC,
+		producer_extra_config=settings.kafka.producer_extra_config(),
+		topic_format=settings.kafka.TRADES_TOPIC_FORMAT,
+		handoff_queue=TradesQueue(
+			max_trades=settings.kafka.HANDOFF_QUEUE_MAX_TRADES,
+			overflow_policy=settings.kafka.HANDOFF_QUEUE_OVERFLOW_POLICY,
+			spill_dir=settings.kafka.HANDOFF_QUEUE_SPILL_DIR,
+		),
+		topic_config=settings.kafka.topic_config(),
+		symbol_weights=(
+			settings.kafka.TRADES_SYMBOL_WEIGHTS
+			if settings.kafka.TRADES_PARTITIONING == "balanced"
+			else None
+		),
 	)
 	historical_start_ms = (
 		convert_str_to_ms(settings.trades_source.HISTORICAL_SINCE)
@@ -111,16 +406,85 @@ if __name__ == "__main__":
 		if settings.trades_source.HISTORICAL_END
 		else None
 	)
-	producer.subscribe_to_trades(
-		symbols=settings.trades_source.SYMBOLS,
-		source=trades_connector,
-		historical_start_ms=historical_start_ms,
-		historical_end_ms=historical_end_ms,
-	)
+	for source_name in settings.trades_source.NAMES:
+		symbols = settings.trades_source.SOURCE_SYMBOLS[source_name]
+		partition_symbols = [symbol for symbol in symbols if symbol]
+		if source_name in LIVE_SOURCES:
+			symbols = partition_symbols[worker_index::worker_count]
+			if not symbols:
+				continue
+		elif worker_index:
+			continue
+		trades_connector = get_trades_connector(source_name)
+		if settings.trades_source.RECORD_DIR:
+			trades_connector = TradesRecorder(
+				trades_connector,
+				record_dir=settings.trades_source.RECORD_DIR,
+				name=f"{source_name.value}_{worker_index}"
+				if worker_count > 1
+				else source_name.value,
+			)
+		producer.subscribe_to_trades(
+			symbols=symbols,
+			source=trades_connector,
+			historical_start_ms=historical_start_ms,
+			historical_end_ms=historical_end_ms,
+			topic=settings.kafka.SOURCE_TRADES_TOPICS[source_name],
+			partition_symbols=partition_symbols,
+		)
+
+	def handle_stop_signal(signum, frame) -> None:
+		logger.info(f"Received {signal.Signals(signum).name}, shutting down...")
+		producer.stop()
+
+	signal.signal(signal.SIGTERM, handle_stop_signal)
+	signal.signal(signal.SIGINT, handle_stop_signal)
 	try:
-		while producer.is_active:
-			...
-	except KeyboardInterrupt:
-		...
+		producer.run()
 	finally:
 		producer.close()
+
+
+def run_worker_processes(worker_count: int) -> int:
+	"""
+	Runs the producer in several processes, so the websocket messages of large
+	symbol lists are parsed on several cores. Stop signals are forwarded to the
+	workers; when a worker fails the others are stopped too.
+	Returns the exit code.
+	"""
+	workers = [
+		multiprocessing.Process(
+			target=run_trades_producer,
+			args=(worker_index, worker_count),
+			name=f"trades_producer_{worker_index}",
+		)
+		for worker_index in range(worker_count)
+	]
+	for worker in workers:
+		worker.start()
+
+	def forward_stop_signal(signum, frame) -> None:
+		logger.info(f"Received {signal.Signals(signum).name}, stopping the workers...")
+		for worker in workers:
+			if worker.is_alive():
+				os.kill(worker.pid, signum)
+
+	signal.signal(signal.SIGTERM, forward_stop_signal)
+	signal.signal(signal.SIGINT, forward_stop_signal)
+	failed = False
+	while any(worker.is_alive() for worker in workers):
+		for worker in workers:
+			worker.join(timeout=1)
+			if worker.exitcode and not failed:
+				failed = True
+				logger.error(f"{worker.name} failed with exit code {worker.exitcode}")
+				for other in workers:
+					if other.is_alive():
+						other.terminate()
+	return 1 if any(worker.exitcode for worker in workers) else 0
+
+
+if __name__ == "__main__":
+	if settings.trades_source.LIVE_WORKER_PROCESSES > 1:
+		sys.exit(run_worker_processes(settings.trades_source.LIVE_WORKER_PROCESSES))
+	run_trades_producer()
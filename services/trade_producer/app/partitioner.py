@@ -0,0 +1,62 @@
+"""
+Partitions of the trades topics by symbol.
+
+The trades are keyed by symbol, and a consumer keeps the window state of
+a symbol in the partition it reads it from, so all the trades of a symbol go
+to one partition. The default `key` partitioning hashes the symbol in the
+producer (CRC32, the `consistent_random` default partitioner of librdkafka,
+unlike the murmur2 of the Java clients), which spreads the symbols evenly
+by count but not by trades: a few hot symbols, e.g. BTC/USD, can share one
+partition, whose consumer then bounds the throughput of the whole group.
+
+The `balanced` partitioning assigns the configured symbols to the partitions
+up front by weight, their expected share of the trades, 1 unless configured:
+the heaviest symbol first, each to the least loaded partition, so the hot
+symbols get partitions of their own as long as there are enough of them.
+Symbols outside of the configuration fall back to a hash of the symbol.
+
+The assignment only depends on the symbols, their weights and the partition
+count, so it is the same in every worker process and after a restart.
+Changing any of them moves symbols to other partitions, splitting their open
+windows between two consumers, so change them along with a new consumer group
+of trade_to_ohlcv.
+"""
+
+import heapq
+import zlib
+from typing import Iterable, Mapping
+
+
+class SymbolPartitioner:
+	"""The balanced partition of every symbol of one topic."""
+
+	def __init__(
+		self,
+		symbols: Iterable[str],
+		num_partitions: int,
+		weights: Mapping[str, float] | None = None,
+	):
+		"""
+		:param symbols: All symbols of the topic, not only those of one worker.
+		:param num_partitions: Partition count of the topic.
+		:param weights: Relative trade rates of the hot symbols, the others are 1.
+		"""
+		self.num_partitions = num_partitions
+		weights = weights or {}
+		symbols = set(symbols) | set(weights)
+		symbols.discard("")
+		# (load, partition) of every partition, the least loaded first
+		loads = [(0.0, partition) for partition in range(num_partitions)]
+		self._partitions: dict[str, int] = {}
+		for symbol in sorted(symbols, key=lambda s: (-weights.get(s, 1.0), s)):
+			load, partition = heapq.heappop(loads)
+			self._partitions[symbol] = partition
+			heapq.heappush(loads, (load + weights.get(symbol, 1.0), partition))
+		self.loads = [load for load, _ in sorted(loads, key=lambda item: item[1])]
+
+	def partition(self, symbol: str) -> int:
+		partition = self._partitions.get(symbol)
+		if partition is None:
+			partition = zlib.crc32(symbol.encode()) % self.num_partitions
+			self._partitions[symbol] = partition
+		return partition
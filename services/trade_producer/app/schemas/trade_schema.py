@@ -1,8 +1,47 @@
+from typing import NamedTuple
+
+import orjson
 from pydantic import BaseModel
 
+# aggressor side of a trade as reported by the exchange
+BUY = 1
+SELL = -1
+UNKNOWN_SIDE = 0
+
 
 class Trade(BaseModel):
 	symbol: str
 	qty: float
 	price: float
 	timestamp_ms: int
+	side: int = UNKNOWN_SIDE
+
+	def to_json(self) -> bytes:
+		return orjson.dumps(self.model_dump())
+
+
+class TradeRecord(NamedTuple):
+	"""
+	Tuple-backed `Trade` for the hot decoding path of the connectors.
+	It skips the pydantic validation, so the fields must already have their types.
+	"""
+
+	symbol: str
+	qty: float
+	price: float
+	timestamp_ms: int
+	side: int = UNKNOWN_SIDE
+
+	def model_dump(self) -> dict:
+		return self._asdict()
+
+	def to_json(self) -> bytes:
+		return orjson.dumps(
+			{
+				"symbol": self.symbol,
+				"qty": self.qty,
+				"price": self.price,
+				"timestamp_ms": self.timestamp_ms,
+				"side": self.side,
+			}
+		)
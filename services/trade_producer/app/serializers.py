@@ -0,0 +1,307 @@
+"""
+Compact binary encoding of the records exchanged between the streaming services.
+
+A message is a 2 byte header (magic byte, schema id) followed by the fixed-size
+fields of the schema in little-endian order and the length-prefixed UTF-8 symbol.
+The schema id is versioned: a changed layout gets a new id, and readers keep
+decoding every id they know. JSON payloads start with "{" and are decoded as
+JSON, so a topic can be switched between the formats without draining it.
+
+The module is shared by trade_producer, trade_to_ohlcv and topic_to_feature_store
+and is kept in sync between them, see trade_to_ohlcv/tests/test_serializers.py.
+"""
+
+import operator
+import struct
+from typing import Any, Callable, Literal, Mapping
+
+from quixstreams.models.serializers import (
+	Deserializer,
+	SerializationContext,
+	SerializationError,
+	Serializer,
+)
+from quixstreams.utils.json import loads as json_loads
+
+MAGIC = 0xB1
+
+TopicFormat = Literal["json", "binary"]
+
+
+class RecordSchema:
+	"""Layout of one version of a record: fixed-size fields, then the symbol."""
+
+	def __init__(
+		self,
+		schema_id: int,
+		name: str,
+		fields: dict[str, str],
+		defaults: dict[str, Any] | None = None,
+	):
+		"""
+		:param schema_id: Unique id of the record layout, written to every message.
+		:param name: Human readable name of the record, e.g. "trade_v1".
+		:param fields: Names and `struct` format characters of the fixed-size fields.
+		:param defaults: Values of the optional fields a record may leave out.
+		"""
+		self.schema_id = schema_id
+		self.name = name
+		self.fields = tuple(fields)
+		self.defaults = dict(defaults or {})
+		# the header is part of the struct, so a message is packed in one call
+		self._struct = struct.Struct("<BB" + "".join(fields.values()) + "H")
+		# the fixed-size fields follow the magic byte and the schema id
+		self._field_indexes = tuple(enumerate(self.fields, start=2))
+		self._get_items = operator.itemgetter(*self.fields)
+		if defaults:
+			self._get_items = lambda record: tuple(
+				record.get(field, defaults.get(field)) for field in self.fields
+			)
+		self._get_attrs = operator.attrgetter(*self.fields)
+
+	def encode(self, record: Mapping[str, Any]) -> bytes:
+		symbol = record["symbol"].encode()
+		return (
+			self._struct.pack(
+				MAGIC, self.schema_id, *self._get_items(record), len(symbol)
+			)
+			+ symbol
+		)
+
+	def encode_object(self, record: Any) -> bytes:
+		"""Encodes a record with the fields as attributes, e.g. a `TradeRecord`."""
+		symbol = record.symbol.encode()
+		return (
+			self._struct.pack(
+				MAGIC, self.schema_id, *self._get_attrs(record), len(symbol)
+			)
+			+ symbol
+		)
+
+	def decode(self, data: bytes) -> dict:
+		values = self._struct.unpack_from(data)
+		record = {field: values[i] for i, field in self._field_indexes}
+		record["symbol"] = data[
+			self._struct.size : self._struct.size + values[-1]
+		].decode()
+		return record
+
+	@property
+	def size(self) -> int:
+		"""Size of a message without the symbol."""
+		return self._struct.size
+
+
+TRADE_V1 = RecordSchema(
+	schema_id=1,
+	name="trade_v1",
+	fields={"qty": "d", "price": "d", "timestamp_ms": "q"},
+)
+# trades with the aggressor side the exchange reported: 1 buy, -1 sell, 0 unknown
+TRADE_V2 = RecordSchema(
+	schema_id=8,
+	name="trade_v2",
+	fields={"qty": "d", "price": "d", "timestamp_ms": "q", "side": "b"},
+	defaults={"side": 0},
+)
+OHLCV_V1 = RecordSchema(
+	schema_id=2,
+	name="ohlcv_v1",
+	fields={
+		"timestamp_ms": "q",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+	},
+)
+# candles of several timeframes sharing a topic
+OHLCV_V2 = RecordSchema(
+	schema_id=3,
+	name="ohlcv_v2",
+	fields={
+		"timestamp_ms": "q",
+		"window_seconds": "I",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+	},
+)
+# in-progress candles, updated until the one with is_final closes the window
+OHLCV_PARTIAL_V1 = RecordSchema(
+	schema_id=4,
+	name="ohlcv_partial_v1",
+	fields={
+		"timestamp_ms": "q",
+		"window_seconds": "I",
+		"is_final": "?",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+	},
+)
+# candles with the extra statistics of trade_to_ohlcv, those left out are zero
+OHLCV_STATS_FIELDS = {
+	"notional": "d",
+	"vwap": "d",
+	"trade_count": "I",
+	"buy_volume": "d",
+	"sell_volume": "d",
+	"first_trade_ms": "q",
+	"last_trade_ms": "q",
+}
+OHLCV_STATS_V1 = RecordSchema(
+	schema_id=5,
+	name="ohlcv_stats_v1",
+	fields={
+		"timestamp_ms": "q",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+		**OHLCV_STATS_FIELDS,
+	},
+	defaults=dict.fromkeys(OHLCV_STATS_FIELDS, 0),
+)
+OHLCV_STATS_V2 = RecordSchema(
+	schema_id=6,
+	name="ohlcv_stats_v2",
+	fields={
+		"timestamp_ms": "q",
+		"window_seconds": "I",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+		**OHLCV_STATS_FIELDS,
+	},
+	defaults=dict.fromkeys(OHLCV_STATS_FIELDS, 0),
+)
+# partial candles with the extra statistics, see OHLCV_PARTIAL_V1
+OHLCV_PARTIAL_STATS_V1 = RecordSchema(
+	schema_id=9,
+	name="ohlcv_partial_stats_v1",
+	fields={
+		"timestamp_ms": "q",
+		"window_seconds": "I",
+		"is_final": "?",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+		**OHLCV_STATS_FIELDS,
+	},
+	defaults=dict.fromkeys(OHLCV_STATS_FIELDS, 0),
+)
+# candles of one timeframe with the technical indicators of trade_to_ohlcv,
+# NaN until an indicator is warmed up
+OHLCV_FEATURES_V1 = RecordSchema(
+	schema_id=7,
+	name="ohlcv_features_v1",
+	fields={
+		"timestamp_ms": "q",
+		"window_seconds": "I",
+		"open": "d",
+		"high": "d",
+		"low": "d",
+		"close": "d",
+		"volume": "d",
+		**dict.fromkeys(
+			(
+				"sma_7",
+				"sma_14",
+				"sma_28",
+				"ema_7",
+				"ema_14",
+				"ema_28",
+				"macd",
+				"macd_signal",
+				"macd_hist",
+				"bb_upper",
+				"bb_middle",
+				"bb_lower",
+				"stoch_k",
+				"stoch_d",
+				"obv",
+				"atr",
+				"cci",
+				"rsi",
+				"adx",
+				"cmf",
+			),
+			"d",
+		),
+	},
+)
+SCHEMAS: dict[int, RecordSchema] = {
+	schema.schema_id: schema
+	for schema in (
+		TRADE_V1,
+		OHLCV_V1,
+		OHLCV_V2,
+		OHLCV_PARTIAL_V1,
+		OHLCV_STATS_V1,
+		OHLCV_STATS_V2,
+		OHLCV_FEATURES_V1,
+		TRADE_V2,
+		OHLCV_PARTIAL_STATS_V1,
+	)
+}
+
+
+def decode_record(data: bytes) -> dict:
+	"""Decodes a binary message of any known schema, or a JSON message."""
+	if data[:1] == b"{":
+		return json_loads(data)
+	if len(data) < 2 or data[0] != MAGIC:
+		raise SerializationError(f"Unknown message format: {data[:8]!r}")
+	schema = SCHEMAS.get(data[1])
+	if schema is None:
+		raise SerializationError(f"Unknown schema id {data[1]}")
+	try:
+		return schema.decode(data)
+	except (struct.error, UnicodeDecodeError) as e:
+		raise SerializationError(f"Malformed {schema.name} message: {e}") from e
+
+
+class BinarySerializer(Serializer):
+	def __init__(self, schema: RecordSchema):
+		self._schema = schema
+
+	def __call__(self, value: Mapping[str, Any], ctx: SerializationContext) -> bytes:
+		try:
+			return self._schema.encode(value)
+		except (KeyError, struct.error, AttributeError) as e:
+			raise SerializationError(f"Can't encode {self._schema.name}: {e}") from e
+
+
+class BinaryDeserializer(Deserializer):
+	"""Decodes binary messages of every known schema as well as JSON messages."""
+
+	def __call__(self, value: bytes, ctx: SerializationContext) -> dict:
+		return decode_record(value)
+
+
+def get_value_serializer(
+	topic_format: TopicFormat, schema: RecordSchema
+) -> Serializer | str:
+	if topic_format == "binary":
+		return BinarySerializer(schema)
+	return "json"
+
+
+def get_object_encoder(
+	topic_format: TopicFormat, schema: RecordSchema
+) -> Callable[[Any], bytes]:
+	"""Returns the encoder of records that serialize themselves to JSON with `to_json()`."""
+	if topic_format == "binary":
+		return schema.encode_object
+	return operator.methodcaller("to_json")
@@ -1,9 +1,15 @@
 __all__ = [
+	"ArchiveTradesConnector",
 	"BybitSpotTradesConnector",
 	"KrakenTradesConnector",
 	"KrakenHistoricalTradesConnector",
+	"ReplayTradesConnector",
+	"TradesRecorder",
 ]
 
+from .archive_trades_connector import ArchiveTradesConnector
 from .bybit_spot_trades_connector import BybitSpotTradesConnector
 from .kraken_historical_trades_connector import KrakenHistoricalTradesConnector
 from .kraken_trades_connector import KrakenTradesConnector
+from .replay_trades_connector import ReplayTradesConnector
+from .trades_recorder import TradesRecorder
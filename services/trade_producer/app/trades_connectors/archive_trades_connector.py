@@ -0,0 +1,331 @@
+import asyncio
+import contextlib
+import functools
+import itertools
+import logging
+import re
+import time
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Literal
+
+from app.abstract import TradesConnector
+from app.config import settings
+from app.schemas.trade_schema import BUY, SELL, UNKNOWN_SIDE, TradeRecord
+
+from .replay_trades_connector import resolve_paths
+
+try:
+	import numpy as np
+	import pyarrow as pa
+	import pyarrow.compute as pc
+	import pyarrow.csv as pacsv
+except ImportError:  # only the archive and parquet sources need pyarrow
+	pa = None
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+ArchiveFormat = Literal["auto", "kraken", "bybit"]
+ARCHIVE_SUFFIXES = (".csv", ".gz", ".zip")
+# Kraken calls bitcoin XBT in its archives, the other sources call it BTC
+KRAKEN_ASSET_NAMES = {"XBT": "BTC", "XDG": "DOGE"}
+# builds a TradeRecord from a tuple in C, without the Python level __new__
+_new_trade_record = functools.partial(tuple.__new__, TradeRecord)
+
+
+class ArchiveTradesConnector(TradesConnector):
+	"""
+	Streams the trades of exchange trade archives from local files.
+
+	Supported are the Kraken time and sales CSV files, `timestamp,price,volume`
+	per pair file or `pair,timestamp,price,volume`, and the Bybit daily trade
+	files with a header row, as plain CSV, gzip or zip archives. Only the Bybit
+	files have the taker side of the trades.
+	The files are parsed in large blocks by the pyarrow CSV reader and filtered
+	with vectorized kernels; plain files are memory-mapped.
+	Files are replayed one after another in name order, so every pair stays
+	ordered when its files are named by date.
+	"""
+
+	_is_active: bool  # is connector produce any trades or not
+
+	@property
+	def is_active(self) -> bool:
+		return self._is_active
+
+	def __init__(
+		self,
+		paths: list[str],
+		archive_format: ArchiveFormat = "auto",
+		block_size: int = 16 * 2**20,
+		batch_size: int = 10_000,
+	):
+		"""
+		:param paths: Files, directories or glob patterns of the archives.
+		:param archive_format: Layout of the CSV files, detected from the first
+			line of every file by default.
+		:param block_size: Bytes of CSV parsed at once.
+		:param batch_size: Maximal number of trades handed to the callback at once.
+		"""
+		if pa is None:
+			raise ImportError("pyarrow is required to import trade archives")
+		self._is_active = False
+		self._paths = resolve_paths(paths, suffixes=ARCHIVE_SUFFIXES)
+		self._archive_format = archive_format
+		self._block_size = block_size
+		self._batch_size = batch_size
+
+	def subscribe_to_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		try:
+			asyncio.run(
+				self.stream_trades(
+					symbols=symbols,
+					callback=callback,
+					historical_start_ms=historical_start_ms,
+					historical_end_ms=historical_end_ms,
+				)
+			)
+		except asyncio.CancelledError:
+			logger.info("Archive import stopped")
+
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		"""
+		Streams the trades of the symbols, all symbols if the list is empty,
+		between historical_start_ms and historical_end_ms.
+		"""
+		self._bind_stream_task()
+		self._is_active = True
+		symbols = [symbol.replace("/", "") for symbol in symbols if symbol]
+		started_at = time.monotonic()
+		imported = 0
+		try:
+			for path in self._paths:
+				for name, open_stream in self._iter_csv_files(path):
+					for trades in self._read_csv(
+						name,
+						open_stream,
+						symbols=symbols,
+						start_ms=historical_start_ms,
+						end_ms=historical_end_ms,
+					):
+						await self._emit(callback, trades)
+						imported += len(trades)
+						# lets the other sources of the event loop run between batches
+						await asyncio.sleep(0)
+		finally:
+			self._is_active = False
+			elapsed_s = time.monotonic() - started_at
+			logger.info(
+				f"Imported {imported} trades from {len(self._paths)} archives in "
+				f"{elapsed_s:.1f}s ({imported / max(elapsed_s, 1e-9):,.0f} trades/s)"
+			)
+
+	@staticmethod
+	def _iter_csv_files(
+		path: Path,
+	) -> Iterator[tuple[str, Callable[[], contextlib.AbstractContextManager]]]:
+		"""Yields the name and a stream opener of every CSV file of the archive."""
+		if path.suffix == ".zip":
+			with zipfile.ZipFile(path) as archive:
+				for member in sorted(archive.namelist()):
+					if member.endswith(".csv"):
+						yield member, lambda member=member: archive.open(member)
+			return
+		if path.suffix == ".gz":
+			yield (
+				path.name,
+				lambda: pa.CompressedInputStream(pa.memory_map(str(path)), "gzip"),
+			)
+			return
+		yield path.name, lambda: pa.memory_map(str(path))
+
+	def _read_csv(
+		self,
+		name: str,
+		open_stream: Callable[[], contextlib.AbstractContextManager],
+		symbols: list[str],
+		start_ms: int | None,
+		end_ms: int | None,
+	) -> Iterator[list[TradeRecord]]:
+		with open_stream() as stream:
+			first_line = _read_first_line(stream)
+		archive_format = self._archive_format
+		if archive_format == "auto":
+			# Bybit files start with a header row, Kraken files with the data
+			archive_format = "bybit" if b"timestamp" in first_line else "kraken"
+
+		if archive_format == "kraken":
+			has_pair = len(first_line.split(b",")) == 4
+			column_names = ["timestamp", "price", "volume"]
+			if has_pair:
+				column_names.insert(0, "pair")
+			read_options = pacsv.ReadOptions(
+				block_size=self._block_size, column_names=column_names
+			)
+			convert_options = pacsv.ConvertOptions(
+				column_types={"timestamp": pa.float64(), "price": pa.float64()}
+			)
+			columns = (
+				"pair" if has_pair else None,
+				"timestamp",
+				"volume",
+				"price",
+				None,
+			)
+			file_symbol = _normalize_kraken_pair(_get_file_stem(name))
+		else:
+			# spot files have "volume", derivatives files have "size" and "symbol"
+			read_options = pacsv.ReadOptions(block_size=self._block_size)
+			convert_options = pacsv.ConvertOptions(
+				column_types={"timestamp": pa.float64(), "price": pa.float64()}
+			)
+			header = first_line.decode().strip().split(",")
+			qty_column = "size" if "size" in header else "volume"
+			columns = (
+				"symbol" if "symbol" in header else None,
+				"timestamp",
+				qty_column,
+				"price",
+				"side" if "side" in header else None,
+			)
+			# e.g. BTCUSDT2024-01-01.csv.gz or BTCUSDT_2024-01-01.csv.gz
+			file_symbol = re.sub(r"_?\d{4}-\d{2}-\d{2}$", "", _get_file_stem(name))
+
+		logger.info(f"Importing {name} as a {archive_format} archive")
+		with open_stream() as stream:
+			reader = pacsv.open_csv(
+				stream, read_options=read_options, convert_options=convert_options
+			)
+			for batch in reader:
+				trades = self._convert_batch(
+					batch, columns, file_symbol, symbols, start_ms, end_ms
+				)
+				if trades is None:
+					# the file is ordered by time, the rest of it is after end_ms
+					return
+				for i in range(0, len(trades), self._batch_size):
+					yield trades[i : i + self._batch_size]
+
+	@staticmethod
+	def _convert_batch(
+		batch: "pa.RecordBatch",
+		columns: tuple[str | None, str, str, str, str | None],
+		file_symbol: str,
+		symbols: list[str],
+		start_ms: int | None,
+		end_ms: int | None,
+	) -> list[TradeRecord] | None:
+		"""
+		Converts a batch of CSV rows to trades, filtered by symbol and time.
+		Returns None once the whole batch is after end_ms.
+		"""
+		symbol_column, timestamp_column, qty_column, price_column, side_column = columns
+		timestamps = batch.column(timestamp_column)
+		if len(timestamps) == 0:
+			return []
+		# seconds with a fraction in the Kraken and Bybit derivatives files,
+		# milliseconds in the Bybit spot files
+		if pc.max(timestamps).as_py() < 1e11:
+			# the microsecond offset keeps e.g. 1704067200.123 from flooring to ...122
+			timestamps = pc.add(pc.multiply(timestamps, 1000), 1e-3)
+		timestamps_ms = pc.cast(pc.floor(timestamps), pa.int64())
+		if end_ms is not None and pc.min(timestamps_ms).as_py() >= end_ms:
+			return None
+
+		if symbol_column is None:
+			symbol_values = pa.repeat(pa.scalar(file_symbol), len(batch))
+		else:
+			symbol_values = batch.column(symbol_column).cast(pa.string())
+			if symbol_column == "pair":
+				# a file holds few pairs, so only the distinct ones are renamed
+				encoded = symbol_values.dictionary_encode()
+				pairs = encoded.dictionary.to_pylist()
+				symbol_values = pa.array(
+					[_normalize_kraken_pair(pair) for pair in pairs], pa.string()
+				).take(encoded.indices)
+
+		mask = None
+		if start_ms is not None:
+			mask = pc.greater_equal(timestamps_ms, start_ms)
+		if end_ms is not None:
+			before_end = pc.less(timestamps_ms, end_ms)
+			mask = before_end if mask is None else pc.and_(mask, before_end)
+		if symbols:
+			is_wanted = pc.is_in(symbol_values, value_set=pa.array(symbols))
+			mask = is_wanted if mask is None else pc.and_(mask, is_wanted)
+
+		qtys = batch.column(qty_column).cast(pa.float64())
+		prices = batch.column(price_column)
+		# the Bybit files have the taker side, "Buy" or "Sell"
+		sides = None
+		if side_column is not None:
+			side_values = batch.column(side_column).cast(pa.string())
+			sides = pc.if_else(
+				pc.equal(side_values, "Buy"),
+				BUY,
+				pc.if_else(pc.equal(side_values, "Sell"), SELL, UNKNOWN_SIDE),
+			)
+		if mask is not None:
+			symbol_values = symbol_values.filter(mask)
+			timestamps_ms = timestamps_ms.filter(mask)
+			qtys = qtys.filter(mask)
+			prices = prices.filter(mask)
+			if sides is not None:
+				sides = sides.filter(mask)
+		# numpy converts columns to Python objects much faster than to_pylist()
+		encoded_symbols = symbol_values.dictionary_encode()
+		symbol_objects = np.array(encoded_symbols.dictionary.to_pylist(), dtype=object)
+		return list(
+			map(
+				_new_trade_record,
+				zip(
+					symbol_objects[encoded_symbols.indices.to_numpy()].tolist(),
+					qtys.to_numpy().tolist(),
+					prices.to_numpy().tolist(),
+					timestamps_ms.to_numpy().tolist(),
+					(
+						itertools.repeat(UNKNOWN_SIDE)
+						if sides is None
+						else sides.to_numpy().tolist()
+					),
+				),
+			)
+		)
+
+	def stop(self):
+		"""Cancels a running import."""
+		self._cancel_stream_task()
+
+
+def _read_first_line(stream: BinaryIO) -> bytes:
+	line = b""
+	while not line.endswith(b"\n"):
+		chunk = stream.read(256)
+		if not chunk:
+			break
+		line += chunk
+	return line.split(b"\n")[0]
+
+
+def _get_file_stem(name: str) -> str:
+	return name.split("/")[-1].split(".")[0]
+
+
+def _normalize_kraken_pair(pair: str) -> str:
+	pair = pair.replace("/", "").upper()
+	for kraken_name, name in KRAKEN_ASSET_NAMES.items():
+		if pair.startswith(kraken_name):
+			return name + pair[len(kraken_name) :]
+	return pair
@@ -1,15 +1,23 @@
 import datetime
+import functools
 import logging
+import threading
+import time
 from typing import Callable, Dict
 
 from pybit.unified_trading import WebSocket
 
 from app.abstract import TradesConnector
 from app.config import settings
-from app.schemas.trade_schema import Trade
+from app.schemas.trade_schema import BUY, SELL, UNKNOWN_SIDE, TradeRecord
+
+from .sharding import ConnectionShard, batched, rebalance, split_into_shards
 
 logger = logging.getLogger(settings.LOGGER_NAME)
 
+# taker side of a trade
+BYBIT_SIDES = {"Buy": BUY, "Sell": SELL}
+
 
 def convert_datetime_to_timestamp_in_ms(dt_str: str) -> int:
 	dt = datetime.datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
@@ -19,15 +27,44 @@ def convert_datetime_to_timestamp_in_ms(dt_str: str) -> int:
 
 
 class BybitSpotTradesConnector(TradesConnector):
-	_is_active: bool  # is connector produce any trades or not
+	"""
+	Streams live spot trades from the Bybit websocket API.
+
+	Large symbol lists are sharded over several connections of at most
+	`symbols_per_connection` symbols, subscribed in batches of the 10 topics
+	Bybit accepts per request. pybit reconnects a connection by itself; a shard
+	that stays disconnected for `shard_down_grace_s` hands its symbols over to
+	the connected shards, or to a new connection when they are full.
+	"""
+
+	SUBSCRIBE_BATCH_SIZE = 10  # topics per subscribe request accepted by Bybit
 
 	@property
 	def is_active(self) -> bool:
-		return self._is_active
+		return self._is_active and any(shard.connected for shard in self._shards)
 
-	def __init__(self):
-		self._ws: WebSocket = None
+	def __init__(
+		self,
+		symbols_per_connection: int = 100,
+		shard_down_grace_s: float = 30.0,
+		health_check_interval_s: float = 5.0,
+		health_log_interval_s: float = 60.0,
+	):
+		"""
+		:param symbols_per_connection: Maximal number of symbols of one connection.
+		:param shard_down_grace_s: How long a shard may stay disconnected before
+			its symbols are moved.
+		:param health_check_interval_s: How often the connections are checked.
+		:param health_log_interval_s: How often the health of the shards is logged.
+		"""
+		self._shards: list[ConnectionShard] = []
 		self._is_active = False
+		self._stopped = threading.Event()
+		self._lock = threading.Lock()
+		self._symbols_per_connection = symbols_per_connection
+		self._shard_down_grace_s = shard_down_grace_s
+		self._health_check_interval_s = health_check_interval_s
+		self._health_log_interval_s = health_log_interval_s
 
 	def subscribe_to_trades(
 		self,
@@ -36,35 +73,136 @@ class BybitSpotTradesConnector(TradesConnector):
 		historical_start_ms: int | None = None,
 		historical_end_ms: int | None = None,
 	) -> None:
-		
 		"""
-		Establishes a connection to the Bybit websocket API
+		Establishes the connections to the Bybit websocket API.
+		Messages are handled on the pybit websocket threads until `stop()` is called,
+		while this thread watches the health of the connections.
 		"""
-		self._ws = WebSocket(
-			testnet=False,
-			channel_type="spot",
-		)
-		# subscribe to trades
-		self._ws.trade_stream(
-			symbol=symbols,
-			callback=self._callback_handler,
-		)
+		self._stopped.clear()
 		self.callback_handler = callback
+		symbols = [symbol for symbol in symbols if symbol]
+		self._shards = []
+		for shard_symbols in split_into_shards(symbols, self._symbols_per_connection):
+			self._open_shard(shard_symbols)
+		logger.info(
+			f"Streaming {len(symbols)} symbols over {len(self._shards)} connections"
+		)
 		self._is_active = True
+		logged_at = time.monotonic()
+		while not self._stopped.wait(self._health_check_interval_s):
+			self._check_health()
+			if time.monotonic() - logged_at >= self._health_log_interval_s:
+				logged_at = time.monotonic()
+				logger.info(
+					"Bybit shards: " + "; ".join(str(shard) for shard in self._shards)
+				)
 		return None
 
-	def _callback_handler(self, msg: Dict) -> list[Dict]:
+	def _open_shard(self, symbols: list[str]) -> ConnectionShard:
+		shard = ConnectionShard(len(self._shards), symbols)
+		shard.connection = WebSocket(
+			testnet=False,
+			channel_type="spot",
+		)
+		try:
+			self._subscribe(shard, symbols)
+		except Exception:
+			shard.connection.exit()
+			raise
+		shard.on_connected()
+		self._shards.append(shard)
+		return shard
+
+	def _subscribe(self, shard: ConnectionShard, symbols: list[str]) -> None:
+		for batch in batched(symbols, self.SUBSCRIBE_BATCH_SIZE):
+			shard.connection.trade_stream(
+				symbol=batch,
+				callback=functools.partial(self._callback_handler, shard),
+			)
+
+	def _check_health(self) -> None:
+		"""Moves the symbols of the shards that stayed disconnected too long."""
+		for shard in list(self._shards):
+			if shard.retired:
+				continue
+			if shard.connection.is_connected():
+				if not shard.connected:
+					shard.on_connected()
+					logger.info(f"Bybit shard {shard.shard_id} reconnected")
+				continue
+			if shard.connected:
+				shard.on_disconnected()
+				logger.warning(f"Bybit shard {shard.shard_id} disconnected")
+			if shard.is_down(self._shard_down_grace_s):
+				self._rebalance(shard)
+
+	def _rebalance(self, failed: ConnectionShard) -> None:
+		with self._lock:
+			moved = rebalance(failed, self._shards, self._symbols_per_connection)
+			if failed.symbols:
+				# the connected shards are full, the rest gets a new connection;
+				# it is opened before the moved symbols are subscribed, so a
+				# failure can still undo the move
+				try:
+					shard = self._open_shard(failed.symbols)
+				except Exception as e:
+					# the symbols go back to the failed shard, the next health
+					# check tries again
+					logger.error(f"Opening a Bybit shard failed: {e} [{type(e)}]")
+					self._undo_rebalance(failed, moved)
+					moved = {}
+				else:
+					logger.warning(
+						f"Moved {len(failed.symbols)} symbols of Bybit shard "
+						f"{failed.shard_id} to the new shard {shard.shard_id}"
+					)
+					failed.symbols = []
+					failed.retired = True
+			for target, symbols in moved.items():
+				logger.warning(
+					f"Moving {len(symbols)} symbols of Bybit shard {failed.shard_id} "
+					f"to shard {target.shard_id}"
+				)
+				self._subscribe(target, symbols)
+		# pybit would go on reconnecting it and stream the moved symbols twice
+		failed.connection.exit()
+
+	@staticmethod
+	def _undo_rebalance(
+		failed: ConnectionShard, moved: dict[ConnectionShard, list[str]]
+	) -> None:
+		"""Puts the symbols moved by `rebalance` back on the failed shard."""
+		symbols = []
+		for target, target_symbols in moved.items():
+			del target.symbols[-len(target_symbols) :]
+			symbols.extend(target_symbols)
+		failed.symbols = symbols + failed.symbols
+		failed.retired = False
+
+	def _callback_handler(self, shard: ConnectionShard, msg: Dict) -> None:
 		logger.debug(msg)
+		shard.on_message()
 
-		trades = []
-		for item in msg.get("data"):
-			logger.debug(item)
-			symbol = item.get("s")
-			trade = Trade(
-				symbol=symbol,
-				price=item.get("p"),
-				qty=item.get("v"),
-				timestamp_ms=item.get("T"),
+		# "T" is already a Unix timestamp in milliseconds, "S" the taker side
+		trades = [
+			TradeRecord(
+				item["s"],
+				float(item["v"]),
+				float(item["p"]),
+				int(item["T"]),
+				BYBIT_SIDES.get(item.get("S"), UNKNOWN_SIDE),
 			)
-			trades.append(trade)
-		self.callback_handler(trades)
\ No newline at end of file
+			for item in msg["data"]
+		]
+		self.callback_handler(trades)
+
+	def stop(self):
+		"""Stops receiving messages."""
+		self._is_active = False
+		for shard in self._shards:
+			if shard.connection is not None and not shard.retired:
+				shard.connection.exit()
+		self._stopped.set()
+
+	def close(self):
+		self.stop()
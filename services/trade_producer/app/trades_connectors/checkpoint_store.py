@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable
+
+from app.config import settings
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+
+class CheckpointStore:
+	"""
+	Durable per-symbol checkpoints of a historical download.
+
+	A checkpoint is the `since_ns` the download of a symbol has to be resumed from.
+	It only moves forward and is persisted to a JSON file with an atomic replace,
+	at most once per `min_write_interval_s` and on `flush()`.
+	"""
+
+	def __init__(self, path: str | Path, min_write_interval_s: float = 1.0):
+		self._path = Path(path)
+		self._min_write_interval_s = min_write_interval_s
+		self._lock = threading.Lock()
+		self._checkpoints: dict[str, int] = {}
+		self._is_dirty = False
+		self._written_at = 0.0
+		if self._path.exists():
+			self._checkpoints = json.loads(self._path.read_text())
+			logger.info(f"Loaded checkpoints from {self._path}: {self._checkpoints}")
+
+	def get(self, symbol: str) -> int | None:
+		with self._lock:
+			return self._checkpoints.get(symbol)
+
+	def commit(self, symbol: str, since_ns: int) -> None:
+		with self._lock:
+			if since_ns <= self._checkpoints.get(symbol, -1):
+				return
+			self._checkpoints[symbol] = since_ns
+			self._is_dirty = True
+			if time.monotonic() - self._written_at >= self._min_write_interval_s:
+				self._write()
+
+	def flush(self) -> None:
+		with self._lock:
+			if self._is_dirty:
+				self._write()
+
+	def tracker(self, symbol: str) -> "PageCheckpointTracker":
+		return PageCheckpointTracker(store=self, symbol=symbol)
+
+	def _write(self) -> None:
+		self._path.parent.mkdir(parents=True, exist_ok=True)
+		tmp_path = self._path.with_suffix(".tmp")
+		tmp_path.write_text(json.dumps(self._checkpoints))
+		os.replace(tmp_path, self._path)
+		self._is_dirty = False
+		self._written_at = time.monotonic()
+
+
+class PageCheckpointTracker:
+	"""
+	Commits the checkpoint of a symbol once all its pages up to it are delivered.
+
+	Pages are acknowledged by the Kafka producer asynchronously; the checkpoint
+	advances only over the contiguous prefix of acknowledged pages, so a page that
+	was never delivered is downloaded again after a restart.
+	"""
+
+	def __init__(self, store: CheckpointStore, symbol: str):
+		self._store = store
+		self._symbol = symbol
+		self._lock = threading.Lock()
+		self._pending: deque[list] = deque()
+
+	def track(self, next_since_ns: int) -> Callable[[], None]:
+		"""Registers a page and returns the callback to call once it is delivered."""
+		page = [next_since_ns, False]
+		with self._lock:
+			self._pending.append(page)
+		return lambda: self._on_delivered(page)
+
+	def _on_delivered(self, page: list) -> None:
+		committed_since_ns = None
+		with self._lock:
+			page[1] = True
+			while self._pending and self._pending[0][1]:
+				committed_since_ns = self._pending.popleft()[0]
+		if committed_since_ns is not None:
+			self._store.commit(self._symbol, committed_since_ns)
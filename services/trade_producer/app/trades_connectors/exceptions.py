@@ -4,3 +4,11 @@ class TooManyRequestsToTradesSourceError(Exception):
 	def __init__(self, message="Too many requests to trades source."):
 		super().__init__(message)
 		self.message = message
+
+
+class TradesSourceUnavailableError(Exception):
+	"""Raised when the trades source keeps failing after all retries."""
+
+	def __init__(self, message="Trades source is unavailable."):
+		super().__init__(message)
+		self.message = message
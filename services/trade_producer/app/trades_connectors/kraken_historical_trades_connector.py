@@ -1,20 +1,38 @@
+import asyncio
 import datetime
 import logging
-import time
-from typing import Callable
+import random
+from typing import AsyncIterator, Callable
 
 import httpx
 
 from app.abstract import TradesConnector
 from app.config import settings
-from app.schemas.trade_schema import Trade
+from app.schemas.trade_schema import BUY, SELL, UNKNOWN_SIDE, TradeRecord
 
+from .checkpoint_store import CheckpointStore
 from .exceptions import (
 	TooManyRequestsToTradesSourceError,
+	TradesSourceUnavailableError,
 )
+from .page_cache import TradesPage, TradesPageCache
+from .rate_limiter import AdaptiveTokenBucket
 
 logger = logging.getLogger(settings.LOGGER_NAME)
 
+RATE_LIMIT_ERRORS = ("EGeneral:Too many requests", "EAPI:Rate limit exceeded")
+RETRY_BASE_DELAY_S = 1.0
+RETRY_MAX_DELAY_S = 60.0
+PAGE_SIZE = 1000  # Kraken returns at most 1000 trades per request
+# Pages a shard downloads ahead of the callback; a shard waiting for the ones
+# before it stops there, so memory stays bounded however long the range.
+SHARD_QUEUE_MAX_PAGES = 10
+# Shard boundaries are aligned to multiples of this grid, so overlapping backfills
+# request the same pages and can be served from the page cache.
+SHARD_GRID_NS = 3600 * 1_000_000_000
+# taker side of a trade
+KRAKEN_REST_SIDES = {"b": BUY, "s": SELL}
+
 
 def convert_datetime_to_timestamp_in_ms(dt_str: str) -> int:
 	dt = datetime.datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
@@ -29,8 +47,29 @@ class KrakenHistoricalTradesConnector(TradesConnector):
 	def is_active(self) -> bool:
 		return self._is_active
 
-	def __init__(self):
+	def __init__(
+		self,
+		shards_per_symbol: int = 4,
+		max_concurrency: int = 4,
+		requests_per_second: float = 1.0,
+		max_requests_per_second: float = 3.0,
+		max_retries: int = 5,
+		max_rate_limited_retries: int = 30,
+		page_cache: TradesPageCache | None = None,
+		checkpoint_store: CheckpointStore | None = None,
+	):
 		self._is_active = False
+		self._shards_per_symbol = max(1, shards_per_symbol)
+		self._max_concurrency = max(1, max_concurrency)
+		self._max_retries = max_retries
+		self._max_rate_limited_retries = max_rate_limited_retries
+		self._page_cache = page_cache
+		self._checkpoint_store = checkpoint_store
+		self._rate_limiter = AdaptiveTokenBucket(
+			rate=requests_per_second,
+			max_rate=max_requests_per_second,
+		)
+		self._semaphore = asyncio.Semaphore(self._max_concurrency)
 
 	def subscribe_to_trades(
 		self,
@@ -47,109 +86,298 @@ class KrakenHistoricalTradesConnector(TradesConnector):
 		        :param start_unix_epoch_ms: The start timestamp in Unix epoch in milliseconds.
 		        :param end_unix_epoch_ms: The end timestamp in Unix epoch in milliseconds.
 		"""
-		self._is_active = True
-		# logger.debug(f"symbols before spliting: {symbols}")
-		# symbols = [f"{symbol.split('USDT')[0]}/USDT" for symbol in symbols]
-		# symbols = [symbol.replace("/", "") for symbol in symbols]
-
-		# logger.debug(f"symbols after spliting: {symbols}")
+		try:
+			asyncio.run(
+				self.stream_trades(
+					symbols=symbols,
+					callback=callback,
+					historical_start_ms=historical_start_ms,
+					historical_end_ms=historical_end_ms,
+				)
+			)
+		except asyncio.CancelledError:
+			logger.info("Historical download stopped")
+		return None
 
-		for symbol in symbols:
-			logger.info(f"Downloading trades for {symbol} from {historical_start_ms} to {historical_end_ms}...")
-			self._push_symbol_trades_to_callback(
-				symbol=symbol,
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		self._bind_stream_task()
+		self._is_active = True
+		try:
+			await self._download(
+				symbols=symbols,
 				callback=callback,
 				start_unix_epoch_ms=historical_start_ms,
 				end_unix_epoch_ms=historical_end_ms,
 			)
-		self._is_active = False
-		return None
+		finally:
+			self._is_active = False
 
-	def _push_symbol_trades_to_callback(
+	async def _download(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		start_unix_epoch_ms: int | None,
+		end_unix_epoch_ms: int | None,
+	) -> None:
+		limits = httpx.Limits(
+			max_connections=self._max_concurrency,
+			max_keepalive_connections=self._max_concurrency,
+		)
+		async with httpx.AsyncClient(limits=limits) as client:
+			await asyncio.gather(
+				*(
+					self._push_symbol_trades_to_callback(
+						symbol=symbol,
+						callback=callback,
+						start_unix_epoch_ms=start_unix_epoch_ms,
+						end_unix_epoch_ms=end_unix_epoch_ms,
+						http_session=client,
+					)
+					for symbol in symbols
+				)
+			)
+		if self._page_cache is not None:
+			logger.info(f"Trades page cache: {self._page_cache.stats()}")
+
+	async def _push_symbol_trades_to_callback(
 		self,
 		symbol: str,
 		callback: Callable,
 		start_unix_epoch_ms: int | None,
 		end_unix_epoch_ms: int | None,
+		http_session: httpx.AsyncClient,
 	) -> None:
 		since_ns = start_unix_epoch_ms * 1_000_000 if start_unix_epoch_ms else 0
+		tracker = None
+		if self._checkpoint_store is not None:
+			tracker = self._checkpoint_store.tracker(symbol)
+			checkpoint_ns = self._checkpoint_store.get(symbol)
+			if checkpoint_ns is not None and checkpoint_ns > since_ns:
+				logger.info(f"Resuming {symbol} from checkpoint {checkpoint_ns}")
+				since_ns = checkpoint_ns
 
 		if end_unix_epoch_ms:
 			end_ns = end_unix_epoch_ms * 1_000_000
 		else:
 			end_ns = int(datetime.datetime.now().timestamp() * 1000) * 1_000_000
 
-		with httpx.Client() as client:
-			while since_ns < end_ns:
-				try:
-					trades = self._get_trades(
-						symbol=symbol,
-						since_ns=since_ns,
-						end_ns=end_ns,
-						http_session=client,
-					)
-				except TooManyRequestsToTradesSourceError as e:
-					logger.warning(e.message)
-					time.sleep(30)
-					continue
-				except Exception as e:
-					logger.error(
-						f"An error occurred while getting trades: {e} [{type(e)}]"
+		logger.info(f"Downloading trades for {symbol} from {since_ns} to {end_ns}...")
+
+		# Shards are downloaded concurrently, but their pages are handed to the
+		# callback strictly shard after shard, so trades stay in timestamp order.
+		shards = self._split_into_shards(since_ns, end_ns)
+		queues = [asyncio.Queue(maxsize=SHARD_QUEUE_MAX_PAGES) for _ in shards]
+		tasks = [
+			asyncio.create_task(
+				self._download_shard(
+					symbol=symbol,
+					since_ns=shard_since_ns,
+					end_ns=shard_end_ns,
+					http_session=http_session,
+					queue=queue,
+				)
+			)
+			for (shard_since_ns, shard_end_ns), queue in zip(shards, queues)
+		]
+		try:
+			for queue, task in zip(queues, tasks):
+				while (trades := await queue.get()) is not None:
+					if tracker is None:
+						await self._emit(callback, trades)
+						continue
+					next_since_ns = trades[-1].timestamp_ms * 1_000_000 + 1
+					await self._emit(
+						callback, trades, on_delivered=tracker.track(next_since_ns)
 					)
-					breakpoint()
-				if trades:
-					# print(trades[-1])
-					callback(trades)
-					since_ns = trades[-1].timestamp_ms * 1_000_000 + 1
-					# logger.debug(
-					# 	f"since_ns: {since_ns}, end_ns: {end_ns}, last trade: {trades[-1].timestamp_ms}"
-					# )
-				else:
-					break
-
-	def _get_trades(
+				# re-raises the shard failure before any later shard is emitted
+				await task
+		finally:
+			for task in tasks:
+				task.cancel()
+
+	def _split_into_shards(self, since_ns: int, end_ns: int) -> list[tuple[int, int]]:
+		if since_ns >= end_ns:
+			return []
+		# the shard length is the grid times a power of two, so boundaries of runs
+		# with different ranges still coincide and share cached pages
+		step_ns = SHARD_GRID_NS
+		while step_ns * self._shards_per_symbol < end_ns - since_ns:
+			step_ns *= 2
+		boundaries = range(since_ns // step_ns * step_ns + step_ns, end_ns, step_ns)
+		starts = [since_ns, *boundaries]
+		ends = [*boundaries, end_ns]
+		return list(zip(starts, ends))
+
+	async def _download_shard(
+		self,
+		symbol: str,
+		since_ns: int,
+		end_ns: int,
+		http_session: httpx.AsyncClient,
+		queue: asyncio.Queue,
+	) -> None:
+		try:
+			async for trades in self.iter_trades(
+				symbol, since_ns, end_ns, http_session
+			):
+				await queue.put(trades)
+		finally:
+			# a cancelled shard has nobody left to read the end of it from a full queue
+			if not asyncio.current_task().cancelling():
+				await queue.put(None)
+
+	async def iter_trades(
+		self,
+		symbol: str,
+		since_ns: int,
+		end_ns: int,
+		http_session: httpx.AsyncClient,
+	) -> AsyncIterator[list[TradeRecord]]:
+		"""Yields the pages of trades of the symbol in [since_ns, end_ns) in order."""
+		while since_ns < end_ns:
+			trades = await self._get_trades_with_retries(
+				symbol=symbol,
+				since_ns=since_ns,
+				end_ns=end_ns,
+				http_session=http_session,
+			)
+			if not trades:
+				break
+			yield trades
+			since_ns = trades[-1].timestamp_ms * 1_000_000 + 1
+
+	async def _get_trades_with_retries(
+		self,
+		symbol: str,
+		since_ns: int,
+		end_ns: int,
+		http_session: httpx.AsyncClient,
+	) -> list[TradeRecord]:
+		attempt = 0
+		# rate limited responses slow the requests down instead of failing them,
+		# up to a cap of their own
+		rate_limited_attempt = 0
+		while True:
+			try:
+				trades = await self._get_trades(
+					symbol=symbol,
+					since_ns=since_ns,
+					end_ns=end_ns,
+					http_session=http_session,
+				)
+			except TooManyRequestsToTradesSourceError as e:
+				rate_limited_attempt += 1
+				if rate_limited_attempt > self._max_rate_limited_retries:
+					raise TradesSourceUnavailableError(
+						f"Failed to get {symbol} trades since {since_ns}, still rate "
+						f"limited after {self._max_rate_limited_retries} retries"
+					) from e
+				self._rate_limiter.on_rate_limited()
+				logger.warning(
+					f"{e.message} Slowing down to "
+					f"{self._rate_limiter.rate:.2f} requests/s, retry "
+					f"{rate_limited_attempt}/{self._max_rate_limited_retries}"
+				)
+				continue
+			except Exception as e:
+				attempt += 1
+				if attempt > self._max_retries:
+					raise TradesSourceUnavailableError(
+						f"Failed to get {symbol} trades since {since_ns} "
+						f"after {self._max_retries} retries: {e}"
+					) from e
+				# full jitter keeps concurrent shards from retrying in lockstep
+				delay = random.uniform(
+					0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2**attempt)
+				)
+				logger.error(
+					f"An error occurred while getting trades: {e} [{type(e)}]. "
+					f"Retry {attempt}/{self._max_retries} in {delay:.1f}s"
+				)
+				await asyncio.sleep(delay)
+				continue
+			return trades
+
+	async def _get_trades(
 		self,
 		symbol: str,
 		since_ns: int,
 		end_ns: int,
-		http_session: httpx.Client,
-	) -> list[Trade]:
+		http_session: httpx.AsyncClient,
+	) -> list[TradeRecord]:
+		page = None
+		# the segment files are read and written off the event loop, which the
+		# other shards keep downloading on
+		if self._page_cache is not None:
+			page = await asyncio.to_thread(self._page_cache.get, symbol, since_ns)
+		if page is None:
+			page = await self._request_trades_page(symbol, since_ns, http_session)
+			# only full pages are final, the tail of the history keeps growing
+			if self._page_cache is not None and len(page) >= PAGE_SIZE:
+				await asyncio.to_thread(self._page_cache.put, symbol, since_ns, page)
+
+		trades = [
+			TradeRecord(symbol, qty, price, int(time_s * 1000), int(side))
+			for price, qty, time_s, side in page
+			if (int(time_s * 1_000_000_000) < end_ns)
+			and (int(time_s * 1_000) * 1_000_000 >= since_ns)
+		]
+		return trades
+
+	async def _request_trades_page(
+		self,
+		symbol: str,
+		since_ns: int,
+		http_session: httpx.AsyncClient,
+	) -> TradesPage:
 		url = f"{self.API_URL}?pair={symbol}&since={since_ns}"
 
-		response = http_session.get(url)
+		async with self._semaphore:
+			await self._rate_limiter.acquire()
+			response = await http_session.get(url)
 		response.raise_for_status()
 		data = response.json()
 
 		# logger.debug(data)
 
-		if ("error" in data) and ("EGeneral:Too many requests" in data["error"]):
+		if ("error" in data) and any(
+			error in data["error"] for error in RATE_LIMIT_ERRORS
+		):
 			raise TooManyRequestsToTradesSourceError(
 				"Too many requests to Kraken API trades source."
 			)
+		self._rate_limiter.on_success()
 		if symbol == "BTCUSDT":
 			# Krakens symbol for BTCUSDT
 			response_symbol = "XBTUSDT"
 		else:
 			response_symbol = symbol
 
-		trades = [
-			Trade(
-				symbol=symbol,
-				price=trade[0],
-				qty=trade[1],
-				timestamp_ms=int(trade[2] * 1000),
+		# a trade is [price, volume, time, "b" or "s" taker side, ...]
+		return [
+			(
+				float(trade[0]),
+				float(trade[1]),
+				float(trade[2]),
+				KRAKEN_REST_SIDES.get(trade[3], UNKNOWN_SIDE),
 			)
 			for trade in data["result"][response_symbol]
-			if (int(trade[2] * 1_000_000_000) < end_ns)
-			and (int(trade[2] * 1_000) * 1_000_000 >= since_ns)
 		]
-		time.sleep(1)
-		return trades
 
-	def stop(self): ...
+	def stop(self):
+		"""Cancels a running download."""
+		self._cancel_stream_task()
 
 	def close(self):
 		self.stop()
+		if self._checkpoint_store is not None:
+			self._checkpoint_store.flush()
 
 
 def test():
@@ -166,11 +394,14 @@ def test():
 	print(f"end_ms: {end_ms}")
 	print(f"end_ns: {end_ns}")
 
-	with httpx.Client() as client:
-		trades = KrakenHistoricalTradesConnector()._get_trades(
-			symbol.replace("/", ""), since_ns, end_ns, client
-		)
-		print(f"trades: {trades}")
+	async def get_trades():
+		async with httpx.AsyncClient() as client:
+			return await KrakenHistoricalTradesConnector()._get_trades(
+				symbol.replace("/", ""), since_ns, end_ns, client
+			)
+
+	trades = asyncio.run(get_trades())
+	print(f"trades: {trades}")
 
 
 if __name__ == "__main__":
@@ -1,79 +1,217 @@
 import asyncio
+import calendar
 import datetime
+import functools
 import json
 import logging
+import random
+import time
 from typing import Callable
 
+import httpx
+import orjson
 import websockets
 from websockets import WebSocketClientProtocol
 
 from app.abstract import TradesConnector
 from app.config import settings
-from app.schemas.trade_schema import Trade
+from app.schemas.trade_schema import BUY, SELL, UNKNOWN_SIDE, TradeRecord
+
+from .exceptions import TradesSourceUnavailableError
+from .kraken_historical_trades_connector import KrakenHistoricalTradesConnector
+from .sharding import ConnectionShard, batched, rebalance, split_into_shards
 
 logger = logging.getLogger(settings.LOGGER_NAME)
 
+# failures of a connection a reconnect repairs: dropped or silent connections,
+# protocol errors and a gap repair giving up; anything else, e.g. an error of the
+# callback, ends the stream
+CONNECTION_ERRORS = (
+	OSError,
+	asyncio.TimeoutError,
+	websockets.WebSocketException,
+	orjson.JSONDecodeError,
+	TradesSourceUnavailableError,
+)
+# taker side of a trade
+KRAKEN_SIDES = {"buy": BUY, "sell": SELL}
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_minute_start_ms(minute_str: str) -> int:
+	return calendar.timegm(time.strptime(minute_str, "%Y-%m-%dT%H:%M")) * 1000
+
 
 def convert_datetime_to_timestamp_in_ms(dt_str: str) -> int:
+	# Kraken sends "2024-01-01T12:34:56.123456Z": the minute is parsed once and
+	# cached, seconds and milliseconds are sliced out of the fixed positions
+	if len(dt_str) >= 20 and dt_str[-1] == "Z" and dt_str[16] == ":":
+		timestamp_ms = _get_minute_start_ms(dt_str[:16]) + int(dt_str[17:19]) * 1000
+		if len(dt_str) > 21 and dt_str[19] == ".":
+			timestamp_ms += int(dt_str[20:-1][:3].ljust(3, "0"))
+		return timestamp_ms
 	dt = datetime.datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
 	return int(dt.timestamp() * 1000)
 
 
 class KrakenTradesConnector(TradesConnector):
+	"""
+	Streams live trades from the Kraken websocket API.
+
+	Large symbol lists are sharded over several connections of at most
+	`symbols_per_connection` symbols, each subscribed in batches and reconnected
+	on its own. A shard that keeps failing hands its symbols over to the
+	connected shards with room left.
+	"""
+
 	URL = "wss://ws.kraken.com/v2"
-	_is_active: bool  # is connector produce any trades or not
 
 	@property
 	def is_active(self) -> bool:
-		return self._is_active
+		return any(shard.connected for shard in self._shards)
 
-	def __init__(self):
-		self._ws: WebSocketClientProtocol | None = None
-		self._is_active = False
+	def __init__(
+		self,
+		reconnect_base_delay_s: float = 1.0,
+		reconnect_max_delay_s: float = 60.0,
+		heartbeat_timeout_s: float = 10.0,
+		rest_connector: KrakenHistoricalTradesConnector | None = None,
+		symbols_per_connection: int = 100,
+		subscribe_batch_size: int = 50,
+		max_shard_failures: int = 3,
+		health_log_interval_s: float = 60.0,
+	):
+		"""
+		:param reconnect_base_delay_s: Delay before the first reconnect attempt,
+			doubled on every failed attempt.
+		:param reconnect_max_delay_s: Upper bound of the reconnect delay.
+		:param heartbeat_timeout_s: The connection is considered dead when no
+			message, heartbeats included, arrives for that long.
+		:param rest_connector: Fetches the trades missed while disconnected,
+			`None` disables the gap repair.
+		:param symbols_per_connection: Maximal number of symbols of one connection.
+		:param subscribe_batch_size: Maximal number of symbols of one subscribe message.
+		:param max_shard_failures: Failed connection attempts in a row after which
+			the symbols of a shard are moved to the other shards.
+		:param health_log_interval_s: How often the health of the shards is logged.
+		"""
+		self._shards: list[ConnectionShard] = []
 		self._running = False  # Flag to control the message receiving loop
+		self._reconnect_base_delay_s = reconnect_base_delay_s
+		self._reconnect_max_delay_s = reconnect_max_delay_s
+		self._heartbeat_timeout_s = heartbeat_timeout_s
+		self._rest_connector = rest_connector
+		# timestamp of the last trade handed to the callback, per symbol, and the
+		# number of trades handed over with that timestamp
+		self._last_trade_ms: dict[str, int] = {}
+		self._trades_at_last_ms: dict[str, int] = {}
+		# live trades up to this timestamp were already emitted by the gap repair
+		self._repaired_until_ms: dict[str, int] = {}
+		self._symbols_per_connection = symbols_per_connection
+		self._subscribe_batch_size = subscribe_batch_size
+		self._max_shard_failures = max_shard_failures
+		self._health_log_interval_s = health_log_interval_s
+		# live trades of symbols moved between shards, held until their gap is repaired
+		self._held_trades: dict[str, list[TradeRecord]] = {}
 
-	async def connect(self) -> None:
-		self._ws = await websockets.connect(self.URL)
+	async def connect(self) -> WebSocketClientProtocol:
+		return await websockets.connect(self.URL)
 
-	async def _receive_messages(self, callback: Callable):
-		"""Handles receiving messages from the WebSocket."""
-		try:
-			while self._running:
-				response = await self._ws.recv()
-				msg_json = json.loads(response)
+	async def _subscribe(self, ws: WebSocketClientProtocol, symbols: list[str]) -> None:
+		msg = {
+			"method": "subscribe",
+			"params": {
+				"channel": "trade",
+				"symbol": symbols,
+				"snapshot": False,
+			},
+		}
+		await ws.send(json.dumps(msg))
+
+	async def _receive_messages(self, shard: ConnectionShard, callback: Callable):
+		"""
+		Handles receiving messages from the WebSocket of the shard.
+		Raises when the connection is lost or no heartbeat arrives in time.
+		"""
+		while self._running:
+			response = await asyncio.wait_for(
+				shard.connection.recv(), timeout=self._heartbeat_timeout_s
+			)
+			if not shard.connected:
+				# the connection counts as healthy once the exchange talks to us
+				shard.on_connected()
+			shard.on_message()
+			msg_json = orjson.loads(response)
+
+			if msg_json.get("channel") in ["status", "heartbeat"]:
+				continue
 
-				if msg_json.get("channel") in ["status", "heartbeat"]:
-					continue
+			if msg_json.get("method") == "subscribe" and msg_json.get("success"):
+				logger.debug(f"Subscribed to {msg_json.get('result').get('symbol')}")
+				continue
 
-				if msg_json.get("method") == "subscribe" and msg_json.get("success"):
-					logger.info(f"Subscribed to {msg_json.get('result').get('symbol')}")
-					continue
+			if msg_json.get("channel") != "trade" or "data" not in msg_json:
+				logger.warning(f"Unexpected message: {response}")
+				continue
 
-				logger.debug(f"Received message: {response}")
+			logger.debug(f"Received message: {response}")
 
+			trades = self._extract_trades_from_websocket_message(msg_json)
+			if self._held_trades:
+				trades = self._hold_trades(trades)
+			if self._repaired_until_ms:
+				trades = self._drop_repaired_trades(trades)
+			if trades:
+				self._remember_last_trades(trades)
 				# Call the callback function with the received message
 				if callback:
-					trades = self._extract_trades_from_websocket_message(msg_json)
-					print(f"trades: {trades}")
-					callback(trades)
-
-		except Exception as e:
-			logger.error(f"An error occurred while receiving messages: {e}")
-
-	def _extract_trades_from_websocket_message(self, msg_json: dict) -> list[Trade]:
-		trades = []
-
-		logger.debug(msg_json)
-		for item in msg_json.get("data"):
-			trade = Trade(
-				# symbol=item.get("symbol").replace("/", ""),
-				symbol=item.get("symbol"),
-				price=item.get("price"),
-				qty=item.get("qty"),
-				timestamp_ms=convert_datetime_to_timestamp_in_ms(item.get("timestamp")),
+					await self._emit(callback, trades)
+
+	def _remember_last_trades(self, trades: list[TradeRecord]) -> None:
+		for trade in trades:
+			if self._last_trade_ms.get(trade.symbol) == trade.timestamp_ms:
+				self._trades_at_last_ms[trade.symbol] += 1
+			else:
+				self._last_trade_ms[trade.symbol] = trade.timestamp_ms
+				self._trades_at_last_ms[trade.symbol] = 1
+
+	def _drop_repaired_trades(self, trades: list[TradeRecord]) -> list[TradeRecord]:
+		"""Drops the live trades that overlap with the trades of the gap repair."""
+		live_trades = []
+		for trade in trades:
+			repaired_until_ms = self._repaired_until_ms.get(trade.symbol)
+			if repaired_until_ms is None:
+				live_trades.append(trade)
+			elif trade.timestamp_ms > repaired_until_ms:
+				del self._repaired_until_ms[trade.symbol]
+				live_trades.append(trade)
+		return live_trades
+
+	def _hold_trades(self, trades: list[TradeRecord]) -> list[TradeRecord]:
+		"""Holds back the trades of the symbols whose gap is being repaired."""
+		live_trades = []
+		for trade in trades:
+			held_trades = self._held_trades.get(trade.symbol)
+			if held_trades is None:
+				live_trades.append(trade)
+			else:
+				held_trades.append(trade)
+		return live_trades
+
+	def _extract_trades_from_websocket_message(
+		self, msg_json: dict
+	) -> list[TradeRecord]:
+		return [
+			TradeRecord(
+				# symbol=item["symbol"].replace("/", ""),
+				item["symbol"],
+				float(item["qty"]),
+				float(item["price"]),
+				convert_datetime_to_timestamp_in_ms(item["timestamp"]),
+				KRAKEN_SIDES.get(item.get("side"), UNKNOWN_SIDE),
 			)
-			trades.append(trade)
-		return trades
+			for item in msg_json["data"]
+		]
 
 	def subscribe_to_trades(
 		self,
@@ -85,39 +223,251 @@ class KrakenTradesConnector(TradesConnector):
 		"""
 		Subscribes to trades for the specified symbols and calls the callback with received messages.
 		"""
+		try:
+			asyncio.run(self.stream_trades(symbols=symbols, callback=callback))
+		except asyncio.CancelledError:
+			logger.info("Trades subscription stopped")
+
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		"""
+		Streams live trades until stopped.
+		A lost connection is re-established with exponential backoff, and the
+		trades missed meanwhile are fetched from the REST API and emitted first.
+		"""
+		self._bind_stream_task()
 		symbols = [f"{symbol.split('USDT')[0]}/USDT" for symbol in symbols]
+		self._shards = [
+			ConnectionShard(shard_id, shard_symbols)
+			for shard_id, shard_symbols in enumerate(
+				split_into_shards(symbols, self._symbols_per_connection)
+			)
+		]
+		logger.info(
+			f"Streaming {len(symbols)} symbols over {len(self._shards)} connections"
+		)
 
-		async def run():
-			await self.connect()
-			msg = {
-				"method": "subscribe",
-				"params": {
-					"channel": "trade",
-					"symbol": symbols,
-					"snapshot": False,
-				},
-			}
-			await self._ws.send(json.dumps(msg))
-
-			# Set the running flag and start receiving messages
-			self._running = True
-			self._is_active = True
-			await self._receive_messages(callback)
-
-		asyncio.run(run())
+		# Set the running flag and start receiving messages
+		self._running = True
+		tasks = [
+			asyncio.create_task(self._stream_shard(shard, callback))
+			for shard in self._shards
+		]
+		tasks.append(asyncio.create_task(self._log_health()))
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+	async def _stream_shard(self, shard: ConnectionShard, callback: Callable) -> None:
+		"""Streams the trades of one connection, reconnecting until stopped."""
+		while self._running and not shard.retired:
+			try:
+				shard.connection = await self.connect()
+				for symbols in batched(shard.symbols, self._subscribe_batch_size):
+					await self._subscribe(shard.connection, symbols)
+				await self._receive_and_repair_gaps(shard, callback)
+			except CONNECTION_ERRORS as e:
+				logger.error(
+					f"Kraken websocket of shard {shard.shard_id} failed: {e} [{type(e)}]"
+				)
+			finally:
+				await self._close(shard.connection)
+				shard.connection = None
+				shard.on_disconnected()
+			if not self._running:
+				break
+			if shard.failures >= self._max_shard_failures:
+				await self._rebalance(shard, callback)
+				if shard.retired:
+					logger.warning(f"Retired Kraken shard {shard.shard_id}")
+					return
+			# full jitter keeps many producers from reconnecting in lockstep
+			delay = random.uniform(
+				0,
+				min(
+					self._reconnect_max_delay_s,
+					self._reconnect_base_delay_s * 2**shard.failures,
+				),
+			)
+			logger.info(
+				f"Reconnecting shard {shard.shard_id} to Kraken websocket in {delay:.1f}s"
+			)
+			await asyncio.sleep(delay)
+
+	async def _rebalance(self, failed: ConnectionShard, callback: Callable) -> None:
+		"""
+		Moves the symbols of a failing shard to the connected shards.
+		The live trades of a moved symbol are held back until the trades missed
+		since its last trade are repaired, so they stay in order.
+		"""
+		for target, symbols in rebalance(
+			failed, self._shards, self._symbols_per_connection
+		).items():
+			logger.warning(
+				f"Moving {len(symbols)} symbols of Kraken shard {failed.shard_id} "
+				f"to shard {target.shard_id}"
+			)
+			if self._rest_connector is not None:
+				for symbol in symbols:
+					self._held_trades[symbol] = []
+			try:
+				for batch in batched(symbols, self._subscribe_batch_size):
+					await self._subscribe(target.connection, batch)
+			except CONNECTION_ERRORS as e:
+				# the target subscribes to all its symbols again when it reconnects
+				logger.error(
+					f"Subscribing shard {target.shard_id} failed: {e} [{type(e)}]"
+				)
+			try:
+				await self._repair_gaps(callback, symbols)
+			finally:
+				await self._release_held_trades(symbols, callback)
+
+	async def _release_held_trades(
+		self, symbols: list[str], callback: Callable
+	) -> None:
+		for symbol in symbols:
+			# a symbol stays held until nothing is left, live trades arriving while
+			# the held ones are emitted must not overtake them
+			while trades := self._held_trades.get(symbol):
+				self._held_trades[symbol] = []
+				if self._repaired_until_ms:
+					trades = self._drop_repaired_trades(trades)
+				if trades:
+					self._remember_last_trades(trades)
+					if callback:
+						await self._emit(callback, trades)
+			self._held_trades.pop(symbol, None)
+
+	async def _log_health(self) -> None:
+		while self._running:
+			await asyncio.sleep(self._health_log_interval_s)
+			logger.info(
+				"Kraken shards: " + "; ".join(str(shard) for shard in self._shards)
+			)
+
+	async def _receive_and_repair_gaps(
+		self, shard: ConnectionShard, callback: Callable
+	) -> None:
+		"""
+		Receives the messages of the shard while the gaps of its symbols are
+		repaired, so a long repair neither starves the websocket nor its keepalive
+		pings. The live trades of the symbols being repaired are held back and
+		emitted after their repaired trades.
+		"""
+		symbols = [
+			symbol
+			for symbol in shard.symbols
+			if symbol in self._last_trade_ms and symbol not in self._held_trades
+		]
+		if self._rest_connector is None or not symbols:
+			await self._receive_messages(shard, callback)
+			return
+		for symbol in symbols:
+			self._held_trades[symbol] = []
+		receiving = asyncio.create_task(self._receive_messages(shard, callback))
+		repairing = asyncio.create_task(self._repair_held_gaps(callback, symbols))
+		try:
+			done, _ = await asyncio.wait(
+				{receiving, repairing}, return_when=asyncio.FIRST_EXCEPTION
+			)
+			if repairing in done:
+				repairing.result()
+			await receiving
+		finally:
+			for task in (receiving, repairing):
+				task.cancel()
+			await asyncio.gather(receiving, repairing, return_exceptions=True)
+
+	async def _repair_held_gaps(self, callback: Callable, symbols: list[str]) -> None:
+		try:
+			await self._repair_gaps(callback, symbols)
+		except BaseException:
+			# the next repair fetches the held trades again from the last trade
+			for symbol in symbols:
+				self._held_trades.pop(symbol, None)
+			raise
+		await self._release_held_trades(symbols, callback)
+
+	async def _repair_gaps(self, callback: Callable, symbols: list[str]) -> None:
+		"""
+		Emits the trades since the last received trade of every symbol.
+		The symbols are repaired concurrently, their requests share the rate limit
+		of the REST connector, and only the live trades after the repaired ones
+		are emitted.
+		"""
+		symbols = [symbol for symbol in symbols if symbol in self._last_trade_ms]
+		if self._rest_connector is None or not symbols:
+			return
+		end_ns = time.time_ns()
+		async with httpx.AsyncClient() as client:
+			repairs = [
+				asyncio.create_task(self._repair_gap(callback, symbol, end_ns, client))
+				for symbol in symbols
+			]
+			try:
+				await asyncio.gather(*repairs)
+			finally:
+				for repair in repairs:
+					repair.cancel()
+				await asyncio.gather(*repairs, return_exceptions=True)
+
+	async def _repair_gap(
+		self,
+		callback: Callable,
+		symbol: str,
+		end_ns: int,
+		client: httpx.AsyncClient,
+	) -> None:
+		"""
+		Emits the trades of the symbol since its last received trade.
+		The millisecond of the last trade is fetched again, as more trades may share
+		it; the ones already emitted are skipped.
+		"""
+		last_trade_ms = self._last_trade_ms[symbol]
+		emitted = self._trades_at_last_ms[symbol]
+		repaired = 0
+		async for trades in self._rest_connector.iter_trades(
+			symbol=symbol.replace("/", ""),
+			since_ns=last_trade_ms * 1_000_000,
+			end_ns=end_ns,
+			http_session=client,
+		):
+			skipped = 0
+			while (
+				skipped < min(emitted, len(trades))
+				and trades[skipped].timestamp_ms == last_trade_ms
+			):
+				skipped += 1
+			emitted = 0 if skipped < len(trades) else emitted - skipped
+			trades = [trade._replace(symbol=symbol) for trade in trades[skipped:]]
+			if not trades:
+				continue
+			repaired += len(trades)
+			self._remember_last_trades(trades)
+			self._repaired_until_ms[symbol] = trades[-1].timestamp_ms
+			if callback:
+				await self._emit(callback, trades)
+		logger.info(f"Repaired the gap of {symbol} with {repaired} trades")
 
 	def stop(self):
 		"""Stops receiving messages."""
 		self._running = False
-		self._is_active = False
-		if self._ws:
-			asyncio.run(self._close())
+		self._cancel_stream_task()
 
 	def close(self):
 		self.stop()
 
-	async def _close(self):
+	async def _close(self, ws: WebSocketClientProtocol | None):
 		"""Closes the websocket connection."""
-		if self._ws:
-			await self._ws.close()
+		if ws:
+			await ws.close()
 			logger.info("WebSocket connection closed.")
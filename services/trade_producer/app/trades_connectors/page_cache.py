@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+from app.config import settings
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+# A page is a list of (price, qty, time_s, side) rows as the trades source returned
+# them, with the taker side as in `TradeRecord`
+TradesPage = list[tuple[float, float, float, int]]
+
+# segments of TPG1, without the sides, are unreadable and fetched again
+SEGMENT_MAGIC = b"TPG2"
+SEGMENT_HEADER = struct.Struct("<4sI")  # magic, number of rows
+SEGMENT_SUFFIX = ".seg"
+
+
+class TradesPageCache:
+	"""
+	Persistent on-disk cache of trades source pages keyed by `(pair, since_ns)`.
+
+	Every page is stored in its own content-addressed segment file: the rows are
+	split into price, qty and time columns of float64 and a side column of int8
+	that are zlib-compressed together. The total size of the segments is capped and the least recently
+	used segments are evicted first; the file mtime keeps the recency across runs.
+	"""
+
+	def __init__(self, cache_dir: str | Path, max_bytes: int):
+		self._dir = Path(cache_dir)
+		self._dir.mkdir(parents=True, exist_ok=True)
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self._segments: OrderedDict[Path, int] = OrderedDict()
+		self._size_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._load_index()
+
+	def _load_index(self) -> None:
+		segments = []
+		for path in self._dir.glob(f"*/*{SEGMENT_SUFFIX}"):
+			stat = path.stat()
+			segments.append((stat.st_mtime, path, stat.st_size))
+		for _, path, size in sorted(segments):
+			self._segments[path] = size
+			self._size_bytes += size
+		logger.info(
+			f"Trades page cache {self._dir}: {len(self._segments)} segments, "
+			f"{self._size_bytes / 2**20:.1f} MiB"
+		)
+
+	def _segment_path(self, pair: str, since_ns: int) -> Path:
+		digest = hashlib.sha256(f"{pair}:{since_ns}".encode()).hexdigest()
+		return self._dir / digest[:2] / f"{digest}{SEGMENT_SUFFIX}"
+
+	def get(self, pair: str, since_ns: int) -> TradesPage | None:
+		path = self._segment_path(pair, since_ns)
+		with self._lock:
+			if path not in self._segments:
+				self.misses += 1
+				return None
+			self._segments.move_to_end(path)
+		try:
+			page = _decode_segment(path.read_bytes())
+			os.utime(path)
+		except (OSError, ValueError, zlib.error) as e:
+			logger.warning(f"Dropping unreadable cache segment {path}: {e}")
+			self._discard(path)
+			with self._lock:
+				self.misses += 1
+			return None
+		with self._lock:
+			self.hits += 1
+		return page
+
+	def put(self, pair: str, since_ns: int, page: TradesPage) -> None:
+		path = self._segment_path(pair, since_ns)
+		data = _encode_segment(page)
+		path.parent.mkdir(exist_ok=True)
+		tmp_path = path.with_suffix(".tmp")
+		tmp_path.write_bytes(data)
+		os.replace(tmp_path, path)
+		with self._lock:
+			self._size_bytes += len(data) - self._segments.pop(path, 0)
+			self._segments[path] = len(data)
+			while self._size_bytes > self._max_bytes and len(self._segments) > 1:
+				evicted_path, evicted_size = self._segments.popitem(last=False)
+				self._size_bytes -= evicted_size
+				self.evictions += 1
+				evicted_path.unlink(missing_ok=True)
+
+	def _discard(self, path: Path) -> None:
+		with self._lock:
+			self._size_bytes -= self._segments.pop(path, 0)
+		path.unlink(missing_ok=True)
+
+	def stats(self) -> str:
+		requests = self.hits + self.misses
+		hit_ratio = self.hits / requests if requests else 0.0
+		return (
+			f"hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.1%} "
+			f"evictions={self.evictions} segments={len(self._segments)} "
+			f"size={self._size_bytes / 2**20:.1f}MiB"
+		)
+
+
+def _encode_segment(page: TradesPage) -> bytes:
+	prices, qtys, times, sides = zip(*page)
+	body = b"".join(array("d", column).tobytes() for column in (prices, qtys, times))
+	body += array("b", sides).tobytes()
+	return SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(page)) + zlib.compress(body)
+
+
+def _decode_segment(data: bytes) -> TradesPage:
+	magic, rows = SEGMENT_HEADER.unpack_from(data)
+	if magic != SEGMENT_MAGIC:
+		raise ValueError(f"unknown segment magic {magic!r}")
+	body = zlib.decompress(data[SEGMENT_HEADER.size :])
+	if len(body) != 25 * rows:
+		raise ValueError(f"expected {25 * rows} bytes, got {len(body)}")
+	columns = array("d")
+	columns.frombytes(body[: 24 * rows])
+	sides = array("b")
+	sides.frombytes(body[24 * rows :])
+	return list(
+		zip(columns[:rows], columns[rows : 2 * rows], columns[2 * rows :], sides)
+	)
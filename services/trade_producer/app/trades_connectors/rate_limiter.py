@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+
+class AdaptiveTokenBucket:
+	"""
+	Token bucket rate limiter whose refill rate adapts to the trades source feedback.
+
+	The rate grows additively after every successful request and is cut
+	multiplicatively when the source reports that we are sending too many requests.
+	"""
+
+	def __init__(
+		self,
+		rate: float,
+		max_rate: float,
+		min_rate: float = 0.1,
+		burst: float = 1.0,
+		increase_step: float = 0.05,
+		decrease_factor: float = 0.5,
+	):
+		self._rate = rate
+		self._max_rate = max(max_rate, rate)
+		self._min_rate = min(min_rate, rate)
+		self._burst = burst
+		self._increase_step = increase_step
+		self._decrease_factor = decrease_factor
+		self._tokens = burst
+		self._updated_at = time.monotonic()
+		self._lock = asyncio.Lock()
+
+	@property
+	def rate(self) -> float:
+		return self._rate
+
+	def _refill(self) -> None:
+		now = time.monotonic()
+		self._tokens = min(
+			self._burst, self._tokens + (now - self._updated_at) * self._rate
+		)
+		self._updated_at = now
+
+	async def acquire(self) -> None:
+		"""Waits until a request may be sent."""
+		async with self._lock:
+			while True:
+				self._refill()
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return
+				await asyncio.sleep((1 - self._tokens) / self._rate)
+
+	def on_success(self) -> None:
+		self._rate = min(self._max_rate, self._rate + self._increase_step)
+
+	def on_rate_limited(self) -> None:
+		self._refill()
+		self._rate = max(self._min_rate, self._rate * self._decrease_factor)
+		self._tokens = 0
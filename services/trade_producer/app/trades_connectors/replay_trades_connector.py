@@ -0,0 +1,210 @@
+import asyncio
+import glob
+import heapq
+import itertools
+import logging
+import operator
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+import orjson
+
+from app.abstract import TradesConnector
+from app.config import settings
+from app.schemas.trade_schema import UNKNOWN_SIDE, TradeRecord
+
+try:
+	import pyarrow.parquet as pq
+except ImportError:  # parquet files are optional, JSON lines need no extra package
+	pq = None
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+
+def resolve_paths(paths: list[str], suffixes: tuple[str, ...]) -> list[Path]:
+	"""Expands directories and glob patterns to the files with the suffixes."""
+	resolved = []
+	for path in paths:
+		if not path:
+			continue
+		if Path(path).is_dir():
+			resolved.extend(
+				sorted(file for file in Path(path).iterdir() if file.suffix in suffixes)
+			)
+			continue
+		matches = sorted(glob.glob(path))
+		if not matches:
+			raise FileNotFoundError(f"No trades files at {path}")
+		resolved.extend(Path(match) for match in matches)
+	return resolved
+
+
+class ReplayTradesConnector(TradesConnector):
+	"""
+	Replays trades from local files without any network.
+
+	Supported files are JSON lines with one trade per line, as written by
+	`TradesRecorder`, and Parquet files with `symbol`, `qty`, `price` and
+	`timestamp_ms` columns (requires `pyarrow`), and optionally the `side` of the
+	trades. Every file must be ordered by timestamp; the files are merged, so any
+	number of symbols are replayed at once.
+	"""
+
+	_is_active: bool  # is connector produce any trades or not
+
+	@property
+	def is_active(self) -> bool:
+		return self._is_active
+
+	def __init__(
+		self,
+		paths: list[str],
+		speed: float = 0.0,
+		batch_size: int = 1000,
+	):
+		"""
+		:param paths: Files, directories or glob patterns of the recorded trades.
+		:param speed: 1 replays with the original timing between trades, N replays
+			N times faster, 0 replays as fast as possible.
+		:param batch_size: Maximal number of trades handed to the callback at once.
+		"""
+		self._is_active = False
+		self._paths = resolve_paths(paths, suffixes=(".jsonl", ".parquet"))
+		self._speed = speed
+		self._batch_size = batch_size
+
+	def subscribe_to_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		try:
+			asyncio.run(
+				self.stream_trades(
+					symbols=symbols,
+					callback=callback,
+					historical_start_ms=historical_start_ms,
+					historical_end_ms=historical_end_ms,
+				)
+			)
+		except asyncio.CancelledError:
+			logger.info("Replay stopped")
+
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		"""
+		Replays the trades of the symbols, all symbols if the list is empty,
+		between historical_start_ms and historical_end_ms.
+		"""
+		self._bind_stream_task()
+		self._is_active = True
+		trades = heapq.merge(
+			*(self._read_file(path) for path in self._paths),
+			key=operator.attrgetter("timestamp_ms"),
+		)
+		symbols = {symbol for symbol in symbols if symbol}
+		if symbols:
+			trades = (trade for trade in trades if trade.symbol in symbols)
+		if historical_start_ms is not None:
+			trades = (t for t in trades if t.timestamp_ms >= historical_start_ms)
+		if historical_end_ms is not None:
+			# the merged trades are ordered, so the replay ends at the first later one
+			trades = itertools.takewhile(
+				lambda t: t.timestamp_ms < historical_end_ms, trades
+			)
+		logger.info(
+			f"Replaying {len(self._paths)} files at speed {self._speed or 'max'}"
+		)
+		try:
+			await self._replay(trades, callback)
+		finally:
+			self._is_active = False
+
+	async def _replay(self, trades: Iterator[TradeRecord], callback: Callable) -> None:
+		started_at = time.monotonic()
+		first_trade_ms = None
+		replayed = 0
+		batch = []
+		for trade in trades:
+			if self._speed > 0:
+				if first_trade_ms is None:
+					first_trade_ms = trade.timestamp_ms
+					started_at = time.monotonic()
+				due_s = (trade.timestamp_ms - first_trade_ms) / 1000 / self._speed
+				delay_s = due_s - (time.monotonic() - started_at)
+				if delay_s > 0:
+					if batch:
+						await self._emit(callback, batch)
+						replayed += len(batch)
+						batch = []
+					await asyncio.sleep(delay_s)
+			batch.append(trade)
+			if len(batch) >= self._batch_size:
+				await self._emit(callback, batch)
+				replayed += len(batch)
+				batch = []
+				# lets the other sources of the event loop run between batches
+				await asyncio.sleep(0)
+		if batch:
+			await self._emit(callback, batch)
+			replayed += len(batch)
+		elapsed_s = time.monotonic() - started_at
+		logger.info(
+			f"Replayed {replayed} trades in {elapsed_s:.1f}s "
+			f"({replayed / max(elapsed_s, 1e-9):,.0f} trades/s)"
+		)
+
+	def _read_file(self, path: Path) -> Iterator[TradeRecord]:
+		if path.suffix == ".parquet":
+			return self._read_parquet(path)
+		return self._read_json_lines(path)
+
+	@staticmethod
+	def _read_json_lines(path: Path) -> Iterator[TradeRecord]:
+		with open(path, "rb") as file:
+			for line in file:
+				if not line.strip():
+					continue
+				trade = orjson.loads(line)
+				yield TradeRecord(
+					trade["symbol"],
+					float(trade["qty"]),
+					float(trade["price"]),
+					int(trade["timestamp_ms"]),
+					int(trade.get("side", UNKNOWN_SIDE)),
+				)
+
+	@staticmethod
+	def _read_parquet(path: Path) -> Iterator[TradeRecord]:
+		if pq is None:
+			raise ImportError(f"pyarrow is required to replay {path}")
+		file = pq.ParquetFile(path)
+		columns = ["symbol", "qty", "price", "timestamp_ms"]
+		has_sides = "side" in file.schema_arrow.names
+		if has_sides:
+			columns.append("side")
+		for batch in file.iter_batches(columns=columns):
+			yield from map(
+				TradeRecord,
+				batch.column("symbol").to_pylist(),
+				batch.column("qty").to_pylist(),
+				batch.column("price").to_pylist(),
+				batch.column("timestamp_ms").to_pylist(),
+				(
+					batch.column("side").to_pylist()
+					if has_sides
+					else itertools.repeat(UNKNOWN_SIDE)
+				),
+			)
+
+	def stop(self):
+		"""Cancels a running replay."""
+		self._cancel_stream_task()
@@ -0,0 +1,105 @@
+import math
+import time
+from typing import Iterator, Sequence
+
+
+def batched(items: Sequence, size: int) -> Iterator[list]:
+	"""Splits the items into lists of at most `size` items."""
+	for i in range(0, len(items), size):
+		yield list(items[i : i + size])
+
+
+def split_into_shards(symbols: list[str], symbols_per_shard: int) -> list[list[str]]:
+	"""
+	Spreads the symbols over as few shards as the limit allows.
+	Symbols are dealt round-robin, so the busy symbols at the top of a list
+	do not all end up on the first connection.
+	"""
+	num_shards = max(1, math.ceil(len(symbols) / symbols_per_shard))
+	return [symbols[i::num_shards] for i in range(num_shards) if symbols[i::num_shards]]
+
+
+class ConnectionShard:
+	"""Symbols of one websocket connection and the health of that connection."""
+
+	def __init__(self, shard_id: int, symbols: list[str]):
+		self.shard_id = shard_id
+		self.symbols = list(symbols)
+		self.connection = None
+		self.connected = False
+		self.disconnected_at: float | None = time.monotonic()
+		self.last_message_at: float | None = None
+		self.messages = 0
+		self.disconnects = 0
+		# failed connection attempts since the last successful one
+		self.failures = 0
+		# the symbols were moved to other shards, the shard is no longer used
+		self.retired = False
+
+	def on_connected(self) -> None:
+		self.connected = True
+		self.disconnected_at = None
+		self.failures = 0
+
+	def on_message(self) -> None:
+		self.messages += 1
+		self.last_message_at = time.monotonic()
+
+	def on_disconnected(self) -> None:
+		if self.connected:
+			self.disconnects += 1
+			self.disconnected_at = time.monotonic()
+		self.connected = False
+		self.failures += 1
+
+	def is_down(self, grace_s: float) -> bool:
+		"""True when the shard has been disconnected for longer than `grace_s`."""
+		return (
+			not self.connected
+			and self.disconnected_at is not None
+			and time.monotonic() - self.disconnected_at > grace_s
+		)
+
+	def __str__(self) -> str:
+		silent_s = (
+			f"{time.monotonic() - self.last_message_at:.0f}s"
+			if self.last_message_at is not None
+			else "-"
+		)
+		state = "retired" if self.retired else "up" if self.connected else "down"
+		return (
+			f"shard {self.shard_id}: {state} symbols={len(self.symbols)} "
+			f"messages={self.messages} disconnects={self.disconnects} "
+			f"silent={silent_s}"
+		)
+
+
+def rebalance(
+	failed: ConnectionShard,
+	shards: list[ConnectionShard],
+	symbols_per_shard: int,
+) -> dict[ConnectionShard, list[str]]:
+	"""
+	Moves the symbols of a failed shard to the connected shards with room left,
+	the least loaded first. Returns the symbols moved to every shard; symbols
+	without room stay on the failed shard, which is retired once it is empty.
+	"""
+	targets = sorted(
+		(
+			shard
+			for shard in shards
+			if shard is not failed and shard.connected and not shard.retired
+		),
+		key=lambda shard: len(shard.symbols),
+	)
+	moved: dict[ConnectionShard, list[str]] = {}
+	for target in targets:
+		room = symbols_per_shard - len(target.symbols)
+		if room <= 0 or not failed.symbols:
+			continue
+		symbols, failed.symbols = failed.symbols[:room], failed.symbols[room:]
+		target.symbols.extend(symbols)
+		moved[target] = symbols
+	if not failed.symbols:
+		failed.retired = True
+	return moved
@@ -0,0 +1,80 @@
+import datetime
+import logging
+from pathlib import Path
+from typing import Callable
+
+from app.abstract import TradesConnector
+from app.config import settings
+from app.schemas.trade_schema import Trade, TradeRecord
+
+logger = logging.getLogger(settings.LOGGER_NAME)
+
+
+class TradesRecorder(TradesConnector):
+	"""
+	Records the trades of another connector to a JSON lines file while passing
+	them on, so they can be replayed later with `ReplayTradesConnector`.
+	"""
+
+	@property
+	def is_active(self) -> bool:
+		return self._connector.is_active
+
+	def __init__(self, connector: TradesConnector, record_dir: str | Path, name: str):
+		"""
+		:param connector: The connector to record.
+		:param record_dir: Directory of the recordings.
+		:param name: Prefix of the recording file name, e.g. the source name.
+		"""
+		self._connector = connector
+		started_at = datetime.datetime.now(datetime.timezone.utc)
+		self._path = Path(record_dir) / f"{name}_{started_at:%Y%m%dT%H%M%S}.jsonl"
+		self._path.parent.mkdir(parents=True, exist_ok=True)
+		self._file = open(self._path, "ab")
+		self.recorded = 0
+		logger.info(f"Recording trades to {self._path}")
+
+	def _record(self, callback: Callable) -> Callable:
+		def record_and_forward(trades: list[Trade | TradeRecord], *args, **kwargs):
+			self._file.write(b"".join(trade.to_json() + b"\n" for trade in trades))
+			self.recorded += len(trades)
+			return callback(trades, *args, **kwargs)
+
+		return record_and_forward
+
+	def subscribe_to_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		self._connector.subscribe_to_trades(
+			symbols,
+			self._record(callback),
+			historical_start_ms,
+			historical_end_ms,
+		)
+
+	async def stream_trades(
+		self,
+		symbols: list[str],
+		callback: Callable,
+		historical_start_ms: int | None = None,
+		historical_end_ms: int | None = None,
+	) -> None:
+		await self._connector.stream_trades(
+			symbols,
+			self._record(callback),
+			historical_start_ms,
+			historical_end_ms,
+		)
+
+	def stop(self) -> None:
+		self._connector.stop()
+
+	def close(self) -> None:
+		self._connector.close()
+		if not self._file.closed:
+			self._file.close()
+			logger.info(f"Recorded {self.recorded} trades to {self._path}")
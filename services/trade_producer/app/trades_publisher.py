@@ -0,0 +1,160 @@
+import threading
+import time
+from typing import Callable, Sequence
+
+import structlog
+from quixstreams.kafka import Producer
+
+from app.config import settings
+from app.partitioner import SymbolPartitioner
+from app.schemas.trade_schema import Trade, TradeRecord
+from app.trades_queue import TradesQueue
+
+logger = structlog.getLogger(settings.LOGGER_NAME)
+
+
+class TradesPublisher:
+	"""
+	Publishes batches of trades to Kafka.
+
+	A full local producer queue blocks the caller, polling for delivery reports
+	until there is room again, instead of failing with `BufferError`.
+	Delivery results are counted asynchronously, as the producer is polled,
+	and logged every `stats_interval_s`.
+	"""
+
+	def __init__(
+		self,
+		producer: Producer,
+		stats_interval_s: float = 10.0,
+		queue_full_poll_timeout_s: float = 0.1,
+		handoff_queue: TradesQueue | None = None,
+		partitioners: dict[str, SymbolPartitioner] | None = None,
+	):
+		"""
+		:param handoff_queue: Queue the published trades are taken from,
+			its depth and latency are logged with the publisher stats.
+		:param partitioners: Partitioners of the topics by name, the trades of
+			the other topics are partitioned by the hash of their symbol.
+		"""
+		self._producer = producer
+		self._handoff_queue = handoff_queue
+		self._partitioners = partitioners or {}
+		self._stats_interval_s = stats_interval_s
+		self._queue_full_poll_timeout_s = queue_full_poll_timeout_s
+		self._lock = threading.Lock()
+		self._logged_at = time.monotonic()
+		self.published = 0
+		self.delivered = 0
+		self.failed = 0
+		self.queue_full_waits = 0
+
+	def publish(
+		self,
+		topic_name: str,
+		trades: Sequence[Trade | TradeRecord],
+		encode: Callable[[Trade | TradeRecord], bytes],
+		on_delivered: Callable[[], None] | None = None,
+	) -> None:
+		"""
+		Produces the trades to the topic, serialized by `encode`.
+		`on_delivered` is called once the broker has acknowledged all of them.
+		"""
+		on_delivery = (
+			BatchDeliveryCallback(self, len(trades), on_delivered)
+			if on_delivered
+			else self._on_delivery
+		)
+		partitioner = self._partitioners.get(topic_name)
+		if partitioner is None:
+			for trade in trades:
+				self._produce(topic_name, trade.symbol, encode(trade), on_delivery)
+		else:
+			for trade in trades:
+				self._produce(
+					topic_name,
+					trade.symbol,
+					encode(trade),
+					on_delivery,
+					partition=partitioner.partition(trade.symbol),
+				)
+		self.published += len(trades)
+
+	def _produce(
+		self,
+		topic_name: str,
+		key: str,
+		value: bytes,
+		on_delivery: Callable,
+		partition: int | None = None,
+	) -> None:
+		while True:
+			try:
+				self._producer.produce(
+					topic=topic_name,
+					value=value,
+					key=key,
+					partition=partition,
+					on_delivery=on_delivery,
+					buffer_error_max_tries=0,
+				)
+				return
+			except BufferError:
+				# the local queue is full: wait for the broker to take some of it
+				self.queue_full_waits += 1
+				self._producer.poll(self._queue_full_poll_timeout_s)
+
+	def _on_delivery(self, err, msg) -> None:
+		with self._lock:
+			if err is None:
+				self.delivered += 1
+				return
+			self.failed += 1
+		logger.error(f"Failed to deliver trade to Kafka: {err}")
+
+	def poll(self, timeout: float = 0) -> None:
+		"""Serves delivery reports and logs the stats when they are due."""
+		self._producer.poll(timeout)
+		if time.monotonic() - self._logged_at >= self._stats_interval_s:
+			self._logged_at = time.monotonic()
+			logger.info(f"Trades publisher: {self.stats()}")
+
+	def flush(self) -> None:
+		self._producer.flush()
+		logger.info(f"Trades publisher flushed: {self.stats()}")
+
+	def stats(self) -> str:
+		stats = (
+			f"published={self.published} delivered={self.delivered} "
+			f"failed={self.failed} in_flight={len(self._producer)} "
+			f"queue_full_waits={self.queue_full_waits}"
+		)
+		if self._handoff_queue is not None:
+			stats += f" {self._handoff_queue.stats()}"
+		return stats
+
+
+class BatchDeliveryCallback:
+	"""Kafka delivery callback shared by all messages of one batch of trades."""
+
+	def __init__(
+		self,
+		publisher: TradesPublisher,
+		num_messages: int,
+		on_delivered: Callable[[], None],
+	):
+		self._publisher = publisher
+		self._remaining = num_messages
+		self._failed = False
+		self._on_delivered = on_delivered
+		self._lock = threading.Lock()
+
+	def __call__(self, err, msg) -> None:
+		self._publisher._on_delivery(err, msg)
+		with self._lock:
+			if err is not None:
+				self._failed = True
+			self._remaining -= 1
+			if self._remaining or self._failed:
+				return
+		self._on_delivered()
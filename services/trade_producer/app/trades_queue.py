@@ -0,0 +1,287 @@
+import asyncio
+import collections
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Literal, NamedTuple, Sequence
+
+import orjson
+import structlog
+
+from app.config import settings
+from app.schemas.trade_schema import Trade, TradeRecord
+
+logger = structlog.getLogger(settings.LOGGER_NAME)
+
+OverflowPolicy = Literal["block", "drop_oldest", "spill"]
+
+
+class TradesQueueClosed(Exception):
+	"""Raised by `TradesQueue.put` once the queue no longer accepts trades."""
+
+
+class TradesBatch(NamedTuple):
+	topic_name: str
+	trades: Sequence[Trade | TradeRecord]
+	on_delivered: Callable[[], None] | None
+	enqueued_at: float
+
+
+class TradesQueue:
+	"""
+	Bounded handoff of trade batches from the connectors to the publisher thread.
+
+	`put` only appends to a deque under a short lock, so a connector callback
+	never waits for Kafka. When more than `max_trades` are queued the overflow
+	policy applies:
+	- block: `put` waits until the publisher has taken enough trades,
+	- drop_oldest: the oldest batches are dropped to make room, but for those with
+		an `on_delivered`: their sources, e.g. a checkpointed download, wait for
+		every batch to be delivered. Without other batches to drop, `put` waits.
+	- spill: the new batches are appended to a file in `spill_dir` and read back,
+		in order, once the queued ones are published.
+
+	`put` blocks the calling thread while it waits, so the event loop of the
+	connectors uses `put_async`, which awaits the room instead.
+	"""
+
+	def __init__(
+		self,
+		max_trades: int = 200_000,
+		overflow_policy: OverflowPolicy = "block",
+		spill_dir: str | None = None,
+		put_timeout_s: float = 1.0,
+	):
+		"""
+		:param max_trades: Number of trades kept in memory.
+		:param overflow_policy: What `put` does when the queue is full.
+		:param spill_dir: Directory of the spill file, the temp dir by default.
+		:param put_timeout_s: How often a blocked `put` checks if the queue was closed.
+		"""
+		if overflow_policy not in ("block", "drop_oldest", "spill"):
+			raise ValueError(f"Unknown overflow policy {overflow_policy}")
+		self._max_trades = max_trades
+		self._overflow_policy = overflow_policy
+		self._spill_dir = spill_dir
+		self._put_timeout_s = put_timeout_s
+		self._batches: collections.deque[TradesBatch] = collections.deque()
+		self._lock = threading.Lock()
+		self._not_empty = threading.Condition(self._lock)
+		self._not_full = threading.Condition(self._lock)
+		# futures of the `put_async` calls waiting for room, with their event loops
+		self._room_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+		self._closed = False
+		self.queued_trades = 0
+		# spilled batches: the trades are on disk, the callbacks stay in memory
+		self._spill_file = None
+		self._spill_read_offset = 0
+		self._spilled_callbacks: collections.deque = collections.deque()
+		self.spilled_trades = 0
+		self.dropped_trades = 0
+		self.blocked_puts = 0
+		# handoff latency of the batches taken since the last stats
+		self._latency_sum_s = 0.0
+		self._latency_max_s = 0.0
+		self._latency_count = 0
+
+	def put(
+		self,
+		topic_name: str,
+		trades: Sequence[Trade | TradeRecord],
+		on_delivered: Callable[[], None] | None = None,
+	) -> None:
+		"""
+		Queues a batch of trades. Safe to call from any thread, but blocks it while
+		the queue is full, so not from the event loop.
+		"""
+		if not trades:
+			return
+		batch = TradesBatch(topic_name, trades, on_delivered, time.monotonic())
+		with self._lock:
+			if self._try_put(batch):
+				return
+			self.blocked_puts += 1
+			while not self._try_put(batch):
+				self._not_full.wait(self._put_timeout_s)
+
+	async def put_async(
+		self,
+		topic_name: str,
+		trades: Sequence[Trade | TradeRecord],
+		on_delivered: Callable[[], None] | None = None,
+	) -> None:
+		"""
+		Queues a batch of trades from the event loop. While the queue is full the
+		coroutine awaits the publisher taking trades, the other sources run on.
+		"""
+		if not trades:
+			return
+		batch = TradesBatch(topic_name, trades, on_delivered, time.monotonic())
+		loop = asyncio.get_running_loop()
+		blocked = False
+		while True:
+			with self._lock:
+				if self._try_put(batch):
+					return
+				if not blocked:
+					blocked = True
+					self.blocked_puts += 1
+				room = loop.create_future()
+				self._room_waiters.append((loop, room))
+			await room
+
+	def _try_put(self, batch: TradesBatch) -> bool:
+		"""
+		Queues the batch unless the queue is full and the policy is to wait.
+		Called under the lock; raises once the queue is closed.
+		"""
+		if self._closed:
+			raise TradesQueueClosed("The trades queue is closed")
+		if self._spilled_callbacks:
+			# keeps the order: nothing overtakes the spilled batches
+			self._spill(batch)
+			return True
+		if self._is_full(len(batch.trades)):
+			if self._overflow_policy == "spill":
+				self._spill(batch)
+				return True
+			if self._overflow_policy == "drop_oldest":
+				self._drop_oldest(len(batch.trades))
+			if self._is_full(len(batch.trades)):
+				return False
+		self._batches.append(batch)
+		self.queued_trades += len(batch.trades)
+		self._not_empty.notify()
+		return True
+
+	def _is_full(self, num_trades: int) -> bool:
+		# a batch larger than the queue is still taken once the queue is empty
+		return self.queued_trades + num_trades > self._max_trades and bool(
+			self._batches
+		)
+
+	def _drop_oldest(self, num_trades: int) -> None:
+		dropped = 0
+		# batches with an `on_delivered` are kept: their sources wait for them
+		kept = []
+		while self._is_full(num_trades):
+			batch = self._batches.popleft()
+			if batch.on_delivered is not None:
+				kept.append(batch)
+				continue
+			self.queued_trades -= len(batch.trades)
+			dropped += len(batch.trades)
+		self._batches.extendleft(reversed(kept))
+		if dropped and not self.dropped_trades:
+			# logged once, the dropped trades are counted in the stats
+			logger.warning("Trades queue is full, dropping the oldest trades")
+		self.dropped_trades += dropped
+
+	def _wake_room_waiters(self) -> None:
+		"""Wakes the waiting `put_async` calls up, they try again. Called under the lock."""
+		for loop, room in self._room_waiters:
+			try:
+				loop.call_soon_threadsafe(_set_room, room)
+			except RuntimeError:
+				# the event loop is already closed, nobody waits anymore
+				pass
+		self._room_waiters.clear()
+
+	def _spill(self, batch: TradesBatch) -> None:
+		if self._spill_file is None:
+			fd, path = tempfile.mkstemp(
+				prefix="trades_spill_", suffix=".jsonl", dir=self._spill_dir
+			)
+			# the file is only needed while the process runs
+			os.unlink(path)
+			self._spill_file = os.fdopen(fd, "a+b")
+			logger.warning(f"Trades queue is full, spilling to {path}")
+		rows = [
+			(trade.symbol, trade.qty, trade.price, trade.timestamp_ms, trade.side)
+			for trade in batch.trades
+		]
+		self._spill_file.write(orjson.dumps([batch.topic_name, rows]) + b"\n")
+		self._spilled_callbacks.append((batch.on_delivered, batch.enqueued_at))
+		self.spilled_trades += len(rows)
+		self._not_empty.notify()
+
+	def _read_spilled(self) -> TradesBatch:
+		self._spill_file.flush()
+		self._spill_file.seek(self._spill_read_offset)
+		topic_name, rows = orjson.loads(self._spill_file.readline())
+		self._spill_read_offset = self._spill_file.tell()
+		on_delivered, enqueued_at = self._spilled_callbacks.popleft()
+		self.spilled_trades -= len(rows)
+		if not self._spilled_callbacks:
+			# everything was read back, the file starts over
+			self._spill_file.truncate(0)
+			self._spill_read_offset = 0
+		trades = [TradeRecord(*row) for row in rows]
+		return TradesBatch(topic_name, trades, on_delivered, enqueued_at)
+
+	def get(self, timeout: float | None = None) -> TradesBatch | None:
+		"""
+		Takes the oldest batch, waiting up to `timeout` for one.
+		Returns None on timeout or once the queue is closed and empty.
+		"""
+		with self._lock:
+			if not self._batches and not self._spilled_callbacks and not self._closed:
+				self._not_empty.wait(timeout)
+			if self._batches:
+				batch = self._batches.popleft()
+				self.queued_trades -= len(batch.trades)
+				self._not_full.notify_all()
+				if self._room_waiters:
+					self._wake_room_waiters()
+			elif self._spilled_callbacks:
+				batch = self._read_spilled()
+			else:
+				return None
+			latency_s = time.monotonic() - batch.enqueued_at
+			self._latency_sum_s += latency_s
+			self._latency_max_s = max(self._latency_max_s, latency_s)
+			self._latency_count += 1
+		return batch
+
+	def close(self) -> None:
+		"""Stops accepting trades; the queued ones can still be taken."""
+		with self._lock:
+			self._closed = True
+			self._not_empty.notify_all()
+			self._not_full.notify_all()
+			self._wake_room_waiters()
+
+	@property
+	def closed(self) -> bool:
+		return self._closed
+
+	def __len__(self) -> int:
+		"""Number of queued batches, in memory and spilled."""
+		return len(self._batches) + len(self._spilled_callbacks)
+
+	def stats(self) -> str:
+		"""Queue depth and handoff latency since the previous call."""
+		with self._lock:
+			mean_latency_ms = (
+				self._latency_sum_s / self._latency_count * 1000
+				if self._latency_count
+				else 0.0
+			)
+			stats = (
+				f"queued_trades={self.queued_trades} "
+				f"spilled_trades={self.spilled_trades} "
+				f"dropped_trades={self.dropped_trades} "
+				f"blocked_puts={self.blocked_puts} "
+				f"handoff_latency_ms_mean={mean_latency_ms:.1f} "
+				f"handoff_latency_ms_max={self._latency_max_s * 1000:.1f}"
+			)
+			self._latency_sum_s = 0.0
+			self._latency_max_s = 0.0
+			self._latency_count = 0
+		return stats
+
+
+def _set_room(room: asyncio.Future) -> None:
+	if not room.done():
+		room.set_result(None)
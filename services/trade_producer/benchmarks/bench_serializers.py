@@ -0,0 +1,77 @@
+"""
+Compares the JSON and the binary encoding of trades and OHLCV candles:
+bytes per message and encode/decode cost on a single core.
+
+Run from the service root:
+	python -m benchmarks.bench_serializers
+"""
+
+import time
+
+from quixstreams.models.serializers import (
+	JSONDeserializer,
+	JSONSerializer,
+	MessageField,
+	SerializationContext,
+)
+
+from app.serializers import (
+	OHLCV_V1,
+	TRADE_V1,
+	BinaryDeserializer,
+	BinarySerializer,
+	RecordSchema,
+)
+
+MESSAGES = 100_000
+REPEATS = 5
+
+TRADE = {
+	"symbol": "BTC/USDT",
+	"qty": 0.00123,
+	"price": 42000.1,
+	"timestamp_ms": 1704067200123,
+}
+OHLCV = {
+	"symbol": "BTC/USDT",
+	"timestamp_ms": 1704067260000,
+	"open": 42000.1,
+	"high": 42010.5,
+	"low": 41990.2,
+	"close": 42005.3,
+	"volume": 12.345678,
+}
+
+
+def measure_ns(func, values: list) -> float:
+	best_s = float("inf")
+	for _ in range(REPEATS):
+		started_at = time.perf_counter()
+		for value in values:
+			func(value)
+		best_s = min(best_s, time.perf_counter() - started_at)
+	return best_s / len(values) * 1e9
+
+
+def compare(name: str, record: dict, schema: RecordSchema) -> None:
+	ctx = SerializationContext(topic="bench", field=MessageField.VALUE)
+	codecs = {
+		"json": (JSONSerializer(), JSONDeserializer()),
+		"binary": (BinarySerializer(schema), BinaryDeserializer()),
+	}
+	records = [record] * MESSAGES
+	print(f"{name}:")
+	for codec_name, (serializer, deserializer) in codecs.items():
+		messages = [serializer(value, ctx=ctx) for value in records]
+		assert deserializer(messages[0], ctx=ctx) == record
+		encode_ns = measure_ns(lambda value: serializer(value, ctx=ctx), records)
+		decode_ns = measure_ns(lambda value: deserializer(value, ctx=ctx), messages)
+		print(
+			f"  {codec_name:6} {len(messages[0]):4} bytes/message  "
+			f"encode {encode_ns:6.0f} ns  decode {decode_ns:6.0f} ns"
+		)
+
+
+if __name__ == "__main__":
+	compare("trade", TRADE, TRADE_V1)
+	compare("ohlcv", OHLCV, OHLCV_V1)
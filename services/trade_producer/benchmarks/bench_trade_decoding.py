@@ -0,0 +1,106 @@
+"""
+Microbenchmark of the live trades decoding path, from a raw websocket message to
+the bytes handed to the Kafka producer, on a single core.
+
+Run from the service root:
+	python -m benchmarks.bench_trade_decoding
+"""
+
+import datetime
+import json
+import time
+
+import orjson
+from quixstreams.models.serializers import (
+	JSONSerializer,
+	MessageField,
+	SerializationContext,
+)
+
+from app.schemas.trade_schema import Trade
+from app.trades_connectors.kraken_trades_connector import KrakenTradesConnector
+
+TRADES_PER_MESSAGE = 20
+MESSAGES = 5_000
+REPEATS = 5
+
+
+def build_kraken_messages() -> list[bytes]:
+	start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+	messages = []
+	for i in range(MESSAGES):
+		data = []
+		for j in range(TRADES_PER_MESSAGE):
+			ts = start + datetime.timedelta(
+				milliseconds=37 * (i * TRADES_PER_MESSAGE + j)
+			)
+			data.append(
+				{
+					"symbol": "BTC/USDT",
+					"side": "buy",
+					"price": 42000.1 + j,
+					"qty": 0.00123,
+					"ord_type": "market",
+					"trade_id": i * TRADES_PER_MESSAGE + j,
+					"timestamp": ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+				}
+			)
+		messages.append(
+			json.dumps({"channel": "trade", "type": "update", "data": data}).encode()
+		)
+	return messages
+
+
+def legacy_decode(messages: list[bytes]) -> int:
+	"""The decoding path before the fast path: json, pydantic and fromisoformat."""
+	serializer = JSONSerializer()
+	ctx = SerializationContext(topic="trades", field=MessageField.VALUE)
+	produced = 0
+	for message in messages:
+		msg_json = json.loads(message)
+		trades = []
+		for item in msg_json.get("data"):
+			dt = datetime.datetime.fromisoformat(
+				item.get("timestamp").replace("Z", "+00:00")
+			)
+			trades.append(
+				Trade(
+					symbol=item.get("symbol"),
+					price=item.get("price"),
+					qty=item.get("qty"),
+					timestamp_ms=int(dt.timestamp() * 1000),
+				)
+			)
+		for trade in trades:
+			serializer(trade.model_dump(), ctx=ctx)
+			produced += 1
+	return produced
+
+
+def fast_decode(messages: list[bytes]) -> int:
+	connector = KrakenTradesConnector()
+	produced = 0
+	for message in messages:
+		for trade in connector._extract_trades_from_websocket_message(
+			orjson.loads(message)
+		):
+			trade.to_json()
+			produced += 1
+	return produced
+
+
+def measure(decode, messages: list[bytes]) -> float:
+	best_s = float("inf")
+	for _ in range(REPEATS):
+		started_at = time.perf_counter()
+		produced = decode(messages)
+		best_s = min(best_s, time.perf_counter() - started_at)
+	return produced / best_s
+
+
+if __name__ == "__main__":
+	messages = build_kraken_messages()
+	legacy_rate = measure(legacy_decode, messages)
+	fast_rate = measure(fast_decode, messages)
+	print(f"legacy: {legacy_rate:12,.0f} trades/s")
+	print(f"fast:   {fast_rate:12,.0f} trades/s ({fast_rate / legacy_rate:.1f}x)")
@@ -0,0 +1,4 @@
+import os
+
+# app.config reads the settings on import
+os.environ.setdefault("KAFKA_TRADES_TOPIC", "trades")
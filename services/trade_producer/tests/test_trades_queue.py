@@ -0,0 +1,167 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.schemas.trade_schema import BUY, SELL, TradeRecord
+from app.trades_queue import TradesQueue, TradesQueueClosed
+
+
+def get_trades(num_trades: int, first_timestamp_ms: int = 0) -> list[TradeRecord]:
+	return [
+		TradeRecord("BTC/USD", 0.1, 42000.0, first_timestamp_ms + i, (BUY, SELL)[i % 2])
+		for i in range(num_trades)
+	]
+
+
+def drain(queue: TradesQueue) -> list[TradeRecord]:
+	trades = []
+	while (batch := queue.get(timeout=0)) is not None:
+		trades.extend(batch.trades)
+	return trades
+
+
+def test_put_blocks_until_the_publisher_takes_trades():
+	queue = TradesQueue(max_trades=2, put_timeout_s=0.01)
+	queue.put("trades", get_trades(2))
+	put = threading.Thread(target=queue.put, args=("trades", get_trades(2, 2)))
+	put.start()
+	put.join(timeout=0.1)
+	assert put.is_alive()
+	assert queue.blocked_puts == 1
+
+	assert [t.timestamp_ms for t in queue.get(timeout=0).trades] == [0, 1]
+	put.join(timeout=1)
+	assert not put.is_alive()
+	assert [t.timestamp_ms for t in drain(queue)] == [2, 3]
+
+
+def test_put_raises_once_closed_while_waiting():
+	queue = TradesQueue(max_trades=1, put_timeout_s=0.01)
+	queue.put("trades", get_trades(1))
+	errors = []
+
+	def put() -> None:
+		try:
+			queue.put("trades", get_trades(1))
+		except TradesQueueClosed as e:
+			errors.append(e)
+
+	thread = threading.Thread(target=put)
+	thread.start()
+	queue.close()
+	thread.join(timeout=1)
+	assert len(errors) == 1
+	with pytest.raises(TradesQueueClosed):
+		queue.put("trades", get_trades(1))
+
+
+def test_put_async_awaits_room_without_blocking_the_loop():
+	queue = TradesQueue(max_trades=2)
+
+	async def run() -> list[str]:
+		events = []
+		await queue.put_async("trades", get_trades(2))
+
+		async def put() -> None:
+			await queue.put_async("trades", get_trades(2, 2))
+			events.append("put")
+
+		async def other_source() -> None:
+			events.append("other source")
+
+		put_task = asyncio.create_task(put())
+		await asyncio.create_task(other_source())
+		await asyncio.sleep(0.05)
+		assert not put_task.done()
+		# the publisher thread takes the first batch
+		await asyncio.to_thread(queue.get, 0)
+		await asyncio.wait_for(put_task, timeout=1)
+		return events
+
+	assert asyncio.run(run()) == ["other source", "put"]
+	assert queue.blocked_puts == 1
+	assert [t.timestamp_ms for t in drain(queue)] == [2, 3]
+
+
+def test_put_async_raises_once_closed_while_waiting():
+	queue = TradesQueue(max_trades=1)
+
+	async def run() -> None:
+		await queue.put_async("trades", get_trades(1))
+		put_task = asyncio.create_task(queue.put_async("trades", get_trades(1)))
+		await asyncio.sleep(0.01)
+		await asyncio.to_thread(queue.close)
+		await asyncio.wait_for(put_task, timeout=1)
+
+	with pytest.raises(TradesQueueClosed):
+		asyncio.run(run())
+
+
+def test_drop_oldest_drops_the_oldest_batches():
+	queue = TradesQueue(max_trades=4, overflow_policy="drop_oldest")
+	for first_timestamp_ms in (0, 2, 4):
+		queue.put("trades", get_trades(2, first_timestamp_ms))
+	assert queue.dropped_trades == 2
+	assert [t.timestamp_ms for t in drain(queue)] == [2, 3, 4, 5]
+
+
+def test_drop_oldest_keeps_the_batches_waiting_for_delivery():
+	queue = TradesQueue(max_trades=4, overflow_policy="drop_oldest", put_timeout_s=0.01)
+	queue.put("trades", get_trades(2, 0), on_delivered=lambda: None)
+	queue.put("trades", get_trades(2, 2))
+	queue.put("trades", get_trades(2, 4))
+	assert queue.dropped_trades == 2
+	batches = [queue.get(timeout=0), queue.get(timeout=0)]
+	assert [t.timestamp_ms for batch in batches for t in batch.trades] == [0, 1, 4, 5]
+	assert batches[0].on_delivered is not None
+
+	# with only tracked batches queued, the put waits instead of dropping
+	queue.put("trades", get_trades(4, 6), on_delivered=lambda: None)
+	put = threading.Thread(
+		target=queue.put,
+		args=("trades", get_trades(2, 10)),
+		kwargs={"on_delivered": lambda: None},
+	)
+	put.start()
+	put.join(timeout=0.1)
+	assert put.is_alive()
+	assert queue.dropped_trades == 2
+	queue.get(timeout=0)
+	put.join(timeout=1)
+	assert [t.timestamp_ms for t in drain(queue)] == [10, 11]
+
+
+def test_spill_keeps_the_order_and_the_callbacks():
+	queue = TradesQueue(max_trades=2, overflow_policy="spill")
+	delivered = []
+	for first_timestamp_ms in (0, 2, 4):
+		queue.put(
+			"trades",
+			get_trades(2, first_timestamp_ms),
+			on_delivered=lambda ms=first_timestamp_ms: delivered.append(ms),
+		)
+	assert queue.spilled_trades == 4
+	assert len(queue) == 3
+
+	batches = []
+	while (batch := queue.get(timeout=0)) is not None:
+		batches.append(batch)
+		if batch.on_delivered is not None:
+			batch.on_delivered()
+		# a put meanwhile goes after the spilled batches
+		if len(batches) == 1:
+			queue.put("trades", get_trades(1, 6))
+	assert [t.timestamp_ms for batch in batches for t in batch.trades] == [
+		0,
+		1,
+		2,
+		3,
+		4,
+		5,
+		6,
+	]
+	assert all(isinstance(t, TradeRecord) for t in batches[1].trades)
+	assert batches[1].trades == get_trades(2, 2)
+	assert delivered == [0, 2, 4]
+	assert queue.spilled_trades == 0
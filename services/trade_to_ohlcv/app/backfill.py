@@ -0,0 +1,572 @@
+"""
+Batch backfill of OHLCV candles from trade files, without Kafka on the input side.
+
+The trades recorded by the trade producer, JSON lines or Parquet files with
+`symbol`, `qty`, `price`, `timestamp_ms` and optionally `side`, are read at
+once, ordered by time and grouped by symbol and window with NumPy. The candles
+are written to the OHLCV topics in bulk or to one Parquet file per window size.
+
+The candles are the same as those of the streaming path fed with the same
+trades: the volume is summed trade by trade, the larger windows are rolled up
+from the smaller candles, and the last window of every symbol, which no later
+trade closes, is left out unless `emit_open_windows` is set. With `fill_gaps`
+the candles form the dense grid of app/candle_grid.py, up to the latest trade,
+as the batch aggregation mode emits it. The statistics of app/candle_stats.py
+are aggregated and rolled up along with the candles.
+
+Run from the service root:
+	python -m app.backfill
+"""
+
+import glob
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import orjson
+import structlog
+from quixstreams import Application
+
+from app.batch_aggregation import (
+	classify_sides,
+	get_vwaps,
+	sequential_sums,
+	starts_of_runs,
+)
+from app.candle_stats import get_stats_fields
+from app.config import settings
+from app.main import (
+	KafkaOptions,
+	_get_output_topics,
+	_get_windows_seconds,
+	_produce_candles,
+)
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:  # only Parquet files need pyarrow
+	pa = None
+
+logger = structlog.get_logger(settings.LOGGER_NAME)
+
+TRADES_FILE_SUFFIXES = (".jsonl", ".parquet")
+
+
+class Trades(NamedTuple):
+	"""
+	Trades as columns, ordered by time; symbols are indexes into `symbols`, sides
+	those the exchange reported, 0 where it didn't.
+	"""
+
+	symbols: list[str]
+	codes: np.ndarray
+	timestamps_ms: np.ndarray
+	prices: np.ndarray
+	qtys: np.ndarray
+	sides: np.ndarray
+
+
+class Candles(NamedTuple):
+	"""
+	Candles of one window size as columns, ordered by symbol and start,
+	with the columns of their statistics by field.
+	"""
+
+	codes: np.ndarray
+	starts_ms: np.ndarray
+	opens: np.ndarray
+	highs: np.ndarray
+	lows: np.ndarray
+	closes: np.ndarray
+	volumes: np.ndarray
+	stats: dict[str, np.ndarray]
+
+	def take(self, indexes: np.ndarray) -> "Candles":
+		return Candles(
+			*(column[indexes] for column in self[:-1]),
+			stats={field: column[indexes] for field, column in self.stats.items()},
+		)
+
+
+def read_trades(paths: list[str]) -> Trades:
+	"""
+	Reads the trades of the files, in the order of the paths, and orders them by
+	time. Trades with the same timestamp keep the order of the files, as the
+	replay of the trade producer merges them.
+	"""
+	symbol_indexes: dict[str, int] = {}
+	codes, timestamps_ms, prices, qtys, sides = [], [], [], [], []
+	for path in _resolve_paths(paths):
+		logger.info(f"Reading trades from {path}")
+		if path.suffix == ".parquet":
+			file_columns = _read_parquet(path, symbol_indexes)
+		else:
+			file_columns = _read_json_lines(path, symbol_indexes)
+		for columns, file_column in zip(
+			(codes, timestamps_ms, prices, qtys, sides), file_columns
+		):
+			columns.append(file_column)
+	if not codes:
+		raise FileNotFoundError(f"No trades files at {paths}")
+	timestamps_ms = np.concatenate(timestamps_ms)
+	order = np.argsort(timestamps_ms, kind="stable")
+	return Trades(
+		symbols=list(symbol_indexes),
+		codes=np.concatenate(codes)[order],
+		timestamps_ms=timestamps_ms[order],
+		prices=np.concatenate(prices)[order],
+		qtys=np.concatenate(qtys)[order],
+		sides=np.concatenate(sides)[order],
+	)
+
+
+def _resolve_paths(paths: list[str]) -> list[Path]:
+	"""Expands directories and glob patterns to the trades files."""
+	resolved = []
+	for path in paths:
+		if not path:
+			continue
+		if Path(path).is_dir():
+			resolved.extend(
+				sorted(
+					file
+					for file in Path(path).iterdir()
+					if file.suffix in TRADES_FILE_SUFFIXES
+				)
+			)
+			continue
+		matches = sorted(glob.glob(path))
+		if not matches:
+			raise FileNotFoundError(f"No trades files at {path}")
+		resolved.extend(Path(match) for match in matches)
+	return resolved
+
+
+def _read_json_lines(
+	path: Path, symbol_indexes: dict[str, int]
+) -> tuple[np.ndarray, ...]:
+	codes, timestamps_ms, prices, qtys, sides = [], [], [], [], []
+	with open(path, "rb") as file:
+		for line in file:
+			if not line.strip():
+				continue
+			trade = orjson.loads(line)
+			codes.append(
+				symbol_indexes.setdefault(trade["symbol"], len(symbol_indexes))
+			)
+			timestamps_ms.append(trade["timestamp_ms"])
+			prices.append(trade["price"])
+			qtys.append(trade["qty"])
+			sides.append(trade.get("side", 0))
+	return (
+		np.array(codes, dtype=np.intp),
+		np.array(timestamps_ms, dtype=np.int64),
+		np.array(prices, dtype=np.float64),
+		np.array(qtys, dtype=np.float64),
+		np.array(sides, dtype=np.int8),
+	)
+
+
+def _read_parquet(path: Path, symbol_indexes: dict[str, int]) -> tuple[np.ndarray, ...]:
+	if pa is None:
+		raise ImportError(f"pyarrow is required to read {path}")
+	columns = ["symbol", "qty", "price", "timestamp_ms"]
+	has_sides = "side" in pq.read_schema(path).names
+	if has_sides:
+		columns.append("side")
+	table = pq.read_table(path, columns=columns)
+	symbols = table.column("symbol").combine_chunks().dictionary_encode()
+	file_codes = np.array(
+		[
+			symbol_indexes.setdefault(symbol, len(symbol_indexes))
+			for symbol in symbols.dictionary.to_pylist()
+		],
+		dtype=np.intp,
+	)
+	return (
+		file_codes[symbols.indices.to_numpy()],
+		table.column("timestamp_ms").to_numpy().astype(np.int64),
+		table.column("price").to_numpy().astype(np.float64),
+		table.column("qty").to_numpy().astype(np.float64),
+		(
+			table.column("side").to_numpy().astype(np.int8)
+			if has_sides
+			else np.zeros(table.num_rows, dtype=np.int8)
+		),
+	)
+
+
+def aggregate_trades(
+	trades: Trades, window_ms: int, stats_fields: list[str] | None = None
+) -> Candles:
+	"""Aggregates the trades into candles of every symbol and window."""
+	# by symbol, in time order within a symbol
+	order = np.argsort(trades.codes, kind="stable")
+	codes = trades.codes[order]
+	timestamps_ms = trades.timestamps_ms[order]
+	starts_ms = timestamps_ms - timestamps_ms % window_ms
+	prices = trades.prices[order]
+	qtys = trades.qtys[order]
+	# every trade as a candle of its own
+	stats = {}
+	for field in stats_fields or []:
+		if field == "notional":
+			stats[field] = prices * qtys
+		elif field == "trade_count":
+			stats[field] = np.ones(len(codes), dtype=np.int64)
+		elif field in ("first_trade_ms", "last_trade_ms"):
+			stats[field] = timestamps_ms
+		else:
+			stats[field] = np.zeros(len(codes))
+	if "buy_volume" in stats:
+		symbol_starts = np.flatnonzero(starts_of_runs(codes))
+		sides = classify_sides(
+			prices,
+			symbol_starts,
+			np.full(len(symbol_starts), np.nan),
+			np.zeros(len(symbol_starts), dtype=np.int8),
+			trades.sides[order],
+		)
+		stats["buy_volume"] = np.where(sides > 0, qtys, 0.0)
+		stats["sell_volume"] = np.where(sides < 0, qtys, 0.0)
+	return _aggregate_runs(
+		codes,
+		starts_ms,
+		opens=prices,
+		highs=prices,
+		lows=prices,
+		closes=prices,
+		volumes=qtys,
+		stats=stats,
+	)
+
+
+def roll_up_candles(candles: Candles, window_ms: int) -> Candles:
+	"""Rolls candles up into candles of a larger window, as `_roll_up_ohlcv_candles`."""
+	return _aggregate_runs(
+		candles.codes,
+		candles.starts_ms - candles.starts_ms % window_ms,
+		opens=candles.opens,
+		highs=candles.highs,
+		lows=candles.lows,
+		closes=candles.closes,
+		volumes=candles.volumes,
+		stats=candles.stats,
+	)
+
+
+def _aggregate_runs(
+	codes: np.ndarray,
+	starts_ms: np.ndarray,
+	opens: np.ndarray,
+	highs: np.ndarray,
+	lows: np.ndarray,
+	closes: np.ndarray,
+	volumes: np.ndarray,
+	stats: dict[str, np.ndarray],
+) -> Candles:
+	"""Aggregates the runs of rows with the same symbol and window start."""
+	if not len(codes):
+		return Candles(codes, starts_ms, opens, highs, lows, closes, volumes, stats)
+	run_starts = np.flatnonzero(starts_of_runs(codes) | starts_of_runs(starts_ms))
+	run_ends = np.append(run_starts[1:], len(codes))
+	candles = Candles(
+		codes=codes[run_starts],
+		starts_ms=starts_ms[run_starts],
+		opens=opens[run_starts],
+		highs=np.maximum.reduceat(highs, run_starts),
+		lows=np.minimum.reduceat(lows, run_starts),
+		closes=closes[run_ends - 1],
+		volumes=sequential_sums(volumes, run_starts, run_ends),
+		stats={},
+	)
+	for field, values in stats.items():
+		if field == "trade_count":
+			candles.stats[field] = np.add.reduceat(values, run_starts)
+		elif field == "first_trade_ms":
+			# 0 in candles without trades
+			first_trade_ms = np.minimum.reduceat(
+				np.where(values == 0, np.iinfo(np.int64).max, values), run_starts
+			)
+			candles.stats[field] = np.where(
+				first_trade_ms == np.iinfo(np.int64).max, 0, first_trade_ms
+			)
+		elif field == "last_trade_ms":
+			candles.stats[field] = np.maximum.reduceat(values, run_starts)
+		elif field == "vwap":
+			candles.stats[field] = get_vwaps(
+				candles.stats["notional"], candles.volumes, candles.closes
+			)
+		else:
+			candles.stats[field] = sequential_sums(values, run_starts, run_ends)
+	return candles
+
+
+def fill_candle_gaps(candles: Candles, window_ms: int, until_ms: int) -> Candles:
+	"""
+	The dense grid of the candles, as `app.candle_grid` emits it: a flat candle at
+	the previous close for every window without trades of a symbol, up to the
+	window ending at `until_ms`, and every candle opening at the previous close.
+	"""
+	if not len(candles.codes):
+		return candles
+	firsts = np.flatnonzero(starts_of_runs(candles.codes))
+	lasts = np.append(firsts[1:], len(candles.codes)) - 1
+	grid_starts_ms = candles.starts_ms[firsts]
+	lengths = (
+		np.maximum(candles.starts_ms[lasts], until_ms - window_ms) - grid_starts_ms
+	) // window_ms + 1
+	grid_firsts = np.cumsum(lengths) - lengths
+	size = int(lengths.sum())
+
+	# the grid position of every candle
+	runs = np.repeat(np.arange(len(firsts)), lasts - firsts + 1)
+	positions = (
+		grid_firsts[runs] + (candles.starts_ms - grid_starts_ms[runs]) // window_ms
+	)
+	has_trades = np.zeros(size, dtype=bool)
+	has_trades[positions] = True
+	# the latest candle of every position, the grid of a symbol starts with one
+	latest = np.maximum.accumulate(np.where(has_trades, np.arange(size), 0))
+	candle_indexes = np.empty(size, dtype=np.intp)
+	candle_indexes[positions] = np.arange(len(candles.codes))
+	grid = candles.take(candle_indexes[latest])
+
+	closes = grid.closes
+	opens = np.where(has_trades, grid.opens, closes)
+	is_seeded = np.ones(size, dtype=bool)
+	is_seeded[grid_firsts] = False
+	opens[is_seeded] = closes[np.flatnonzero(is_seeded) - 1]
+	stats = {
+		field: np.where(has_trades, column, closes if field == "vwap" else 0)
+		for field, column in grid.stats.items()
+	}
+	return Candles(
+		codes=grid.codes,
+		starts_ms=np.repeat(grid_starts_ms - grid_firsts * window_ms, lengths)
+		+ np.arange(size) * window_ms,
+		opens=opens,
+		highs=np.maximum(np.where(has_trades, grid.highs, closes), opens),
+		lows=np.minimum(np.where(has_trades, grid.lows, closes), opens),
+		closes=closes,
+		volumes=np.where(has_trades, grid.volumes, 0.0),
+		stats=stats,
+	)
+
+
+def _drop_open_candles(
+	candles: Candles,
+	window_ms: int,
+	child_candles: Candles | None = None,
+	child_window_ms: int | None = None,
+) -> Candles:
+	"""
+	Leaves out the last candle of every symbol when the streaming path keeps it
+	open: a window of trades is closed by a later trade of its symbol, a rolled
+	up window by its last child candle or a later one.
+	"""
+	is_open = _ends_of_runs(candles.codes)
+	if child_candles is not None:
+		# the last child candle of a symbol may end with its rolled up window
+		child_ends_ms = (
+			child_candles.starts_ms[_ends_of_runs(child_candles.codes)]
+			+ child_window_ms
+		)
+		is_open[is_open] = child_ends_ms != candles.starts_ms[is_open] + window_ms
+	return candles.take(np.flatnonzero(~is_open))
+
+
+def _ends_of_runs(codes: np.ndarray) -> np.ndarray:
+	"""True where a code differs from the next one."""
+	is_end = np.empty(len(codes), dtype=bool)
+	if len(codes):
+		is_end[-1] = True
+		np.not_equal(codes[1:], codes[:-1], out=is_end[:-1])
+	return is_end
+
+
+def _to_dicts(candles: Candles, symbols: list[str], window_ms: int) -> list[dict]:
+	"""The candles as the streaming path writes them, ordered by time."""
+	candles = candles.take(np.lexsort((candles.codes, candles.starts_ms)))
+	fields = list(candles.stats)
+	return [
+		{
+			"symbol": symbols[code],
+			"timestamp_ms": start_ms + window_ms,
+			"open": open_,
+			"high": high,
+			"low": low,
+			"close": close,
+			"volume": volume,
+			**dict(zip(fields, stats)),
+		}
+		for code, start_ms, open_, high, low, close, volume, *stats in zip(
+			*(column.tolist() for column in candles[:-1]),
+			*(column.tolist() for column in candles.stats.values()),
+		)
+	]
+
+
+def _write_parquet(
+	candles_by_window: dict[int, Candles], symbols: list[str], parquet_dir: Path
+) -> None:
+	parquet_dir.mkdir(parents=True, exist_ok=True)
+	symbol_names = np.array(symbols, dtype=object)
+	for window_seconds, candles in candles_by_window.items():
+		candles = candles.take(np.lexsort((candles.codes, candles.starts_ms)))
+		table = pa.table(
+			{
+				"symbol": pa.array(symbol_names[candles.codes], pa.string()),
+				"timestamp_ms": candles.starts_ms + window_seconds * 1000,
+				"open": candles.opens,
+				"high": candles.highs,
+				"low": candles.lows,
+				"close": candles.closes,
+				"volume": candles.volumes,
+				**candles.stats,
+			}
+		)
+		path = parquet_dir / f"ohlcv_{window_seconds}s.parquet"
+		pq.write_table(table, path)
+		logger.info(f"Wrote {len(candles.codes)} candles to {path}")
+
+
+def _produce_to_topics(
+	candles_by_window: dict[int, Candles],
+	symbols: list[str],
+	kafka: KafkaOptions,
+	stats_fields: list[str],
+) -> None:
+	app = Application(
+		broker_address=kafka.broker_address,
+		consumer_group=kafka.consumer_group,
+		auto_offset_reset=kafka.auto_offset_reset,
+	)
+	window_topic_names, output_topics = _get_output_topics(
+		app, kafka, list(candles_by_window), stats_fields
+	)
+	with app.get_producer() as producer:
+		for window_seconds, candles in candles_by_window.items():
+			_produce_candles(
+				producer,
+				_to_dicts(candles, symbols, window_seconds * 1000),
+				window_seconds,
+				window_topic_names,
+				output_topics,
+			)
+			logger.info(
+				f"Produced {len(candles.codes)} candles of {window_seconds}s "
+				f"to {window_topic_names[window_seconds]}"
+			)
+		producer.flush()
+
+
+def backfill_ohlcv(
+	paths: list[str],
+	ohlcv_window_seconds: int | list[int],
+	output: str,
+	kafka: KafkaOptions | None = None,
+	parquet_dir: str | Path | None = None,
+	emit_open_windows: bool = False,
+	fill_gaps: bool = False,
+	extra_stats: list[str] | None = None,
+) -> None:
+	"""
+	Aggregates the trades of the files into OHLCV of all window sizes.
+
+	Args:
+	    paths: Files, directories or glob patterns of the trades
+	    ohlcv_window_seconds: Window sizes in seconds,
+	        each one a multiple of the next smaller one
+	    output: "topic" to produce to the OHLCV topics of `kafka`,
+	        "parquet" to write `ohlcv_<seconds>s.parquet` files to `parquet_dir`
+	    kafka: Kafka options, with the topics of the timeframes
+	    parquet_dir: Directory of the Parquet files
+	    emit_open_windows: Also write the last candle of every symbol,
+	        which the streaming path keeps open
+	    fill_gaps: Whether to write a dense candle grid
+	    extra_stats: Groups of statistics added to the candles
+
+	Returns:
+	    None
+	"""
+	windows_seconds = _get_windows_seconds(ohlcv_window_seconds)
+	stats_fields = get_stats_fields(extra_stats or [])
+	if output not in ("topic", "parquet"):
+		raise ValueError(f"Unknown backfill output {output}")
+	if output == "topic" and kafka is None:
+		raise ValueError("Kafka options are required to backfill the OHLCV topics")
+	if output == "parquet" and (pa is None or parquet_dir is None):
+		raise ValueError("pyarrow and a directory are required to write Parquet")
+
+	started_at = time.monotonic()
+	trades = read_trades(paths)
+	logger.info(
+		f"Read {len(trades.codes)} trades of {len(trades.symbols)} symbols "
+		f"in {time.monotonic() - started_at:.1f}s"
+	)
+
+	candles_by_window: dict[int, Candles] = {}
+	child_candles = None
+	child_window_ms = None
+	latest_timestamp_ms = int(trades.timestamps_ms[-1])
+	for window_seconds in windows_seconds:
+		window_ms = window_seconds * 1000
+		if child_candles is None:
+			candles = aggregate_trades(trades, window_ms, stats_fields)
+			if fill_gaps:
+				candles = fill_candle_gaps(
+					candles,
+					window_ms,
+					until_ms=latest_timestamp_ms - latest_timestamp_ms % window_ms,
+				)
+		else:
+			candles = roll_up_candles(child_candles, window_ms)
+		if fill_gaps and not emit_open_windows:
+			# the windows are closed by the latest trade of all symbols
+			candles = candles.take(
+				np.flatnonzero(candles.starts_ms + window_ms <= latest_timestamp_ms)
+			)
+		elif not emit_open_windows:
+			candles = _drop_open_candles(
+				candles, window_ms, child_candles, child_window_ms
+			)
+		candles_by_window[window_seconds] = candles
+		child_candles = candles
+		child_window_ms = window_ms
+
+	if output == "parquet":
+		_write_parquet(candles_by_window, trades.symbols, Path(parquet_dir))
+	else:
+		_produce_to_topics(candles_by_window, trades.symbols, kafka, stats_fields)
+	num_candles = sum(len(candles.codes) for candles in candles_by_window.values())
+	elapsed_s = time.monotonic() - started_at
+	logger.info(
+		f"Backfilled {num_candles} candles of {len(trades.codes)} trades "
+		f"in {elapsed_s:.1f}s ({len(trades.codes) / max(elapsed_s, 1e-9):,.0f} trades/s)"
+	)
+
+
+if __name__ == "__main__":
+	logger.info("Starting the OHLCV backfill")
+	backfill_ohlcv(
+		paths=settings.backfill.TRADES_PATHS,
+		ohlcv_window_seconds=settings.OHLCV_WINDOWS_SECONDS,
+		output=settings.backfill.OUTPUT,
+		kafka=KafkaOptions(
+			broker_address=settings.kafka.BROKER_ADDRESS,
+			input_topic=settings.kafka.TRADES_TOPIC,
+			output_topic=settings.kafka.OHLCV_TOPIC,
+			consumer_group=settings.kafka.CONSUMER_GROUP,
+			auto_offset_reset=settings.kafka.AUTO_OFFSET_RESET,
+			output_topic_format=settings.kafka.OHLCV_TOPIC_FORMAT,
+			window_output_topics=settings.kafka.WINDOW_OHLCV_TOPICS,
+			topic_config=settings.kafka.topic_config(),
+		),
+		parquet_dir=settings.backfill.PARQUET_DIR,
+		emit_open_windows=settings.backfill.EMIT_OPEN_WINDOWS,
+		fill_gaps=settings.OHLCV_FILL_GAPS,
+		extra_stats=settings.OHLCV_EXTRA_STATS,
+	)
@@ -0,0 +1,1060 @@
+"""
+Micro-batch aggregation of trades into OHLCV candles with NumPy.
+
+The tumbling window of `app.main.trade_to_ohlcv` calls the reducer and the state
+store for every trade. Here a whole batch of trades is grouped by symbol and
+window at once, and the open candles of the symbols live in arrays updated in
+place, so the state is only saved once per batch.
+
+The candles are the same as those of the tumbling window without grace period:
+the latest trade timestamp is tracked per partition, the trades of a window that
+already ended are dropped, and a window is closed by the next trade of its symbol
+at or after its end. Trades are keyed by symbol, so a symbol is a window key.
+The statistics of app/candle_stats.py are aggregated along, as columns as well.
+With a grace period the trades go through the reorder buffer of app/watermarks.py
+first, since a symbol has a single open window here.
+
+The symbols only grow in the arrays and the state of the partition, unless
+the symbols without trades for a while are expired, see
+`PartitionState.expire_symbols`.
+
+The state of a partition is saved to a local file by `PartitionSnapshots`,
+unlike the state store of the tumbling window, which is backed by a changelog
+topic. A partition can only resume on a replica that reads the files of the one
+it was assigned to before, so all replicas of a consumer group share the state
+directory, e.g. on a volume; see benchmarks/bench_replica_scaling.py.
+"""
+
+import functools
+import os
+from pathlib import Path
+from typing import Any, Callable, Iterable, Sequence
+
+import numpy as np
+from quixstreams.utils.json import dumps as json_dumps
+from quixstreams.utils.json import loads as json_loads
+
+from app.candle_stats import INTEGER_FIELDS
+from app.watermarks import TradesReorderBuffer
+
+# start of the open window of a symbol without one
+NO_WINDOW = -1
+
+
+class OhlcvBatchAggregator:
+	"""Open OHLCV candles of the symbols of one partition."""
+
+	def __init__(
+		self,
+		window_ms: int,
+		capacity: int = 1024,
+		stats_fields: Sequence[str] = (),
+	):
+		"""
+		:param window_ms: Window size in milliseconds.
+		:param capacity: Number of symbols the arrays are allocated for,
+			they grow when more symbols show up.
+		:param stats_fields: Fields of the statistics of the candles,
+			see `app.candle_stats.get_stats_fields`.
+		"""
+		self.window_ms = window_ms
+		# the latest trade timestamp of the partition, as in the windowed state
+		self.latest_timestamp_ms = 0
+		# trades dropped as late since the last stats
+		self.late_trades = 0
+		self.symbols: list[str] = []
+		self._symbol_indexes: dict[str, int] = {}
+		self._start_ms = np.full(capacity, NO_WINDOW, dtype=np.int64)
+		self._open = np.zeros(capacity)
+		self._high = np.zeros(capacity)
+		self._low = np.zeros(capacity)
+		self._close = np.zeros(capacity)
+		self._volume = np.zeros(capacity)
+		self._stats = {
+			field: np.zeros(
+				capacity, dtype=np.int64 if field in INTEGER_FIELDS else np.float64
+			)
+			for field in stats_fields
+		}
+		# price and side of the latest trade of every symbol, for the tick rule
+		self._classifies_sides = "buy_volume" in self._stats
+		self._latest_price = np.full(capacity, np.nan)
+		self._latest_side = np.zeros(capacity, dtype=np.int8)
+		# timestamp of the latest trade of every symbol, for the expiry
+		self._last_trade_ms = np.zeros(capacity, dtype=np.int64)
+
+	@property
+	def num_open_windows(self) -> int:
+		return int(np.count_nonzero(self._start_ms[: len(self.symbols)] != NO_WINDOW))
+
+	def aggregate(
+		self,
+		symbols: Sequence[str],
+		timestamps_ms: Sequence[int],
+		prices: Sequence[float],
+		qtys: Sequence[float],
+		sides: Sequence[int] | None = None,
+	) -> list[dict]:
+		"""
+		Adds a batch of trades, in the order they were consumed, and returns
+		the candles they closed, ordered by end time. `sides` are the aggressor
+		sides the exchange reported, 0 where it didn't.
+		"""
+		num_trades = len(symbols)
+		if not num_trades:
+			return []
+		window_ms = self.window_ms
+		codes = self._get_symbol_indexes(symbols)
+		timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+		prices = np.asarray(prices, dtype=np.float64)
+		qtys = np.asarray(qtys, dtype=np.float64)
+
+		# the latest timestamp of the partition after and before every trade
+		latest_after_ms = np.maximum.accumulate(
+			np.maximum(timestamps_ms, self.latest_timestamp_ms)
+		)
+		latest_before_ms = np.empty_like(latest_after_ms)
+		latest_before_ms[0] = self.latest_timestamp_ms
+		latest_before_ms[1:] = latest_after_ms[:-1]
+		self.latest_timestamp_ms = int(latest_after_ms[-1])
+		starts_ms = timestamps_ms - timestamps_ms % window_ms
+		# the trades of a window that ended before they arrived are dropped
+		is_valid = starts_ms + window_ms > latest_before_ms
+		self.late_trades += num_trades - int(np.count_nonzero(is_valid))
+
+		# trades grouped by symbol, in the consumed order within a symbol
+		order = np.argsort(codes, kind="stable")
+		sorted_codes = codes[order]
+		first_trades = np.flatnonzero(starts_of_runs(sorted_codes))
+		batch_codes = sorted_codes[first_trades]
+		# the windows of a symbol are closed by its last trade of the batch
+		last_trades = np.append(first_trades[1:], num_trades) - 1
+		closed_until_ms = latest_after_ms[order[last_trades]]
+		first_seen = order[first_trades]
+		self._last_trade_ms[batch_codes] = np.maximum(
+			self._last_trade_ms[batch_codes],
+			np.maximum.reduceat(timestamps_ms[order], first_trades),
+		)
+		if self._classifies_sides:
+			sides = self._classify_sides(
+				prices,
+				None if sides is None else np.asarray(sides, dtype=np.int8),
+				order,
+				first_trades,
+				last_trades,
+				batch_codes,
+			)
+		else:
+			sides = None
+
+		# one run of trades per symbol and window: the valid trades of a symbol
+		# never go back to an earlier window
+		order = order[is_valid[order]]
+		window_codes = codes[order]
+		window_starts_ms = starts_ms[order]
+		if len(order):
+			run_starts = np.flatnonzero(
+				starts_of_runs(window_codes) | starts_of_runs(window_starts_ms)
+			)
+			run_ends = np.append(run_starts[1:], len(order))
+		else:
+			# a batch of late trades only
+			run_starts = run_ends = np.empty(0, dtype=np.intp)
+		window_codes = window_codes[run_starts]
+		window_starts_ms = window_starts_ms[run_starts]
+		sorted_prices = prices[order]
+		sorted_qtys = qtys[order]
+		opens = sorted_prices[run_starts]
+		closes = sorted_prices[run_ends - 1]
+		if len(order):
+			highs = np.maximum.reduceat(sorted_prices, run_starts)
+			lows = np.minimum.reduceat(sorted_prices, run_starts)
+		else:
+			highs = lows = np.empty(0)
+
+		# only the first window of a symbol can continue its open candle
+		continues = self._start_ms[window_codes] == window_starts_ms
+		continued_codes = window_codes[continues]
+		opens[continues] = self._open[continued_codes]
+		highs[continues] = np.maximum(highs[continues], self._high[continued_codes])
+		lows[continues] = np.minimum(lows[continues], self._low[continued_codes])
+		volumes = sequential_sums(
+			sorted_qtys,
+			run_starts,
+			run_ends,
+			initial=np.where(continues, self._volume[window_codes], 0.0),
+		)
+		run_stats = {}
+		if self._stats:
+			run_stats = self._get_run_stats(
+				order,
+				run_starts,
+				run_ends,
+				window_codes,
+				continues,
+				timestamps_ms,
+				prices,
+				qtys,
+				sides,
+				volumes,
+				closes,
+			)
+
+		window_key_indexes = np.searchsorted(batch_codes, window_codes)
+		is_closed = window_starts_ms + window_ms <= closed_until_ms[window_key_indexes]
+		# open candles from earlier batches closed without a continuation
+		state_starts_ms = self._start_ms[batch_codes]
+		is_state_closed = (
+			(state_starts_ms != NO_WINDOW)
+			& (state_starts_ms + window_ms <= closed_until_ms)
+			& ~np.isin(batch_codes, continued_codes)
+		)
+		state_codes = batch_codes[is_state_closed]
+
+		closed_codes = np.concatenate((state_codes, window_codes[is_closed]))
+		candles = {
+			"start_ms": np.concatenate(
+				(state_starts_ms[is_state_closed], window_starts_ms[is_closed])
+			),
+			"open": np.concatenate((self._open[state_codes], opens[is_closed])),
+			"high": np.concatenate((self._high[state_codes], highs[is_closed])),
+			"low": np.concatenate((self._low[state_codes], lows[is_closed])),
+			"close": np.concatenate((self._close[state_codes], closes[is_closed])),
+			"volume": np.concatenate((self._volume[state_codes], volumes[is_closed])),
+		}
+		for field, column in self._stats.items():
+			candles[field] = np.concatenate(
+				(column[state_codes], run_stats[field][is_closed])
+			)
+		closed_order = np.lexsort(
+			(
+				first_seen[np.searchsorted(batch_codes, closed_codes)],
+				candles["start_ms"],
+			)
+		)
+
+		# the windows left open are the last ones of their symbols
+		self._start_ms[closed_codes] = NO_WINDOW
+		is_open = ~is_closed
+		open_codes = window_codes[is_open]
+		self._start_ms[open_codes] = window_starts_ms[is_open]
+		self._open[open_codes] = opens[is_open]
+		self._high[open_codes] = highs[is_open]
+		self._low[open_codes] = lows[is_open]
+		self._close[open_codes] = closes[is_open]
+		self._volume[open_codes] = volumes[is_open]
+		for field, column in self._stats.items():
+			column[open_codes] = run_stats[field][is_open]
+
+		symbols = self.symbols
+		columns = [values[closed_order].tolist() for values in candles.values()]
+		if self._stats:
+			fields = list(candles)[1:]
+			return [
+				{
+					"symbol": symbols[code],
+					"timestamp_ms": start_ms + window_ms,
+					**dict(zip(fields, values)),
+				}
+				for code, start_ms, *values in zip(
+					closed_codes[closed_order].tolist(), *columns
+				)
+			]
+		return [
+			{
+				"symbol": symbols[code],
+				"timestamp_ms": start_ms + window_ms,
+				"open": open_,
+				"high": high,
+				"low": low,
+				"close": close,
+				"volume": volume,
+			}
+			for code, start_ms, open_, high, low, close, volume in zip(
+				closed_codes[closed_order].tolist(), *columns
+			)
+		]
+
+	def _classify_sides(
+		self,
+		prices: np.ndarray,
+		reported_sides: np.ndarray | None,
+		order: np.ndarray,
+		first_trades: np.ndarray,
+		last_trades: np.ndarray,
+		batch_codes: np.ndarray,
+	) -> np.ndarray:
+		"""
+		The reported sides of the trades, or else by the tick rule, following the
+		earlier batches.
+		"""
+		sorted_prices = prices[order]
+		sorted_sides = classify_sides(
+			sorted_prices,
+			first_trades,
+			self._latest_price[batch_codes],
+			self._latest_side[batch_codes],
+			None if reported_sides is None else reported_sides[order],
+		)
+		self._latest_price[batch_codes] = sorted_prices[last_trades]
+		self._latest_side[batch_codes] = sorted_sides[last_trades]
+		sides = np.empty_like(sorted_sides)
+		sides[order] = sorted_sides
+		return sides
+
+	def _get_run_stats(
+		self,
+		order: np.ndarray,
+		run_starts: np.ndarray,
+		run_ends: np.ndarray,
+		window_codes: np.ndarray,
+		continues: np.ndarray,
+		timestamps_ms: np.ndarray,
+		prices: np.ndarray,
+		qtys: np.ndarray,
+		sides: np.ndarray | None,
+		volumes: np.ndarray,
+		closes: np.ndarray,
+	) -> dict[str, np.ndarray]:
+		"""
+		The statistics of the runs of trades of a symbol and window, continuing
+		the open candles, as `app.candle_stats.update_candle_stats` adds them up.
+		"""
+		stats = {}
+		initial = {
+			field: np.where(continues, column[window_codes], 0)
+			for field, column in self._stats.items()
+		}
+		if "notional" in self._stats:
+			notional = sequential_sums(
+				(prices * qtys)[order], run_starts, run_ends, initial["notional"]
+			)
+			stats["notional"] = notional
+			stats["vwap"] = get_vwaps(notional, volumes, closes)
+		if "trade_count" in self._stats:
+			stats["trade_count"] = run_ends - run_starts + initial["trade_count"]
+		if "buy_volume" in self._stats:
+			sorted_qtys = qtys[order]
+			sorted_sides = sides[order]
+			stats["buy_volume"] = sequential_sums(
+				np.where(sorted_sides > 0, sorted_qtys, 0.0),
+				run_starts,
+				run_ends,
+				initial["buy_volume"],
+			)
+			stats["sell_volume"] = sequential_sums(
+				np.where(sorted_sides < 0, sorted_qtys, 0.0),
+				run_starts,
+				run_ends,
+				initial["sell_volume"],
+			)
+		if "first_trade_ms" in self._stats:
+			sorted_timestamps_ms = timestamps_ms[order]
+			stats["first_trade_ms"] = np.where(
+				continues,
+				self._stats["first_trade_ms"][window_codes],
+				sorted_timestamps_ms[run_starts],
+			)
+			stats["last_trade_ms"] = sorted_timestamps_ms[run_ends - 1]
+		return stats
+
+	def get_open_candles(self, symbols: Iterable[str]) -> list[dict]:
+		"""
+		The open candles of the symbols, as they would be closed without more trades.
+		"""
+		candles = []
+		for symbol in symbols:
+			index = self._symbol_indexes.get(symbol)
+			if index is None or self._start_ms[index] == NO_WINDOW:
+				continue
+			candles.append(self._get_candle(index))
+		return candles
+
+	def close_windows(self) -> list[dict]:
+		"""
+		Closes the open candles of all symbols whose windows ended by the latest
+		timestamp of the partition, which no later trade can change, and returns
+		them ordered by end time.
+		"""
+		starts_ms = self._start_ms[: len(self.symbols)]
+		indexes = np.flatnonzero(
+			(starts_ms != NO_WINDOW)
+			& (starts_ms + self.window_ms <= self.latest_timestamp_ms)
+		)
+		indexes = indexes[np.argsort(starts_ms[indexes], kind="stable")].tolist()
+		candles = [self._get_candle(index) for index in indexes]
+		self._start_ms[indexes] = NO_WINDOW
+		return candles
+
+	def expire_symbols(self, until_ms: int) -> tuple[list[dict], list[str]]:
+		"""
+		Forgets the symbols without trades after `until_ms`, and returns their
+		open candles, closed and ordered by end time, and the symbols.
+		"""
+		num_symbols = len(self.symbols)
+		is_expired = self._last_trade_ms[:num_symbols] <= until_ms
+		if not is_expired.any():
+			return [], []
+		indexes = np.flatnonzero(is_expired)
+		starts_ms = self._start_ms[indexes]
+		closed_indexes = indexes[starts_ms != NO_WINDOW]
+		closed_indexes = closed_indexes[
+			np.argsort(self._start_ms[closed_indexes], kind="stable")
+		]
+		candles = [self._get_candle(index) for index in closed_indexes.tolist()]
+		symbols = [self.symbols[index] for index in indexes.tolist()]
+
+		# the remaining symbols move up to the first indexes
+		kept_indexes = np.flatnonzero(~is_expired)
+		num_kept = len(kept_indexes)
+		columns = [
+			(self._start_ms, NO_WINDOW),
+			(self._open, 0),
+			(self._high, 0),
+			(self._low, 0),
+			(self._close, 0),
+			(self._volume, 0),
+			*((column, 0) for column in self._stats.values()),
+			(self._latest_price, np.nan),
+			(self._latest_side, 0),
+			(self._last_trade_ms, 0),
+		]
+		for column, empty in columns:
+			column[:num_kept] = column[kept_indexes]
+			column[num_kept:num_symbols] = empty
+		self.symbols = [self.symbols[index] for index in kept_indexes.tolist()]
+		self._symbol_indexes = {symbol: i for i, symbol in enumerate(self.symbols)}
+		return candles, symbols
+
+	def _get_candle(self, index: int) -> dict:
+		return {
+			"symbol": self.symbols[index],
+			"timestamp_ms": int(self._start_ms[index]) + self.window_ms,
+			"open": float(self._open[index]),
+			"high": float(self._high[index]),
+			"low": float(self._low[index]),
+			"close": float(self._close[index]),
+			"volume": float(self._volume[index]),
+			**{field: column[index].item() for field, column in self._stats.items()},
+		}
+
+	def _get_symbol_indexes(self, symbols: Sequence[str]) -> np.ndarray:
+		try:
+			return np.fromiter(
+				map(self._symbol_indexes.__getitem__, symbols),
+				dtype=np.intp,
+				count=len(symbols),
+			)
+		except KeyError:
+			for symbol in dict.fromkeys(symbols):
+				if symbol not in self._symbol_indexes:
+					self._add_symbol(symbol)
+			return self._get_symbol_indexes(symbols)
+
+	def _add_symbol(self, symbol: str) -> int:
+		index = len(self.symbols)
+		if index == len(self._start_ms):
+			self._grow(2 * index)
+		self._symbol_indexes[symbol] = index
+		self.symbols.append(symbol)
+		return index
+
+	def _grow(self, capacity: int) -> None:
+		size = len(self._start_ms)
+		self._start_ms = np.append(
+			self._start_ms, np.full(capacity - size, NO_WINDOW, dtype=np.int64)
+		)
+		for name in ("_open", "_high", "_low", "_close", "_volume"):
+			setattr(
+				self, name, np.append(getattr(self, name), np.zeros(capacity - size))
+			)
+		for field, column in self._stats.items():
+			self._stats[field] = np.append(
+				column, np.zeros(capacity - size, dtype=column.dtype)
+			)
+		self._latest_price = np.append(
+			self._latest_price, np.full(capacity - size, np.nan)
+		)
+		self._latest_side = np.append(
+			self._latest_side, np.zeros(capacity - size, dtype=np.int8)
+		)
+		self._last_trade_ms = np.append(
+			self._last_trade_ms, np.zeros(capacity - size, dtype=np.int64)
+		)
+
+	def to_snapshot(self, symbols: Iterable[str] | None = None) -> dict:
+		"""
+		The latest timestamp, the open candles with their statistics,
+		the latest trades of the tick rule and the timestamps of the latest
+		trades of the symbols, as plain JSON values.
+
+		:param symbols: Symbols whose state to include, by default all of them.
+		"""
+		if symbols is None:
+			symbol_indexes = np.arange(len(self.symbols))
+		else:
+			symbol_indexes = np.array(
+				[
+					self._symbol_indexes[symbol]
+					for symbol in symbols
+					if symbol in self._symbol_indexes
+				],
+				dtype=np.intp,
+			)
+		indexes = symbol_indexes[self._start_ms[symbol_indexes] != NO_WINDOW]
+		columns = zip(
+			self._start_ms[indexes].tolist(),
+			self._open[indexes].tolist(),
+			self._high[indexes].tolist(),
+			self._low[indexes].tolist(),
+			self._close[indexes].tolist(),
+			self._volume[indexes].tolist(),
+			*(column[indexes].tolist() for column in self._stats.values()),
+		)
+		snapshot = {
+			"window_ms": self.window_ms,
+			"latest_timestamp_ms": self.latest_timestamp_ms,
+			"candles": {
+				self.symbols[index]: list(candle)
+				for index, candle in zip(indexes.tolist(), columns)
+			},
+		}
+		snapshot["last_trades_ms"] = {
+			self.symbols[index]: last_trade_ms
+			for index, last_trade_ms in zip(
+				symbol_indexes.tolist(), self._last_trade_ms[symbol_indexes].tolist()
+			)
+		}
+		if self._stats:
+			snapshot["stats_fields"] = list(self._stats)
+		if self._classifies_sides:
+			indexes = symbol_indexes[~np.isnan(self._latest_price[symbol_indexes])]
+			snapshot["latest_trades"] = {
+				self.symbols[index]: [price, side]
+				for index, price, side in zip(
+					indexes.tolist(),
+					self._latest_price[indexes].tolist(),
+					self._latest_side[indexes].tolist(),
+				)
+			}
+		return snapshot
+
+	@classmethod
+	def from_snapshot(
+		cls, snapshot: dict, stats_fields: Sequence[str] | None = None
+	) -> "OhlcvBatchAggregator":
+		"""
+		:param stats_fields: Fields of the statistics of the candles, by default
+			those of the snapshot; the others of the open candles are zero.
+		"""
+		snapshot_stats_fields = snapshot.get("stats_fields", [])
+		if stats_fields is None:
+			stats_fields = snapshot_stats_fields
+		aggregator = cls(
+			window_ms=snapshot["window_ms"],
+			capacity=max(
+				1024, len(snapshot.get("last_trades_ms", snapshot["candles"]))
+			),
+			stats_fields=stats_fields,
+		)
+		aggregator.latest_timestamp_ms = snapshot["latest_timestamp_ms"]
+		for symbol, candle in snapshot["candles"].items():
+			index = aggregator._add_symbol(symbol)
+			(
+				aggregator._start_ms[index],
+				aggregator._open[index],
+				aggregator._high[index],
+				aggregator._low[index],
+				aggregator._close[index],
+				aggregator._volume[index],
+			) = candle[:6]
+			stats = dict(zip(snapshot_stats_fields, candle[6:]))
+			for field, column in aggregator._stats.items():
+				column[index] = stats.get(field, 0)
+		for symbol, (price, side) in snapshot.get("latest_trades", {}).items():
+			index = aggregator._symbol_indexes.get(symbol)
+			if index is None:
+				index = aggregator._add_symbol(symbol)
+			aggregator._latest_price[index] = price
+			aggregator._latest_side[index] = side
+		# the symbols of a snapshot without them were last seen at its latest trade
+		last_trades_ms = snapshot.get("last_trades_ms")
+		if last_trades_ms is None:
+			last_trades_ms = dict.fromkeys(
+				aggregator.symbols, aggregator.latest_timestamp_ms
+			)
+		for symbol, last_trade_ms in last_trades_ms.items():
+			index = aggregator._symbol_indexes.get(symbol)
+			if index is None:
+				index = aggregator._add_symbol(symbol)
+			aggregator._last_trade_ms[index] = last_trade_ms
+		return aggregator
+
+
+def sequential_sums(
+	values: np.ndarray,
+	run_starts: np.ndarray,
+	run_ends: np.ndarray,
+	initial: np.ndarray | None = None,
+) -> np.ndarray:
+	"""
+	Sums every run of values from left to right, as the reducer does, so the
+	floats come out identical; `np.add.reduceat` and `sum` add pairwise.
+	A few long runs are summed one by one with `cumsum`, which adds sequentially,
+	many short runs side by side, one position of all of them per step.
+	"""
+	lengths = run_ends - run_starts
+	sums = values[run_starts]
+	if initial is not None:
+		sums = initial + sums
+	long_runs = np.flatnonzero(lengths > 1)
+	max_length = int(lengths.max(initial=0))
+	if len(long_runs) <= max_length:
+		for i in long_runs.tolist():
+			run_values = values[run_starts[i] : run_ends[i]].copy()
+			run_values[0] = sums[i]
+			sums[i] = np.cumsum(run_values)[-1]
+		return sums
+
+	order = np.argsort(-lengths, kind="stable")
+	positions = run_starts[order]
+	sorted_sums = sums[order]
+	# the runs longer than a position are a prefix of the runs, longest first
+	descending_lengths = -lengths[order]
+	for position in range(1, max_length):
+		num_runs = np.searchsorted(descending_lengths, -position)
+		sorted_sums[:num_runs] += values[positions[:num_runs] + position]
+	sums[order] = sorted_sums
+	return sums
+
+
+def classify_sides(
+	prices: np.ndarray,
+	run_starts: np.ndarray,
+	latest_prices: np.ndarray,
+	latest_sides: np.ndarray,
+	reported_sides: np.ndarray | None = None,
+) -> np.ndarray:
+	"""
+	The sides of runs of trades of one symbol each as app/candle_stats.py
+	classifies them, following the latest price and side before every run,
+	NaN and 0 for a symbol without earlier trades: the reported side, if not 0,
+	or else by the tick rule.
+	"""
+	previous_prices = np.empty_like(prices)
+	previous_prices[1:] = prices[:-1]
+	previous_prices[run_starts] = latest_prices
+	sides = np.nan_to_num(np.sign(prices - previous_prices)).astype(np.int8)
+	sides[run_starts] = np.where(
+		sides[run_starts] != 0, sides[run_starts], latest_sides
+	)
+	if reported_sides is not None:
+		sides = np.where(reported_sides != 0, reported_sides, sides)
+	# a trade at the previous price keeps the side of the previous trade
+	is_first = np.zeros(len(prices), dtype=bool)
+	is_first[run_starts] = True
+	positions = np.arange(len(prices))
+	return sides[np.maximum.accumulate(np.where((sides != 0) | is_first, positions, 0))]
+
+
+def get_vwaps(
+	notional: np.ndarray, volumes: np.ndarray, closes: np.ndarray
+) -> np.ndarray:
+	"""Notional / volume, the close for candles without volume."""
+	vwaps = closes.astype(np.float64)
+	np.divide(notional, volumes, out=vwaps, where=volumes != 0)
+	return vwaps
+
+
+def starts_of_runs(values: np.ndarray) -> np.ndarray:
+	"""True where a value differs from the previous one."""
+	is_start = np.empty(len(values), dtype=bool)
+	if len(values):
+		is_start[0] = True
+		np.not_equal(values[1:], values[:-1], out=is_start[1:])
+	return is_start
+
+
+class SymbolState:
+	"""Dict-backed stand-in for the quixstreams `State` of one symbol."""
+
+	def __init__(
+		self,
+		values: dict[str, Any] | None = None,
+		on_change: Callable[[], None] | None = None,
+	):
+		"""
+		:param on_change: Called when a value is set or deleted, as the values
+			are only changed through `set`, like those of the state store.
+		"""
+		self.values = values if values is not None else {}
+		self._on_change = on_change
+
+	def get(self, key: str, default: Any = None) -> Any:
+		return self.values.get(key, default)
+
+	def set(self, key: str, value: Any) -> None:
+		self.values[key] = value
+		if self._on_change is not None:
+			self._on_change()
+
+	def delete(self, key: str) -> None:
+		self.values.pop(key, None)
+		if self._on_change is not None:
+			self._on_change()
+
+	def exists(self, key: str) -> bool:
+		return key in self.values
+
+
+class PartitionState:
+	"""
+	Aggregation state of one partition: the open candles of the smallest window,
+	the rolled up candles of the larger ones by symbol, the trades held back for
+	the grace period, and the offset of the last aggregated trade.
+	"""
+
+	def __init__(
+		self,
+		aggregator: OhlcvBatchAggregator,
+		symbol_states: dict[str, dict] | None = None,
+		offset: int | None = None,
+		reorder_buffer: TradesReorderBuffer | None = None,
+		version: int = 0,
+	):
+		self.aggregator = aggregator
+		# symbols whose state changed since the last `pop_changed_symbols`
+		self._changed_symbols: set[str] = set()
+		self.symbol_states = {
+			symbol: self._get_new_symbol_state(symbol, values)
+			for symbol, values in (symbol_states or {}).items()
+		}
+		self.offset = offset
+		self.reorder_buffer = reorder_buffer
+		# number of the saved state, committed along with the offset
+		self.version = version
+		# size of the saved state
+		self.state_bytes = 0
+		# expired since the last stats
+		self.expired_symbols = 0
+
+	def aggregate(self, trades: list[dict]) -> list[dict]:
+		"""
+		Aggregates trades, released by the reorder buffer if any, and returns
+		the candles they closed.
+		"""
+		aggregator = self.aggregator
+		symbols = [trade["symbol"] for trade in trades]
+		self._changed_symbols.update(symbols)
+		candles = aggregator.aggregate(
+			symbols=symbols,
+			timestamps_ms=[trade["timestamp_ms"] for trade in trades],
+			prices=[trade["price"] for trade in trades],
+			qtys=[trade["qty"] for trade in trades],
+			# trades of sources without sides have none
+			sides=(
+				[trade.get("side", 0) for trade in trades]
+				if aggregator._classifies_sides
+				else None
+			),
+		)
+		if self.reorder_buffer is not None:
+			# no trade before the watermark is left to aggregate
+			aggregator.latest_timestamp_ms = max(
+				aggregator.latest_timestamp_ms, self.reorder_buffer.watermark_ms
+			)
+		return candles
+
+	def close_windows(self) -> list[dict]:
+		"""See `OhlcvBatchAggregator.close_windows`."""
+		candles = self.aggregator.close_windows()
+		self._changed_symbols.update(candle["symbol"] for candle in candles)
+		return candles
+
+	def advance_clock(self, timestamp_ms: int) -> bool:
+		"""
+		Moves the latest timestamp of the partition up to a wall clock time,
+		returns whether it moved.
+		"""
+		clock = self.reorder_buffer or self.aggregator
+		if self.reorder_buffer is not None and self.reorder_buffer.is_restoring:
+			# the held back trades are restored against the saved watermark
+			return False
+		if timestamp_ms <= clock.latest_timestamp_ms:
+			return False
+		clock.latest_timestamp_ms = timestamp_ms
+		return True
+
+	def expire_symbols(self, ttl_ms: int) -> tuple[list[dict], list[str]]:
+		"""
+		Forgets the symbols of the aggregator without trades for `ttl_ms` before
+		the latest timestamp, and returns their last candles and the symbols,
+		whose states are to be flushed and deleted with `delete_symbol_states`.
+		"""
+		aggregator = self.aggregator
+		candles, symbols = aggregator.expire_symbols(
+			aggregator.latest_timestamp_ms - ttl_ms
+		)
+		self.expired_symbols += len(symbols)
+		self._changed_symbols.update(symbols)
+		return candles, symbols
+
+	@property
+	def resume_offset(self) -> int | None:
+		"""
+		The offset to consume from: the one after the last aggregated trade, or
+		that of the oldest trade held back by the reorder buffer, taken in again.
+		"""
+		if self.offset is None:
+			return None
+		offset = self.offset + 1
+		if self.reorder_buffer is not None:
+			oldest_offset = self.reorder_buffer.oldest_offset
+			if oldest_offset is not None:
+				offset = min(offset, oldest_offset)
+		return offset
+
+	def delete_symbol_states(self, symbols: Iterable[str]) -> None:
+		for symbol in symbols:
+			if self.symbol_states.pop(symbol, None) is not None:
+				self._changed_symbols.add(symbol)
+
+	def pop_changed_symbols(self) -> set[str]:
+		"""
+		The symbols whose open candle, latest trade or state changed since
+		the last call.
+		"""
+		# the states of the symbols add to this set
+		symbols = set(self._changed_symbols)
+		self._changed_symbols.clear()
+		return symbols
+
+	def stats(self) -> str:
+		"""The lateness and state size metrics, the counts since the last stats."""
+		aggregator = self.aggregator
+		late_trades = aggregator.late_trades
+		aggregator.late_trades = 0
+		stats = (
+			f"open_windows={aggregator.num_open_windows} "
+			f"symbols={len(aggregator.symbols)} "
+			f"symbol_states={len(self.symbol_states)} "
+			f"expired_symbols={self.expired_symbols} "
+			f"state_bytes={self.state_bytes}"
+		)
+		self.expired_symbols = 0
+		if self.reorder_buffer is not None:
+			late_trades += self.reorder_buffer.late_trades
+			self.reorder_buffer.late_trades = 0
+			stats += f" buffered_trades={len(self.reorder_buffer)}"
+		return f"late_trades={late_trades} {stats}"
+
+	def get_symbol_state(self, symbol: str) -> SymbolState:
+		state = self.symbol_states.get(symbol)
+		if state is None:
+			state = self.symbol_states[symbol] = self._get_new_symbol_state(symbol)
+		return state
+
+	def _get_new_symbol_state(
+		self, symbol: str, values: dict[str, Any] | None = None
+	) -> SymbolState:
+		return SymbolState(values, functools.partial(self._changed_symbols.add, symbol))
+
+	def to_snapshot(self, symbols: Iterable[str] | None = None) -> dict:
+		"""
+		:param symbols: Symbols whose state to include, listed in the snapshot
+			as "symbols", by default all of them; see `apply_snapshot_changes`.
+		"""
+		if symbols is None:
+			symbol_states = self.symbol_states
+		else:
+			symbols = list(symbols)
+			symbol_states = {
+				symbol: self.symbol_states[symbol]
+				for symbol in symbols
+				if symbol in self.symbol_states
+			}
+		snapshot = {
+			"offset": self.offset,
+			"version": self.version,
+			"aggregator": self.aggregator.to_snapshot(symbols),
+			"symbol_states": {
+				symbol: state.values
+				for symbol, state in symbol_states.items()
+				if state.values
+			},
+		}
+		if symbols is not None:
+			snapshot["symbols"] = symbols
+		if self.reorder_buffer is not None:
+			snapshot["reorder_buffer"] = self.reorder_buffer.to_snapshot()
+		return snapshot
+
+	@classmethod
+	def from_snapshot(
+		cls,
+		snapshot: dict,
+		stats_fields: Sequence[str] | None = None,
+		grace_ms: int = 0,
+	) -> "PartitionState":
+		"""
+		:param grace_ms: Grace period of the windows, the trades held back
+			for a former one are released by it.
+		"""
+		aggregator = OhlcvBatchAggregator.from_snapshot(
+			snapshot["aggregator"], stats_fields
+		)
+		reorder_buffer = None
+		if snapshot.get("reorder_buffer"):
+			reorder_buffer = TradesReorderBuffer.from_snapshot(
+				snapshot["reorder_buffer"], grace_ms
+			)
+		elif grace_ms:
+			reorder_buffer = TradesReorderBuffer(
+				aggregator.window_ms, grace_ms, aggregator.latest_timestamp_ms
+			)
+		return cls(
+			aggregator=aggregator,
+			symbol_states=snapshot["symbol_states"],
+			offset=snapshot["offset"],
+			reorder_buffer=reorder_buffer,
+			version=snapshot.get("version", 0),
+		)
+
+
+def apply_snapshot_changes(snapshot: dict, changes: dict) -> dict:
+	"""
+	Updates a snapshot of `PartitionState.to_snapshot` in place with one of
+	the changed symbols only, whose states replace those of the snapshot.
+	"""
+	symbols = changes["symbols"]
+	for state, changed_state, symbol_keys in (
+		(snapshot, changes, {"symbol_states"}),
+		(
+			snapshot["aggregator"],
+			changes["aggregator"],
+			{"candles", "last_trades_ms", "latest_trades"},
+		),
+	):
+		for key, value in changed_state.items():
+			if key in symbol_keys:
+				values = state.setdefault(key, {})
+				for symbol in symbols:
+					values.pop(symbol, None)
+				values.update(value)
+			elif key not in ("symbols", "aggregator"):
+				state[key] = value
+	if "reorder_buffer" not in changes:
+		snapshot.pop("reorder_buffer", None)
+	return snapshot
+
+
+class PartitionSnapshots:
+	"""
+	Saves the state of every partition to a JSON Lines file: the whole state,
+	then the changes of every batch, the state of its changed symbols only,
+	appended. Once the changes outgrow the state, it is written whole to a new
+	file, replaced atomically.
+
+	With `keep_previous` the file it replaces is kept, for the state saved
+	before a transaction that failed.
+	"""
+
+	def __init__(
+		self,
+		state_dir: str | Path,
+		keep_previous: bool = False,
+		compaction_ratio: float = 1.0,
+	):
+		"""
+		:param compaction_ratio: Size of the changes appended to the state of
+			a partition, relative to its size, from which it is written whole.
+		"""
+		self._state_dir = Path(state_dir)
+		self._keep_previous = keep_previous
+		self._compaction_ratio = compaction_ratio
+		# sizes of the whole state and of the changes in the file of a partition
+		self._sizes: dict[tuple[str, int], tuple[int, int]] = {}
+
+	def _get_path(self, topic: str, partition: int, previous: bool = False) -> Path:
+		suffix = ".previous" if previous else ""
+		return self._state_dir / f"{topic}_{partition}{suffix}.jsonl"
+
+	def load(
+		self, topic: str, partition: int, version: int | None = None
+	) -> dict | None:
+		"""
+		The state is written whole again, without the changes after it.
+
+		:param version: Version of the state to load, the latest one or the one
+			before it, None for the latest one.
+		"""
+		snapshots = [
+			self._read_snapshots(path)
+			for path in (
+				self._get_path(topic, partition),
+				self._get_path(topic, partition, previous=True),
+			)
+			if path.exists()
+		]
+		snapshots = [file_snapshots for file_snapshots in snapshots if file_snapshots]
+		if not snapshots:
+			return None
+		selected = snapshots[0]
+		if version is not None:
+			for file_snapshots in snapshots:
+				versions = [snapshot.get("version", 0) for snapshot in file_snapshots]
+				if version in versions:
+					# the changes after it, of a transaction that failed, are dropped
+					end = len(versions) - versions[::-1].index(version)
+					selected = file_snapshots[:end]
+					break
+		snapshot = selected[0]
+		for changes in selected[1:]:
+			snapshot = apply_snapshot_changes(snapshot, changes)
+		self._write_snapshot(topic, partition, snapshot)
+		return snapshot
+
+	def save(self, topic: str, partition: int, state: PartitionState) -> int:
+		"""
+		Saves the changes of the state since it was last saved, or the whole
+		state, and returns the size of the saved state.
+		"""
+		symbols = state.pop_changed_symbols()
+		state_bytes, changes_bytes = self._sizes.get((topic, partition), (0, 0))
+		if not state_bytes or changes_bytes >= self._compaction_ratio * state_bytes:
+			return self._write_snapshot(topic, partition, state.to_snapshot())
+		data = self._dumps(state.to_snapshot(symbols))
+		with self._get_path(topic, partition).open("ab") as file:
+			file.write(data)
+		changes_bytes += len(data)
+		self._sizes[(topic, partition)] = (state_bytes, changes_bytes)
+		return state_bytes + changes_bytes
+
+	def _write_snapshot(self, topic: str, partition: int, snapshot: dict) -> int:
+		path = self._get_path(topic, partition)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		if self._keep_previous and path.exists():
+			os.replace(path, self._get_path(topic, partition, previous=True))
+		tmp_path = path.with_suffix(".tmp")
+		data = self._dumps(snapshot)
+		tmp_path.write_bytes(data)
+		os.replace(tmp_path, path)
+		self._sizes[(topic, partition)] = (len(data), 0)
+		return len(data)
+
+	@staticmethod
+	def _read_snapshots(path: Path) -> list[dict]:
+		"""The whole state and the changes saved to a file, in order."""
+		snapshots = []
+		for line in path.read_bytes().splitlines():
+			try:
+				snapshots.append(json_loads(line))
+			except ValueError:
+				# changes cut short by a crash while they were appended
+				break
+		return snapshots
+
+	@staticmethod
+	def _dumps(snapshot: dict) -> bytes:
+		data = json_dumps(snapshot)
+		return (data if isinstance(data, bytes) else data.encode()) + b"\n"
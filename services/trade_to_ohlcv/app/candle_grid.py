@@ -0,0 +1,100 @@
+"""
+Dense candle grid: one candle per symbol and window, without gaps.
+
+A window without trades gets a flat candle at the previous close with zero
+volume, and every candle opens at the close of the previous one, its high and
+low stretched to include that open. The candles of a symbol can then be looked
+up by `timestamp_ms` arithmetic instead of being reindexed and forward filled.
+
+The grid of a symbol starts with its first candle. Gaps between two candles
+are filled when the later one is finalized; the trailing gap of a symbol that
+stopped trading is filled up to the latest timestamp of its partition by
+`fill_gaps_until`, in the batch aggregation mode.
+"""
+
+from typing import Callable
+
+from quixstreams import State
+
+from app.candle_stats import get_empty_stats
+
+# end and close of the latest candle of a symbol
+GRID_STATE_KEY = "grid"
+
+
+def seed_open(candle: dict, close: float) -> dict:
+	"""The candle opening at the previous close."""
+	return {
+		**candle,
+		"open": close,
+		"high": max(candle["high"], close),
+		"low": min(candle["low"], close),
+	}
+
+
+def fill_ohlcv_gaps(window_ms: int, stats_fields: list[str] | None = None) -> Callable:
+	"""
+	Returns the stateful function turning a finalized candle of `window_ms`
+	into the flat candles of the windows without trades before it, followed by
+	the candle opening at the previous close.
+	The flat candles have the `stats_fields` of a candle without trades.
+	"""
+	stats_fields = stats_fields or []
+
+	def fill_gaps(candle: dict, state: State) -> list[dict]:
+		latest = state.get(GRID_STATE_KEY)
+		if latest is None:
+			candles = [candle]
+		else:
+			candles = _get_flat_candles(
+				candle["symbol"],
+				latest,
+				window_ms,
+				candle["timestamp_ms"] - window_ms,
+				stats_fields,
+			)
+			candles.append(seed_open(candle, latest["close"]))
+		state.set(
+			GRID_STATE_KEY,
+			{"timestamp_ms": candle["timestamp_ms"], "close": candle["close"]},
+		)
+		return candles
+
+	return fill_gaps
+
+
+def fill_gaps_until(
+	symbol: str,
+	state: State,
+	window_ms: int,
+	end_ms: int,
+	stats_fields: list[str] | None = None,
+) -> list[dict]:
+	"""The flat candles of a symbol without trades up to the window ending at `end_ms`."""
+	latest = state.get(GRID_STATE_KEY)
+	if latest is None or latest["timestamp_ms"] >= end_ms:
+		return []
+	state.set(GRID_STATE_KEY, {"timestamp_ms": end_ms, "close": latest["close"]})
+	return _get_flat_candles(symbol, latest, window_ms, end_ms, stats_fields or [])
+
+
+def _get_flat_candles(
+	symbol: str, latest: dict, window_ms: int, end_ms: int, stats_fields: list[str]
+) -> list[dict]:
+	close = latest["close"]
+	stats = get_empty_stats(stats_fields, close)
+	return [
+		{
+			"symbol": symbol,
+			"timestamp_ms": timestamp_ms,
+			"open": close,
+			"high": close,
+			"low": close,
+			"close": close,
+			"volume": 0.0,
+			**stats,
+		}
+		for timestamp_ms in range(
+			latest["timestamp_ms"] + window_ms, end_ms + 1, window_ms
+		)
+	]
@@ -0,0 +1,138 @@
+"""
+Microstructure statistics of the candles, accumulated in the same pass over the
+trades as OHLCV and rolled up with the candles.
+
+The statistics are opt-in by group, so the default candles and their cost stay
+the same:
+- vwap: `notional`, the sum of price * qty, and `vwap`, notional / volume
+- trade_count: `trade_count`
+- buy_sell_volume: `buy_volume` and `sell_volume`, by the aggressor side the
+  exchange reported. Trades without one, e.g. those of sources without sides,
+  are classified by the tick rule: a trade above the previous price of its
+  symbol is a buy, below it a sell, and at the same price it keeps the side of
+  the previous trade. The first trades of a symbol are neither.
+- trade_timestamps: `first_trade_ms` and `last_trade_ms`, in consumed order
+
+A candle without trades, e.g. a flat candle of the grid, has zero statistics
+and its close as vwap.
+"""
+
+from quixstreams import State
+
+EXTRA_STATS = {
+	"vwap": ("notional", "vwap"),
+	"trade_count": ("trade_count",),
+	"buy_sell_volume": ("buy_volume", "sell_volume"),
+	"trade_timestamps": ("first_trade_ms", "last_trade_ms"),
+}
+# fields counting or timing trades, the others are floats
+INTEGER_FIELDS = frozenset(("trade_count", "first_trade_ms", "last_trade_ms"))
+
+# price and side of the latest trade of a symbol
+TICK_STATE_KEY = "tick"
+
+
+def get_stats_fields(extra_stats: list[str]) -> list[str]:
+	"""The candle fields of the statistics, in a fixed order."""
+	unknown = set(extra_stats) - set(EXTRA_STATS)
+	if unknown:
+		raise ValueError(
+			f"Unknown OHLCV statistics {sorted(unknown)}, "
+			f"supported are {list(EXTRA_STATS)}"
+		)
+	return [
+		field
+		for stats, fields in EXTRA_STATS.items()
+		if stats in extra_stats
+		for field in fields
+	]
+
+
+def classify_trade_side(trade: dict, state: State) -> dict:
+	"""
+	The trade with its `side`: 1 buy, -1 sell, 0 unknown, the reported one or
+	else by the tick rule.
+	"""
+	price = trade["price"]
+	side = trade.get("side", 0)
+	if not side:
+		tick = state.get(TICK_STATE_KEY)
+		if tick is not None:
+			latest_price, side = tick
+			if price > latest_price:
+				side = 1
+			elif price < latest_price:
+				side = -1
+	state.set(TICK_STATE_KEY, [price, side])
+	return {**trade, "side": side}
+
+
+def init_candle_stats(trade: dict, fields: frozenset[str]) -> dict:
+	"""The statistics of a candle with its first trade."""
+	stats = {}
+	price = trade["price"]
+	qty = trade["qty"]
+	if "notional" in fields:
+		notional = price * qty
+		stats["notional"] = notional
+		stats["vwap"] = notional / qty if qty else price
+	if "trade_count" in fields:
+		stats["trade_count"] = 1
+	if "buy_volume" in fields:
+		side = trade["side"]
+		stats["buy_volume"] = qty if side > 0 else 0.0
+		stats["sell_volume"] = qty if side < 0 else 0.0
+	if "first_trade_ms" in fields:
+		stats["first_trade_ms"] = trade["timestamp_ms"]
+		stats["last_trade_ms"] = trade["timestamp_ms"]
+	return stats
+
+
+def update_candle_stats(kline: dict, trade: dict, fields: frozenset[str]) -> dict:
+	"""The statistics of a candle with one more trade."""
+	stats = {}
+	price = trade["price"]
+	qty = trade["qty"]
+	if "notional" in fields:
+		notional = kline["notional"] + price * qty
+		volume = kline["volume"] + qty
+		stats["notional"] = notional
+		stats["vwap"] = notional / volume if volume else price
+	if "trade_count" in fields:
+		stats["trade_count"] = kline["trade_count"] + 1
+	if "buy_volume" in fields:
+		side = trade["side"]
+		stats["buy_volume"] = kline["buy_volume"] + (qty if side > 0 else 0.0)
+		stats["sell_volume"] = kline["sell_volume"] + (qty if side < 0 else 0.0)
+	if "first_trade_ms" in fields:
+		stats["first_trade_ms"] = kline["first_trade_ms"]
+		stats["last_trade_ms"] = trade["timestamp_ms"]
+	return stats
+
+
+def merge_candle_stats(kline: dict, candle: dict) -> dict:
+	"""The statistics of a candle followed by the next one, those of `candle`."""
+	stats = {}
+	if "notional" in candle:
+		notional = kline["notional"] + candle["notional"]
+		volume = kline["volume"] + candle["volume"]
+		stats["notional"] = notional
+		stats["vwap"] = notional / volume if volume else candle["close"]
+	if "trade_count" in candle:
+		stats["trade_count"] = kline["trade_count"] + candle["trade_count"]
+	if "buy_volume" in candle:
+		stats["buy_volume"] = kline["buy_volume"] + candle["buy_volume"]
+		stats["sell_volume"] = kline["sell_volume"] + candle["sell_volume"]
+	if "first_trade_ms" in candle:
+		# 0 in candles without trades
+		stats["first_trade_ms"] = kline["first_trade_ms"] or candle["first_trade_ms"]
+		stats["last_trade_ms"] = candle["last_trade_ms"] or kline["last_trade_ms"]
+	return stats
+
+
+def get_empty_stats(fields: list[str], close: float) -> dict:
+	"""The statistics of a candle without trades."""
+	return {
+		field: close if field == "vwap" else 0 if field in INTEGER_FIELDS else 0.0
+		for field in fields
+	}
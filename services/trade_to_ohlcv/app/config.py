@@ -5,6 +5,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
+from quixstreams.models import TopicConfig
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DOTENV_PATH = os.path.join(BASE_DIR, ".env.trades_to_ohlcv")
@@ -17,8 +18,16 @@ def get_kafka_trades_topic_name() -> str:
 		return f"{env_topic}_{os.getenv('BACKFILL_JOB_ID')}"
 	return env_topic
 
-def get_kafka_ohlcv_topic_name() -> str:
+def get_ohlcv_windows_seconds() -> list[int]:
+	# several timeframes from one consumer, e.g. OHLCV_WINDOW_SECONDS=60,300,900,3600
+	windows = os.getenv("OHLCV_WINDOW_SECONDS", "60")
+	return [int(window) for window in windows.split(",") if window.strip()]
+
+def get_kafka_ohlcv_topic_name(window_seconds: int | None = None) -> str:
 	env_topic = os.getenv("KAFKA_OHLCV_TOPIC")
+	if window_seconds is not None:
+		# KAFKA_OHLCV_TOPIC__<SECONDS> routes the candles of a timeframe to its own topic
+		env_topic = os.getenv(f"KAFKA_OHLCV_TOPIC__{window_seconds}", env_topic)
 	if "historical" in env_topic:
 		return f"{env_topic}_{os.getenv('BACKFILL_JOB_ID')}"
 	return env_topic
@@ -38,7 +47,53 @@ class KafkaSettings(BaseModel):
 	)  # earliest, latest, error
 	TRADES_TOPIC: str = get_kafka_trades_topic_name()
 	OHLCV_TOPIC: str = get_kafka_ohlcv_topic_name()
+	WINDOW_OHLCV_TOPICS: dict[int, str] = {
+		window: get_kafka_ohlcv_topic_name(window)
+		for window in get_ohlcv_windows_seconds()
+	}
 	CONSUMER_GROUP: str = get_kafka_consumer_group_name()
+	# in-progress candles with is_final, written in the batch aggregation mode
+	OHLCV_PARTIAL_TOPIC: str | None = os.getenv("KAFKA_OHLCV_PARTIAL_TOPIC")
+	# json or binary, see app/serializers.py
+	OHLCV_TOPIC_FORMAT: str = os.getenv("KAFKA_OHLCV_TOPIC_FORMAT", "json")
+	# candles of FEATURES_WINDOW_SECONDS with their technical indicators
+	FEATURES_TOPIC: str | None = os.getenv("KAFKA_FEATURES_TOPIC")
+	# at-least-once or exactly-once: the candles are written in transactions
+	# committed along with the offsets of the trades and the window state
+	PROCESSING_GUARANTEE: str = os.getenv("KAFKA_PROCESSING_GUARANTEE", "at-least-once")
+	# partitions and replicas of the topics created by the service, 1 when
+	# unset; existing topics are left as they are
+	TOPIC_PARTITIONS: int | None = (
+		int(os.getenv("KAFKA_TOPIC_PARTITIONS"))
+		if os.getenv("KAFKA_TOPIC_PARTITIONS")
+		else None
+	)
+	TOPIC_REPLICATION_FACTOR: int | None = (
+		int(os.getenv("KAFKA_TOPIC_REPLICATION_FACTOR"))
+		if os.getenv("KAFKA_TOPIC_REPLICATION_FACTOR")
+		else None
+	)
+
+	def topic_config(self) -> TopicConfig | None:
+		if not self.TOPIC_PARTITIONS and not self.TOPIC_REPLICATION_FACTOR:
+			return None
+		return TopicConfig(
+			num_partitions=self.TOPIC_PARTITIONS or 1,
+			replication_factor=self.TOPIC_REPLICATION_FACTOR or 1,
+		)
+
+
+class BackfillSettings(BaseModel):
+	# trades files of `python -m app.backfill`, JSON lines or Parquet,
+	# e.g. recorded with TRADES_SOURCE__RECORD_DIR of the trade producer
+	TRADES_PATHS: list[str] = os.getenv("BACKFILL_TRADES_PATHS", "").split(",")
+	# topic or parquet
+	OUTPUT: str = os.getenv("BACKFILL_OUTPUT", "topic")
+	PARQUET_DIR: str = os.getenv(
+		"BACKFILL_PARQUET_DIR", os.path.join(BASE_DIR, "ohlcv")
+	)
+	# the last candle of every symbol, which the streaming path keeps open
+	EMIT_OPEN_WINDOWS: bool = os.getenv("BACKFILL_EMIT_OPEN_WINDOWS", "false") == "true"
 
 
 class Settings(BaseSettings):
@@ -47,8 +102,69 @@ class Settings(BaseSettings):
 	PROJECT_DESCRIPTION: str = "Aggregate trades to OHLCV and save it to Kafka"
 	BASE_DIR: Path = BASE_DIR
 	kafka: KafkaSettings = KafkaSettings()
+	backfill: BackfillSettings = BackfillSettings()
 	LOGGER_NAME: str = "trades_to_ohlcv"
-	OHLCV_WINDOW_SECONDS: int = os.getenv("OHLCV_WINDOW_SECONDS", 60)
+	OHLCV_WINDOWS_SECONDS: list[int] = get_ohlcv_windows_seconds()
+	# stream: quixstreams tumbling window, batch: NumPy micro-batches,
+	# see app/batch_aggregation.py
+	OHLCV_AGGREGATION_MODE: str = os.getenv("OHLCV_AGGREGATION_MODE", "stream")
+	OHLCV_BATCH_SIZE: int = int(os.getenv("OHLCV_BATCH_SIZE", 10_000))
+	OHLCV_BATCH_TIMEOUT_S: float = float(os.getenv("OHLCV_BATCH_TIMEOUT_S", 0.5))
+	# throttling of the partial candles, by trade time and by relative close change
+	OHLCV_PARTIAL_MIN_INTERVAL_MS: int = int(
+		os.getenv("OHLCV_PARTIAL_MIN_INTERVAL_MS", 1000)
+	)
+	OHLCV_PARTIAL_MIN_PRICE_CHANGE: float = float(
+		os.getenv("OHLCV_PARTIAL_MIN_PRICE_CHANGE", 0.0)
+	)
+	# batch aggregation mode and backfill: a dense candle grid, flat candles for
+	# the windows without trades and every candle opening at the previous close,
+	# see app/candle_grid.py
+	OHLCV_FILL_GAPS: bool = os.getenv("OHLCV_FILL_GAPS", "false") == "true"
+	# batch aggregation mode: also close the windows by the wall clock minus
+	# this lag, e.g. 5000, unset to close them by trade time only
+	OHLCV_FILL_GAPS_CLOCK_LAG_MS: int | None = (
+		int(os.getenv("OHLCV_FILL_GAPS_CLOCK_LAG_MS"))
+		if os.getenv("OHLCV_FILL_GAPS_CLOCK_LAG_MS")
+		else None
+	)
+	# statistics added to the candles, e.g. vwap,trade_count,buy_sell_volume,
+	# trade_timestamps, see app/candle_stats.py
+	OHLCV_EXTRA_STATS: list[str] = [
+		stats.strip()
+		for stats in os.getenv("OHLCV_EXTRA_STATS", "").split(",")
+		if stats.strip()
+	]
+	# window of the candles with indicators on KAFKA_FEATURES_TOPIC, unset for
+	# the smallest one, see app/indicators.py
+	FEATURES_WINDOW_SECONDS: int | None = (
+		int(os.getenv("FEATURES_WINDOW_SECONDS"))
+		if os.getenv("FEATURES_WINDOW_SECONDS")
+		else None
+	)
+	# batch aggregation mode: directory of the partition state files, which are
+	# local files, not a changelog topic: all replicas of the consumer group must
+	# mount the same directory, e.g. a shared volume, as a partition moving to
+	# another replica resumes from the state its previous replica saved
+	OHLCV_STATE_DIR: str = os.getenv("OHLCV_STATE_DIR", os.path.join(BASE_DIR, "state"))
+	# batch aggregation mode: resume a partition without its saved state instead
+	# of failing, e.g. the first time, from the offsets of the stream mode
+	OHLCV_ALLOW_STATE_LOSS: bool = (
+		os.getenv("OHLCV_ALLOW_STATE_LOSS", "false") == "true"
+	)
+	# the windows take in late trades until the latest trade timestamp of the
+	# partition passed their end by this grace period, see app/watermarks.py
+	OHLCV_GRACE_MS: int = int(os.getenv("OHLCV_GRACE_MS", 0))
+	# batch aggregation mode: delete the state of the symbols without trades
+	# for this long, at least the largest window plus the grace period, unset
+	# to keep it
+	OHLCV_STATE_TTL_MS: int | None = (
+		int(os.getenv("OHLCV_STATE_TTL_MS"))
+		if os.getenv("OHLCV_STATE_TTL_MS")
+		else None
+	)
+	# interval of the late trades, open windows and state size in the logs
+	OHLCV_STATS_INTERVAL_S: float = float(os.getenv("OHLCV_STATS_INTERVAL_S", 60))
 
 
 settings = Settings()
@@ -0,0 +1,380 @@
+"""
+Technical indicators of the finalized candles, updated incrementally.
+
+The columns are those of `add_technical_indicators` of the price predictor,
+see services/price_predictor/app/feature_engineering.py, computed the way
+TA-Lib computes them over the candles of a symbol: the moving averages keep
+running totals, the smoothed indicators their previous values, and the
+windowed ones the last candles of their window, so a candle is one update
+of constant cost instead of a pass over the whole history.
+
+Fed the same candles from the first one on, the values match TA-Lib up to
+floating point rounding, with NaN before an indicator is warmed up. A state
+started at another candle than the DataFrame matches it once the indicators
+are warmed up, the smoothed ones once the influence of their seed faded out.
+
+The state of a symbol is a JSON-serializable dict, kept in the quixstreams
+state or in the partition state of the batch aggregation mode.
+"""
+
+import math
+
+from quixstreams import State
+
+INDICATOR_COLUMNS = [
+	"sma_7",
+	"sma_14",
+	"sma_28",
+	"ema_7",
+	"ema_14",
+	"ema_28",
+	"macd",
+	"macd_signal",
+	"macd_hist",
+	"bb_upper",
+	"bb_middle",
+	"bb_lower",
+	"stoch_k",
+	"stoch_d",
+	"obv",
+	"atr",
+	"cci",
+	"rsi",
+	"adx",
+	"cmf",
+]
+
+# indicator state of a symbol
+INDICATORS_STATE_KEY = "indicators"
+
+NAN = float("nan")
+
+
+def add_technical_indicators(candle: dict, state: State) -> dict:
+	"""Stateful function adding the indicators of a symbol to its next candle."""
+	indicators_state = state.get(INDICATORS_STATE_KEY) or {}
+	indicators = update_indicators(indicators_state, candle)
+	state.set(INDICATORS_STATE_KEY, indicators_state)
+	return {**candle, **indicators}
+
+
+def update_indicators(state: dict, candle: dict) -> dict:
+	"""Updates the indicator state with the next candle, returns its indicators."""
+	high = candle["high"]
+	low = candle["low"]
+	close = candle["close"]
+	volume = candle["volume"]
+	sma_14 = _sma(state.setdefault("sma_14", {}), close, 14)
+	macd, macd_signal, macd_hist = _macd(state.setdefault("macd", {}), close)
+	bb_upper, bb_lower = _bbands(state.setdefault("bbands", {}), close, sma_14, 14)
+	stoch_k, stoch_d = _stoch(state.setdefault("stoch", {}), high, low, close)
+	return {
+		"sma_7": _sma(state.setdefault("sma_7", {}), close, 7),
+		"sma_14": sma_14,
+		"sma_28": _sma(state.setdefault("sma_28", {}), close, 28),
+		"ema_7": _ema(state.setdefault("ema_7", {}), close, 7),
+		"ema_14": _ema(state.setdefault("ema_14", {}), close, 14),
+		"ema_28": _ema(state.setdefault("ema_28", {}), close, 28),
+		"macd": macd,
+		"macd_signal": macd_signal,
+		"macd_hist": macd_hist,
+		"bb_upper": bb_upper,
+		"bb_middle": sma_14,
+		"bb_lower": bb_lower,
+		"stoch_k": stoch_k,
+		"stoch_d": stoch_d,
+		"obv": _obv(state.setdefault("obv", {}), close, volume),
+		"atr": _atr(state.setdefault("atr", {}), high, low, close, 14),
+		"cci": _cci(state.setdefault("cci", {}), high, low, close, 14),
+		"rsi": _rsi(state.setdefault("rsi", {}), close, 14),
+		"adx": _adx(state.setdefault("adx", {}), high, low, close, 14),
+		"cmf": _adosc(state.setdefault("adosc", {}), high, low, close, volume, 3, 14),
+	}
+
+
+def _is_zero(value: float) -> bool:
+	# TA_IS_ZERO of TA-Lib
+	return -0.00000001 < value < 0.00000001
+
+
+def _sma(state: dict, value: float, period: int) -> float:
+	"""Simple moving average, a running total of the last `period` values."""
+	window = state.setdefault("window", [])
+	window.append(value)
+	total = state.get("total", 0.0) + value
+	if len(window) < period:
+		state["total"] = total
+		return NAN
+	state["total"] = total - window.pop(0)
+	return total / period
+
+
+def _ema(state: dict, value: float, period: int) -> float:
+	"""Exponential moving average, seeded with the mean of the first `period` values."""
+	count = state.get("count", 0) + 1
+	state["count"] = count
+	if count < period:
+		state["total"] = state.get("total", 0.0) + value
+		return NAN
+	if count == period:
+		ema = (state.pop("total", 0.0) + value) / period
+	else:
+		previous = state["ema"]
+		ema = ((value - previous) * (2.0 / (period + 1))) + previous
+	state["ema"] = ema
+	return ema
+
+
+def _macd(
+	state: dict, value: float, fast: int = 12, slow: int = 26, signal: int = 9
+) -> tuple[float, float, float]:
+	"""
+	MACD, its signal and histogram. As in TA-Lib, both averages start with the
+	slow one, the fast one seeded with the mean of the last `fast` of the first
+	`slow` values.
+	"""
+	count = state.get("count", 0) + 1
+	state["count"] = count
+	slow_ema = _ema(state.setdefault("slow", {}), value, slow)
+	if count <= slow - fast:
+		return NAN, NAN, NAN
+	fast_ema = _ema(state.setdefault("fast", {}), value, fast)
+	if count < slow:
+		return NAN, NAN, NAN
+	macd = fast_ema - slow_ema
+	macd_signal = _ema(state.setdefault("signal", {}), macd, signal)
+	if math.isnan(macd_signal):
+		return NAN, NAN, NAN
+	return macd, macd_signal, macd - macd_signal
+
+
+def _bbands(
+	state: dict, value: float, middle: float, period: int, deviations: float = 2.0
+) -> tuple[float, float]:
+	"""
+	Upper and lower Bollinger band around the `middle` SMA of `period`, by the
+	population standard deviation from a running total of the squares.
+	"""
+	window = state.setdefault("window", [])
+	square = value * value
+	window.append(square)
+	total = state.get("total", 0.0) + square
+	if len(window) < period:
+		state["total"] = total
+		return NAN, NAN
+	state["total"] = total - window.pop(0)
+	variance = total / period - middle * middle
+	stddev = math.sqrt(variance) if variance >= 0.00000001 else 0.0
+	return middle + stddev * deviations, middle - stddev * deviations
+
+
+def _stoch(
+	state: dict,
+	high: float,
+	low: float,
+	close: float,
+	fastk_period: int = 14,
+	slowk_period: int = 3,
+	slowd_period: int = 3,
+) -> tuple[float, float]:
+	"""Slow stochastic %K and %D, SMAs of the fast %K over the last highs and lows."""
+	highs = state.setdefault("highs", [])
+	lows = state.setdefault("lows", [])
+	highs.append(high)
+	lows.append(low)
+	if len(highs) < fastk_period:
+		return NAN, NAN
+	highest = max(highs)
+	lowest = min(lows)
+	del highs[0], lows[0]
+	diff = (highest - lowest) / 100.0
+	fast_k = (close - lowest) / diff if diff != 0.0 else 0.0
+	slow_k = _sma(state.setdefault("slow_k", {}), fast_k, slowk_period)
+	if math.isnan(slow_k):
+		return NAN, NAN
+	slow_d = _sma(state.setdefault("slow_d", {}), slow_k, slowd_period)
+	if math.isnan(slow_d):
+		return NAN, NAN
+	return slow_k, slow_d
+
+
+def _obv(state: dict, close: float, volume: float) -> float:
+	"""On balance volume, starting at the volume of the first candle."""
+	previous_close = state.get("close")
+	obv = state.get("obv", volume)
+	if previous_close is not None:
+		if close > previous_close:
+			obv += volume
+		elif close < previous_close:
+			obv -= volume
+	state["close"] = close
+	state["obv"] = obv
+	return obv
+
+
+def _true_range(high: float, low: float, previous_close: float) -> float:
+	return max(high - low, abs(high - previous_close), abs(low - previous_close))
+
+
+def _atr(state: dict, high: float, low: float, close: float, period: int) -> float:
+	"""Average true range, Wilder's smoothing seeded with the mean of `period`."""
+	previous_close = state.get("close")
+	state["close"] = close
+	if previous_close is None:
+		return NAN
+	true_range = _true_range(high, low, previous_close)
+	atr = state.get("atr")
+	if atr is None:
+		# the mean of the first true ranges, the SMA of TA-Lib
+		atr = _sma(state.setdefault("sma", {}), true_range, period)
+		if math.isnan(atr):
+			return NAN
+		del state["sma"]
+	else:
+		atr = (atr * (period - 1) + true_range) / period
+	state["atr"] = atr
+	return atr
+
+
+def _cci(state: dict, high: float, low: float, close: float, period: int) -> float:
+	"""
+	Commodity channel index over the typical prices of the last `period` candles,
+	kept in a circular buffer summed in its slot order as TA-Lib does.
+	"""
+	count = state.get("count", 0)
+	state["count"] = count + 1
+	typical_price = (high + low + close) / 3
+	prices = state.setdefault("prices", [0.0] * period)
+	prices[count % period] = typical_price
+	if count < period - 1:
+		return NAN
+	average = 0.0
+	for price in prices:
+		average += price
+	average /= period
+	deviation = 0.0
+	for price in prices:
+		deviation += abs(price - average)
+	deviation /= period
+	difference = typical_price - average
+	# on a flat window both are rounding noise, zero as for TA-Lib
+	if not _is_zero(difference) and not _is_zero(deviation):
+		return difference / (0.015 * deviation)
+	return 0.0
+
+
+def _rsi(state: dict, close: float, period: int) -> float:
+	"""Relative strength index, Wilder's averages of the gains and losses."""
+	previous_close = state.get("close")
+	state["close"] = close
+	if previous_close is None:
+		return NAN
+	change = close - previous_close
+	count = state.get("count", 0) + 1
+	state["count"] = count
+	gain = state.get("gain", 0.0)
+	loss = state.get("loss", 0.0)
+	if count > period:
+		gain *= period - 1
+		loss *= period - 1
+	if change < 0:
+		loss -= change
+	else:
+		gain += change
+	if count >= period:
+		gain /= period
+		loss /= period
+	state["gain"] = gain
+	state["loss"] = loss
+	if count < period:
+		return NAN
+	total = gain + loss
+	return 100.0 * (gain / total) if not _is_zero(total) else 0.0
+
+
+def _adx(state: dict, high: float, low: float, close: float, period: int) -> float:
+	"""
+	Average directional movement index: Wilder's sums of the directional
+	movements and true ranges, the first ADX the mean of `period` DX.
+	"""
+	count = state.get("count", 0)
+	state["count"] = count + 1
+	if count == 0:
+		state.update(high=high, low=low, close=close, plus_dm=0.0, minus_dm=0.0, tr=0.0)
+		return NAN
+	diff_plus = high - state["high"]
+	diff_minus = state["low"] - low
+	plus_dm = state["plus_dm"]
+	minus_dm = state["minus_dm"]
+	tr = state["tr"]
+	if count >= period:
+		minus_dm -= minus_dm / period
+		plus_dm -= plus_dm / period
+	if diff_minus > 0 and diff_plus < diff_minus:
+		minus_dm += diff_minus
+	elif diff_plus > 0 and diff_plus > diff_minus:
+		plus_dm += diff_plus
+	true_range = _true_range(high, low, state["close"])
+	if count >= period:
+		tr = tr - (tr / period) + true_range
+	else:
+		tr += true_range
+	state.update(
+		high=high, low=low, close=close, plus_dm=plus_dm, minus_dm=minus_dm, tr=tr
+	)
+	if count < period:
+		return NAN
+	dx = None
+	if not _is_zero(tr):
+		minus_di = 100.0 * (minus_dm / tr)
+		plus_di = 100.0 * (plus_dm / tr)
+		total = minus_di + plus_di
+		if not _is_zero(total):
+			dx = 100.0 * (abs(minus_di - plus_di) / total)
+	if count < 2 * period - 1:
+		if dx is not None:
+			state["dx_total"] = state.get("dx_total", 0.0) + dx
+		return NAN
+	adx = state.get("adx")
+	if adx is None:
+		if dx is not None:
+			state["dx_total"] = state.get("dx_total", 0.0) + dx
+		adx = state.pop("dx_total", 0.0) / period
+	elif dx is not None:
+		adx = ((adx * (period - 1)) + dx) / period
+	state["adx"] = adx
+	return adx
+
+
+def _adosc(
+	state: dict,
+	high: float,
+	low: float,
+	close: float,
+	volume: float,
+	fast: int,
+	slow: int,
+) -> float:
+	"""
+	Chaikin A/D oscillator: the fast minus the slow EMA of the accumulation
+	distribution line, both seeded with its first value.
+	"""
+	ad = state.get("ad", 0.0)
+	high_low = high - low
+	if high_low > 0.0:
+		ad += (((close - low) - (high - close)) / high_low) * volume
+	state["ad"] = ad
+	count = state.get("count", 0) + 1
+	state["count"] = count
+	if count == 1:
+		fast_ema = slow_ema = ad
+	else:
+		fast_k = 2.0 / (fast + 1)
+		slow_k = 2.0 / (slow + 1)
+		fast_ema = (fast_k * ad) + ((1.0 - fast_k) * state["fast"])
+		slow_ema = (slow_k * ad) + ((1.0 - slow_k) * state["slow"])
+	state["fast"] = fast_ema
+	state["slow"] = slow_ema
+	if count < max(fast, slow):
+		return NAN
+	return fast_ema - slow_ema
@@ -1,17 +1,57 @@
+import collections
+import signal
+import time
 from datetime import timedelta
+from pathlib import Path
+from typing import Callable
 
 import structlog
-from quixstreams import Application
+from confluent_kafka import TopicPartition
+from quixstreams import Application, State
+from quixstreams.dataframe import StreamingDataFrame
+from quixstreams.kafka import Consumer, Producer
+from quixstreams.kafka.producer import TransactionalProducer
+from quixstreams.models import Topic, TopicConfig
 
 from dataclasses import dataclass
 
+from app.batch_aggregation import (
+	OhlcvBatchAggregator,
+	PartitionSnapshots,
+	PartitionState,
+)
+from app.candle_grid import fill_gaps_until, fill_ohlcv_gaps
+from app.candle_stats import (
+	classify_trade_side,
+	get_stats_fields,
+	init_candle_stats,
+	update_candle_stats,
+)
 from app.config import settings
-
-# TODO: make kline open price as the last price of previous kline
-
+from app.indicators import INDICATOR_COLUMNS, add_technical_indicators
+from app.partial_candles import (
+	PartialCandles,
+	merge_ohlcv_candles,
+	roll_up_state_key,
+)
+from app.serializers import (
+	OHLCV_FEATURES_V1,
+	OHLCV_PARTIAL_STATS_V1,
+	OHLCV_PARTIAL_V1,
+	OHLCV_STATS_V1,
+	OHLCV_STATS_V2,
+	OHLCV_V1,
+	OHLCV_V2,
+	BinaryDeserializer,
+	decode_record,
+	get_value_serializer,
+)
+from app.watermarks import TradesReorderBuffer, WindowStateMetrics
 
 logger = structlog.get_logger(settings.LOGGER_NAME)
 
+OHLCV_COLUMNS = ["symbol", "timestamp_ms", "open", "high", "low", "close", "volume"]
+
 
 @dataclass
 class KafkaOptions:
@@ -20,6 +60,16 @@ class KafkaOptions:
 	output_topic: str | None
 	consumer_group: str
 	auto_offset_reset: str
+	output_topic_format: str = "json"  # json or binary
+	# per timeframe output topics, the others go to output_topic
+	window_output_topics: dict[int, str] | None = None
+	# in-progress candles of all timeframes, only in the batch aggregation mode
+	partial_output_topic: str | None = None
+	# candles of one timeframe with their technical indicators
+	features_output_topic: str | None = None
+	# partitions and replicas of the topics created by the service
+	topic_config: TopicConfig | None = None
+	processing_guarantee: str = "at-least-once"  # or exactly-once
 
 def _custom_ts_extractor(
 		trade: dict,
@@ -35,40 +85,125 @@ def _custom_ts_extractor(
 
 def trade_to_ohlcv(
 	kafka: KafkaOptions,
-	ohlcv_window_seconds: int,
+	ohlcv_window_seconds: int | list[int],
+	fill_gaps: bool = False,
+	extra_stats: list[str] | None = None,
+	features_window_seconds: int | None = None,
+	grace_ms: int = 0,
+	state_ttl_ms: int | None = None,
+	stats_interval_s: float = 60.0,
 ) -> None:
 	"""
 	Reads trades from Kafka input_topic,
-	aggregates them into OHLCV with specified window size and
-	writes OHLCV to Kafka output topic
+	aggregates them into OHLCV with specified window sizes and
+	writes OHLCV to Kafka output topics
+
+	The smallest window is aggregated from the trades, every larger one is
+	rolled up from the finalized candles of the next smaller one, so the trades
+	are read once for all timeframes. Candles of several timeframes sharing
+	a topic carry a `window_seconds` field.
+
+	The `extra_stats` groups, e.g. vwap or trade_count, are accumulated by the
+	same reducer and add their fields to the candles, see app/candle_stats.py.
+
+	With `kafka.features_output_topic` the candles of `features_window_seconds`
+	are also written there with their technical indicators, updated per candle,
+	see app/indicators.py.
+
+	The windows take in late trades for `grace_ms` after their end, see
+	app/watermarks.py; the late trades dropped and the open windows of every
+	partition are logged every `stats_interval_s`.
+
+	Replicas of the service in one consumer group share the partitions of the
+	input topic; quixstreams restores the window state of a partition moving
+	to another replica from its changelog topic.
+
+	With the exactly-once `kafka.processing_guarantee` the candles, the
+	changelogs of the state and the offsets of the trades are committed in
+	one transaction per checkpoint, so a restart doesn't write the candles
+	again; consumers of the candles read the committed ones only, as the
+	Kafka clients do by default.
 
 	Args:
-	    kafka_input_topic: Kafka topic to read trades from
-	    kafka_output_topic: Kafka topic to write OHLCV to
-	    kafka_broker_address: Kafka broker address
-	    ohlcv_window_seconds: Window size in seconds to aggregate trades into OHLCV
+	    kafka: Kafka options, with the topics of the timeframes
+	    ohlcv_window_seconds: Window sizes in seconds to aggregate trades into OHLCV,
+	        each one a multiple of the next smaller one
+	    fill_gaps: Only in the batch aggregation mode
+	    extra_stats: Groups of statistics added to the candles
+	    features_window_seconds: Window size of the candles with indicators,
+	        None for the smallest one
+	    grace_ms: Grace period of the windows for late trades
+	    state_ttl_ms: Only in the batch aggregation mode
+	    stats_interval_s: Interval of the lateness metrics in the logs
 
 	Returns:
 	    None
 	"""
+	windows_seconds = _get_windows_seconds(ohlcv_window_seconds)
+	stats_fields = get_stats_fields(extra_stats or [])
+	features_window_seconds = _get_features_window_seconds(
+		windows_seconds, features_window_seconds
+	)
+	if state_ttl_ms is not None:
+		# the windowed state of a symbol is only expired by its own trades
+		raise ValueError(
+			"State expiry requires the batch aggregation mode, "
+			"set OHLCV_AGGREGATION_MODE=batch"
+		)
+	if fill_gaps:
+		# the trailing gap of a symbol that stopped trading would never be filled,
+		# a window is only finalized by a trade of its own symbol
+		raise ValueError(
+			"A dense candle grid requires the batch aggregation mode, "
+			"set OHLCV_AGGREGATION_MODE=batch"
+		)
+	if kafka.partial_output_topic:
+		# a streaming dataframe can't emit both the current and the final windows
+		raise ValueError(
+			"Partial candles require the batch aggregation mode, "
+			"set OHLCV_AGGREGATION_MODE=batch"
+		)
 	app = Application(
 		broker_address=kafka.broker_address,
 		consumer_group=kafka.consumer_group,  # In case we have multiple parallel trade-to-ohlcv jobs
 		auto_offset_reset=kafka.auto_offset_reset,
+		processing_guarantee=kafka.processing_guarantee,
 	)
 
 
-	input_topic = app.topic(kafka.input_topic, value_serializer="json", timestamp_extractor=_custom_ts_extractor)
-	output_topic = app.topic(kafka.output_topic, value_serializer="json")
+	# trades are decoded from both the JSON and the binary format
+	input_topic = app.topic(
+		kafka.input_topic,
+		value_deserializer=BinaryDeserializer(),
+		timestamp_extractor=_custom_ts_extractor,
+		config=kafka.topic_config,
+	)
+	window_topic_names, output_topics = _get_output_topics(
+		app, kafka, windows_seconds, stats_fields
+	)
+	features_topic = _get_features_topic(app, kafka)
 
 	# create a streaming dataframe
 	# to apply transformations to data
 	sdf = app.dataframe(input_topic)
+	if "buy_volume" in stats_fields:
+		sdf = sdf.apply(classify_trade_side, stateful=True)
 
-	# aggregate trades into OHLCV
+	# aggregate trades into OHLCV of the smallest window
+	window_seconds = windows_seconds[0]
+	window_metrics = WindowStateMetrics(
+		window_ms=window_seconds * 1000,
+		grace_ms=grace_ms,
+		stats_interval_s=stats_interval_s,
+	)
+	sdf = sdf.update(window_metrics.observe)
+	reducer, initializer = _get_ohlcv_reducers(stats_fields)
 	sdf = (
-		sdf.tumbling_window(duration_ms=timedelta(seconds=ohlcv_window_seconds))
-		.reduce(reducer=_update_ohlcv_candle, initializer=_init_ohlcv_candle)
+		sdf.tumbling_window(
+			duration_ms=timedelta(seconds=window_seconds),
+			grace_ms=timedelta(milliseconds=grace_ms),
+		)
+		.reduce(reducer=reducer, initializer=initializer)
 		.final()
 	)
 	sdf["symbol"] = sdf["value"]["symbol"]
@@ -77,15 +212,671 @@ def trade_to_ohlcv(
 	sdf["low"] = sdf["value"]["low"]
 	sdf["close"] = sdf["value"]["close"]
 	sdf["volume"] = sdf["value"]["volume"]
+	for field in stats_fields:
+		sdf[field] = sdf["value"][field]
 	sdf["timestamp_ms"] = sdf["end"]
+	sdf = _to_topic(
+		sdf, window_seconds, window_topic_names, output_topics, stats_fields
+	)
+	if features_topic is not None and window_seconds == features_window_seconds:
+		sdf = _to_features_topic(sdf, window_seconds, features_topic)
+
+	# roll the finalized candles up into the larger windows, one after another
+	for child_window_seconds, window_seconds in zip(
+		windows_seconds, windows_seconds[1:]
+	):
+		sdf = sdf.apply(
+			_roll_up_ohlcv_candles(
+				window_ms=window_seconds * 1000,
+				child_window_ms=child_window_seconds * 1000,
+			),
+			stateful=True,
+			expand=True,
+		)
+		sdf = _to_topic(
+			sdf, window_seconds, window_topic_names, output_topics, stats_fields
+		)
+		if features_topic is not None and window_seconds == features_window_seconds:
+			sdf = _to_features_topic(sdf, window_seconds, features_topic)
+
+	app.run(sdf)
+
+
+def trade_to_ohlcv_batched(
+	kafka: KafkaOptions,
+	ohlcv_window_seconds: int | list[int],
+	batch_size: int = 10_000,
+	batch_timeout_s: float = 0.5,
+	state_dir: str | Path = "state",
+	partial_min_interval_ms: int = 1000,
+	partial_min_price_change: float = 0.0,
+	fill_gaps: bool = False,
+	fill_gaps_clock_lag_ms: int | None = None,
+	extra_stats: list[str] | None = None,
+	features_window_seconds: int | None = None,
+	grace_ms: int = 0,
+	state_ttl_ms: int | None = None,
+	stats_interval_s: float = 60.0,
+	allow_state_loss: bool = False,
+) -> None:
+	"""
+	Same as `trade_to_ohlcv`, but the trades are consumed in micro-batches and
+	aggregated with NumPy, see app/batch_aggregation.py.
+
+	The state of every partition is saved to `state_dir` once per batch, with
+	the offset of its last aggregated trade, and consumption resumes from that
+	offset when the partition is assigned again.
+
+	With `kafka.partial_output_topic` the open candles of every timeframe are
+	also written there, throttled, with their statistics, see
+	app/partial_candles.py.
+
+	With `fill_gaps` the candles form a dense grid, see app/candle_grid.py:
+	the windows are also closed once the latest trade timestamp of the
+	partition passed their end, and the symbols without trades get flat
+	candles up to it. With `fill_gaps_clock_lag_ms` the latest timestamp also
+	follows the wall clock, so idle partitions keep emitting candles; trades
+	delayed by more than the lag are then dropped as late.
+
+	The `extra_stats` are aggregated along with the candles, in the same pass.
+
+	With `kafka.features_output_topic` the candles of `features_window_seconds`
+	are also written there with their technical indicators, whose state is
+	saved with the partition.
+
+	With `grace_ms` the trades are held back for the grace period and
+	aggregated in timestamp order, see app/watermarks.py; after a restart the
+	held back trades are consumed again. With `state_ttl_ms`
+	the symbols without trades for that long are forgotten: their open and
+	rolled up candles, final by then, are emitted, and their grid, tick rule
+	and indicators start over with their next trade. The late trades, the open
+	windows and the state size of every partition are logged every
+	`stats_interval_s`.
+
+	Replicas of the service in one consumer group share the partitions of the
+	input topic, the trades of a symbol being in one partition. A partition
+	moving to another replica resumes from the state its previous replica
+	saved, so the replicas share `state_dir`, e.g. on a volume. A partition
+	assigned without its state, or with an outdated one, as a replica with a
+	`state_dir` of its own would be, fails the service, as its open windows
+	would be lost, unless `allow_state_loss`, e.g. to start from an existing
+	consumer group.
+
+	With the exactly-once `kafka.processing_guarantee` the candles of every
+	batch and the offsets of its trades are committed in one transaction.
+	The state of a partition is saved before, along with the previous one,
+	and the committed offset carries the version of the state it goes with,
+	so a partition assigned after a failed transaction resumes from the
+	previous state, and a restart doesn't write the candles again.
+
+	Args:
+	    kafka: Kafka options, with the topics of the timeframes
+	    ohlcv_window_seconds: Window sizes in seconds to aggregate trades into OHLCV,
+	        each one a multiple of the next smaller one
+	    batch_size: Maximal number of trades aggregated at once
+	    batch_timeout_s: How long to wait for the first trade of a batch
+	    state_dir: Directory of the partition state files
+	    partial_min_interval_ms: Trade time between two partial candle updates
+	    partial_min_price_change: Relative close change emitted right away
+	        as a partial candle update, 0 to only throttle by time
+	    fill_gaps: Whether to emit a dense candle grid
+	    fill_gaps_clock_lag_ms: Lag of the wall clock closing the windows
+	        with `fill_gaps`, None to only close them by trade time
+	    extra_stats: Groups of statistics added to the candles
+	    features_window_seconds: Window size of the candles with indicators,
+	        None for the smallest one
+	    grace_ms: Grace period of the windows for late trades
+	    state_ttl_ms: Time without trades after which the state of a symbol
+	        is deleted, at least the largest window plus `grace_ms`, None to
+	        keep it
+	    stats_interval_s: Interval of the lateness and state metrics in the logs
+	    allow_state_loss: Resume a partition without its state, or with an
+	        outdated one, logging it, instead of failing
+
+	Returns:
+	    None
+	"""
+	windows_seconds = _get_windows_seconds(ohlcv_window_seconds)
+	stats_fields = get_stats_fields(extra_stats or [])
+	features_window_seconds = _get_features_window_seconds(
+		windows_seconds, features_window_seconds
+	)
+	if (
+		state_ttl_ms is not None
+		and state_ttl_ms < windows_seconds[-1] * 1000 + grace_ms
+	):
+		# the rolled up candles of an expired symbol must be final, late trades
+		# included
+		raise ValueError(
+			f"A state TTL of {state_ttl_ms}ms is shorter than the largest window "
+			f"of {windows_seconds[-1]}s plus the grace period of {grace_ms}ms"
+		)
+	app = Application(
+		broker_address=kafka.broker_address,
+		consumer_group=kafka.consumer_group,
+		auto_offset_reset=kafka.auto_offset_reset,
+	)
+	# the trades are consumed outside of the topic, which is declared to be
+	# created with the partitions of `kafka.topic_config`
+	app.topic(kafka.input_topic, config=kafka.topic_config)
+	window_topic_names, output_topics = _get_output_topics(
+		app, kafka, windows_seconds, stats_fields
+	)
+	features_topic = _get_features_topic(app, kafka)
+	roll_ups = {
+		window_seconds: _roll_up_ohlcv_candles(
+			window_ms=window_seconds * 1000,
+			child_window_ms=child_window_seconds * 1000,
+		)
+		for child_window_seconds, window_seconds in zip(
+			windows_seconds, windows_seconds[1:]
+		)
+	}
+	partial_topic = None
+	partial_candles = None
+	if kafka.partial_output_topic:
+		partial_topic = app.topic(
+			kafka.partial_output_topic,
+			value_serializer=get_value_serializer(
+				kafka.output_topic_format,
+				OHLCV_PARTIAL_STATS_V1 if stats_fields else OHLCV_PARTIAL_V1,
+			),
+			config=kafka.topic_config,
+		)
+		partial_candles = PartialCandles(
+			windows_seconds,
+			min_interval_ms=partial_min_interval_ms,
+			min_price_change=partial_min_price_change,
+			fill_gaps=fill_gaps,
+			stats_fields=stats_fields,
+		)
+	fill_grid_gaps = fill_ohlcv_gaps(
+		window_ms=windows_seconds[0] * 1000, stats_fields=stats_fields
+	)
+	exactly_once = kafka.processing_guarantee == "exactly-once"
+	snapshots = PartitionSnapshots(
+		Path(state_dir) / kafka.consumer_group, keep_previous=exactly_once
+	)
+	partitions: dict[int, PartitionState] = {}
+
+	def on_assign(consumer: Consumer, topic_partitions: list[TopicPartition]) -> None:
+		committed = {
+			committed.partition: committed
+			for committed in consumer.committed(topic_partitions, timeout=10)
+		}
+		for topic_partition in topic_partitions:
+			committed_offset = -1
+			committed_version = None
+			if topic_partition.partition in committed:
+				committed_offset = committed[topic_partition.partition].offset
+				if exactly_once and committed[topic_partition.partition].metadata:
+					committed_version = int(
+						committed[topic_partition.partition].metadata
+					)
+			snapshot = snapshots.load(
+				topic_partition.topic, topic_partition.partition, committed_version
+			)
+			_check_partition_state(
+				topic_partition.partition, snapshot, committed_offset, allow_state_loss
+			)
+			if snapshot is None:
+				window_ms = windows_seconds[0] * 1000
+				reorder_buffer = None
+				if grace_ms:
+					reorder_buffer = TradesReorderBuffer(window_ms, grace_ms)
+				partition = PartitionState(
+					OhlcvBatchAggregator(
+						window_ms=window_ms, stats_fields=stats_fields
+					),
+					reorder_buffer=reorder_buffer,
+				)
+			else:
+				partition = PartitionState.from_snapshot(
+					snapshot, stats_fields, grace_ms
+				)
+				if partition.resume_offset is not None:
+					topic_partition.offset = partition.resume_offset
+			partitions[topic_partition.partition] = partition
+		consumer.incremental_assign(topic_partitions)
+
+	def on_revoke(consumer: Consumer, topic_partitions: list[TopicPartition]) -> None:
+		for topic_partition in topic_partitions:
+			partitions.pop(topic_partition.partition, None)
+
+	running = True
+
+	def stop(signum, frame) -> None:
+		nonlocal running
+		running = False
+
+	signal.signal(signal.SIGINT, stop)
+	signal.signal(signal.SIGTERM, stop)
+	stats_logged_at = time.monotonic()
+
+	with (
+		app.get_consumer(auto_commit_enable=False) as consumer,
+		_get_producer(app, kafka) as producer,
+	):
+		consumer.subscribe(
+			[kafka.input_topic],
+			on_assign=on_assign,
+			on_revoke=on_revoke,
+			on_lost=on_revoke,
+		)
+		while running:
+			messages_by_partition = collections.defaultdict(list)
+			for message in _consume_batch(consumer, batch_size, batch_timeout_s):
+				if message.error():
+					logger.error(f"Kafka error: {message.error()}")
+					continue
+				messages_by_partition[message.partition()].append(message)
+			if fill_gaps and fill_gaps_clock_lag_ms is not None:
+				clock_ms = time.time_ns() // 1_000_000 - fill_gaps_clock_lag_ms
+				for partition_id, partition in partitions.items():
+					if partition.advance_clock(clock_ms):
+						# the windows it passed are closed without trades
+						messages_by_partition.setdefault(partition_id, [])
+			if time.monotonic() - stats_logged_at >= stats_interval_s:
+				stats_logged_at = time.monotonic()
+				for partition_id, partition in sorted(partitions.items()):
+					logger.info(f"Partition {partition_id}: {partition.stats()}")
+			if not messages_by_partition:
+				continue
+			if exactly_once:
+				producer.begin_transaction()
+
+			offsets = []
+			updated_partition_ids = []
+			for partition_id, messages in messages_by_partition.items():
+				partition = partitions.get(partition_id)
+				if partition is None:
+					# revoked while the batch was consumed
+					continue
+				trades = [decode_record(message.value()) for message in messages]
+				if partition.reorder_buffer is not None:
+					trades = partition.reorder_buffer.push(
+						trades, [message.offset() for message in messages]
+					)
+				candles = partition.aggregate(trades)
+				if fill_gaps:
+					candles = _fill_candle_gaps(
+						partition, candles, fill_grid_gaps, stats_fields
+					)
+				expired_symbols = []
+				if state_ttl_ms is not None:
+					expired_candles, expired_symbols = partition.expire_symbols(
+						state_ttl_ms
+					)
+					candles += expired_candles
+				logger.debug(
+					f"Aggregated {len(trades)} trades of partition {partition_id} "
+					f"into {len(candles)} candles"
+				)
+				if not messages and not candles and not expired_symbols:
+					continue
+				updated_partition_ids.append(partition_id)
+				for window_seconds in windows_seconds:
+					if window_seconds in roll_ups:
+						roll_up = roll_ups[window_seconds]
+						candles = [
+							rolled_up
+							for candle in candles
+							for rolled_up in roll_up(
+								candle, partition.get_symbol_state(candle["symbol"])
+							)
+						]
+						candles += _flush_rolled_up_candles(
+							partition, expired_symbols, window_seconds
+						)
+					_produce_candles(
+						producer,
+						candles,
+						window_seconds,
+						window_topic_names,
+						output_topics,
+					)
+					if partial_candles is not None:
+						_produce_tagged_candles(
+							producer,
+							partial_candles.finalize(candles, window_seconds),
+							partial_topic,
+						)
+					if (
+						features_topic is not None
+						and window_seconds == features_window_seconds
+					):
+						_produce_tagged_candles(
+							producer,
+							[
+								_get_features(
+									candle,
+									window_seconds,
+									partition.get_symbol_state(candle["symbol"]),
+								)
+								for candle in candles
+							],
+							features_topic,
+						)
+				if partial_candles is not None:
+					_produce_tagged_candles(
+						producer,
+						partial_candles.get_updates(
+							partition,
+							dict.fromkeys(trade["symbol"] for trade in trades),
+						),
+						partial_topic,
+					)
+				partition.delete_symbol_states(expired_symbols)
+				if messages:
+					# the trades consumed again for the reorder buffer are behind it
+					partition.offset = max(messages[-1].offset(), partition.offset or 0)
+				elif not exactly_once or partition.offset is None:
+					continue
+				partition.version += 1
+				offsets.append(
+					TopicPartition(
+						kafka.input_topic,
+						partition_id,
+						partition.offset + 1,
+						# the state committed along with the offset
+						metadata=str(partition.version),
+					)
+				)
+
+			if exactly_once:
+				# the states are saved before the transaction whose offsets carry
+				# their versions, the previous ones are kept in case it fails
+				for partition_id in updated_partition_ids:
+					partition = partitions[partition_id]
+					partition.state_bytes = snapshots.save(
+						kafka.input_topic, partition_id, partition
+					)
+				if offsets:
+					producer.send_offsets_to_transaction(
+						offsets, consumer.consumer_group_metadata()
+					)
+				producer.commit_transaction()
+				continue
+			if not updated_partition_ids:
+				continue
+			producer.flush()
+			# the state is saved once the candles it closed were delivered
+			for partition_id in updated_partition_ids:
+				partition = partitions[partition_id]
+				partition.state_bytes = snapshots.save(
+					kafka.input_topic, partition_id, partition
+				)
+			if offsets:
+				consumer.commit(offsets=offsets, asynchronous=True)
+	logger.info("Stopped trade_to_ohlcv")
+
+
+def _get_producer(app: Application, kafka: KafkaOptions) -> Producer:
+	"""A transactional producer with the exactly-once processing guarantee."""
+	if kafka.processing_guarantee != "exactly-once":
+		return app.get_producer()
+	app.setup_topics()
+	return TransactionalProducer(broker_address=kafka.broker_address)
+
+
+def _check_partition_state(
+	partition_id: int,
+	snapshot: dict | None,
+	committed_offset: int,
+	allow_state_loss: bool,
+) -> None:
+	"""
+	Fails on a partition whose trades the consumer group committed beyond its
+	state, e.g. aggregated by a replica not sharing the state directory, or
+	logs it with `allow_state_loss`.
+	"""
+	if committed_offset < 0:
+		return
+	if snapshot is None:
+		message = (
+			f"Partition {partition_id} has no saved state, its open windows are "
+			f"lost and it resumes at the committed offset {committed_offset}"
+		)
+	elif snapshot["offset"] + 1 < committed_offset:
+		message = (
+			f"Partition {partition_id} has a state at offset {snapshot['offset']}, "
+			f"behind the committed offset {committed_offset}, its trades since "
+			"are aggregated again"
+		)
+	else:
+		return
+	if not allow_state_loss:
+		raise RuntimeError(
+			f"{message}. Do the replicas share the state directory? "
+			"Set OHLCV_ALLOW_STATE_LOSS=true to resume anyway"
+		)
+	logger.warning(message)
+
+
+def _fill_candle_gaps(
+	partition: PartitionState,
+	candles: list[dict],
+	fill_grid_gaps: Callable,
+	stats_fields: list[str],
+) -> list[dict]:
+	"""
+	Closes the open candles of the partition whose windows its latest timestamp
+	passed, and fills the gaps of every symbol up to it.
+	"""
+	aggregator = partition.aggregator
+	candles = sorted(
+		candles + partition.close_windows(),
+		key=lambda candle: candle["timestamp_ms"],
+	)
+	filled_candles = [
+		filled_candle
+		for candle in candles
+		for filled_candle in fill_grid_gaps(
+			candle, partition.get_symbol_state(candle["symbol"])
+		)
+	]
+	latest_timestamp_ms = aggregator.latest_timestamp_ms
+	end_ms = latest_timestamp_ms - latest_timestamp_ms % aggregator.window_ms
+	for symbol, state in partition.symbol_states.items():
+		filled_candles.extend(
+			fill_gaps_until(symbol, state, aggregator.window_ms, end_ms, stats_fields)
+		)
+	return filled_candles
+
+
+def _flush_rolled_up_candles(
+	partition: PartitionState, symbols: list[str], window_seconds: int
+) -> list[dict]:
+	"""The candles of the window still rolled up for expired symbols."""
+	state_key = roll_up_state_key(window_seconds * 1000)
+	candles = []
+	for symbol in symbols:
+		state = partition.symbol_states.get(symbol)
+		if state is not None and state.exists(state_key):
+			candles.append(state.get(state_key))
+			state.delete(state_key)
+	return candles
+
+
+def _consume_batch(consumer: Consumer, batch_size: int, timeout_s: float) -> list:
+	"""Polls up to `batch_size` messages, waiting at most `timeout_s` for the first."""
+	message = consumer.poll(timeout_s)
+	if message is None:
+		return []
+	messages = [message]
+	while len(messages) < batch_size:
+		message = consumer.poll(0)
+		if message is None:
+			break
+		messages.append(message)
+	return messages
+
+
+def _produce_candles(
+	producer: Producer,
+	candles: list[dict],
+	window_seconds: int,
+	window_topic_names: dict[int, str],
+	output_topics: dict[str, Topic],
+) -> None:
+	"""Writes the candles of the window to its topic, tagged if the topic is shared."""
+	topic = output_topics[window_topic_names[window_seconds]]
+	is_shared = list(window_topic_names.values()).count(topic.name) > 1
+	for candle in candles:
+		value = candle
+		if is_shared:
+			value = {
+				"symbol": candle["symbol"],
+				"timestamp_ms": candle["timestamp_ms"],
+				"window_seconds": window_seconds,
+				**candle,
+			}
+		message = topic.serialize(value=value)
+		producer.produce(
+			topic=topic.name,
+			value=message.value,
+			key=candle["symbol"],
+			# the window start, as the tumbling window emits it
+			timestamp=candle["timestamp_ms"] - window_seconds * 1000,
+		)
+
+
+def _produce_tagged_candles(
+	producer: Producer, candles: list[dict], topic: Topic
+) -> None:
+	"""Writes candles carrying their `window_seconds` to the topic."""
+	for candle in candles:
+		message = topic.serialize(value=candle)
+		producer.produce(
+			topic=topic.name,
+			value=message.value,
+			key=candle["symbol"],
+			timestamp=candle["timestamp_ms"] - candle["window_seconds"] * 1000,
+		)
+
+
+def _get_output_topics(
+	app: Application,
+	kafka: KafkaOptions,
+	windows_seconds: list[int],
+	stats_fields: list[str] | None = None,
+) -> tuple[dict[int, str], dict[str, Topic]]:
+	"""Topic names of the timeframes and the output topics by name."""
+	window_topic_names = {
+		window: (kafka.window_output_topics or {}).get(window, kafka.output_topic)
+		for window in windows_seconds
+	}
+	topic_names = list(window_topic_names.values())
+	shared_topic_names = {name for name in topic_names if topic_names.count(name) > 1}
+	if stats_fields:
+		schema, shared_schema = OHLCV_STATS_V1, OHLCV_STATS_V2
+	else:
+		schema, shared_schema = OHLCV_V1, OHLCV_V2
+	output_topics = {
+		name: app.topic(
+			name,
+			value_serializer=get_value_serializer(
+				kafka.output_topic_format,
+				shared_schema if name in shared_topic_names else schema,
+			),
+			config=kafka.topic_config,
+		)
+		for name in set(topic_names)
+	}
+	return window_topic_names, output_topics
+
+
+def _get_features_topic(app: Application, kafka: KafkaOptions) -> Topic | None:
+	if not kafka.features_output_topic:
+		return None
+	return app.topic(
+		kafka.features_output_topic,
+		value_serializer=get_value_serializer(
+			kafka.output_topic_format, OHLCV_FEATURES_V1
+		),
+		config=kafka.topic_config,
+	)
+
+
+def _get_features_window_seconds(
+	windows_seconds: list[int], features_window_seconds: int | None
+) -> int:
+	"""The window of the candles with indicators, the smallest one by default."""
+	if features_window_seconds is None:
+		return windows_seconds[0]
+	if features_window_seconds not in windows_seconds:
+		raise ValueError(
+			f"Indicators of {features_window_seconds}s candles require that window, "
+			f"the OHLCV windows are {windows_seconds}"
+		)
+	return features_window_seconds
+
+
+def _get_windows_seconds(ohlcv_window_seconds: int | list[int]) -> list[int]:
+	"""Sorts the window sizes and checks that every one nests in the next larger."""
+	if isinstance(ohlcv_window_seconds, int):
+		ohlcv_window_seconds = [ohlcv_window_seconds]
+	windows_seconds = sorted(set(ohlcv_window_seconds))
+	if not windows_seconds:
+		raise ValueError("At least one OHLCV window size is required")
+	for smaller, larger in zip(windows_seconds, windows_seconds[1:]):
+		if larger % smaller:
+			raise ValueError(
+				f"OHLCV window of {larger}s can't be rolled up from {smaller}s candles, "
+				"every window must be a multiple of the next smaller one"
+			)
+	return windows_seconds
+
+
+def _to_topic(
+	sdf: StreamingDataFrame,
+	window_seconds: int,
+	window_topic_names: dict[int, str],
+	output_topics: dict[str, Topic],
+	stats_fields: list[str],
+) -> StreamingDataFrame:
+	"""Writes the candles of the window to its topic, tagged if the topic is shared."""
+	topic_name = window_topic_names[window_seconds]
+	columns = OHLCV_COLUMNS + stats_fields
+	if list(window_topic_names.values()).count(topic_name) > 1:
+		sdf["window_seconds"] = window_seconds
+		columns.insert(2, "window_seconds")
 	sdf = sdf.update(logger.debug)
 
-	sdf = sdf[["symbol", "timestamp_ms", "open", "high", "low", "close", "volume"]]
+	sdf = sdf[columns]
 
 	# write aggregated trades to Kafka output topic
-	sdf.to_topic(output_topic)
+	sdf.to_topic(output_topics[topic_name])
+	return sdf
 
-	app.run(sdf)
+
+def _to_features_topic(
+	sdf: StreamingDataFrame, window_seconds: int, features_topic: Topic
+) -> StreamingDataFrame:
+	"""Writes the candles of the window with their indicators to the features topic."""
+	sdf = sdf.apply(
+		lambda candle, state: _get_features(candle, window_seconds, state),
+		stateful=True,
+	)
+	sdf.to_topic(features_topic)
+	# the candles are rolled up without the indicators
+	return sdf.apply(_drop_indicators)
+
+
+def _get_features(candle: dict, window_seconds: int, state: State) -> dict:
+	"""The candle with the next indicators of its symbol."""
+	return {
+		"symbol": candle["symbol"],
+		"timestamp_ms": candle["timestamp_ms"],
+		"window_seconds": window_seconds,
+		**add_technical_indicators(candle, state),
+	}
+
+
+def _drop_indicators(features: dict) -> dict:
+	return {
+		key: value for key, value in features.items() if key not in INDICATOR_COLUMNS
+	}
 
 
 def _init_ohlcv_candle(trade: dict) -> dict:
@@ -123,6 +914,52 @@ def _update_ohlcv_candle(kline: dict, trade: dict) -> dict:
 	}
 
 
+def _get_ohlcv_reducers(stats_fields: list[str]) -> tuple[Callable, Callable]:
+	"""The reducer and the initializer of the candles with the statistics."""
+	if not stats_fields:
+		return _update_ohlcv_candle, _init_ohlcv_candle
+	fields = frozenset(stats_fields)
+
+	def init_candle(trade: dict) -> dict:
+		return {**_init_ohlcv_candle(trade), **init_candle_stats(trade, fields)}
+
+	def update_candle(kline: dict, trade: dict) -> dict:
+		return {
+			**_update_ohlcv_candle(kline, trade),
+			**update_candle_stats(kline, trade, fields),
+		}
+
+	return update_candle, init_candle
+
+
+def _roll_up_ohlcv_candles(window_ms: int, child_window_ms: int) -> Callable:
+	"""
+	Returns the stateful function rolling finalized candles of `child_window_ms`
+	up into candles of `window_ms`.
+	A candle is emitted with its last child candle, or with the first child
+	candle of a later window when its last children had no trades.
+	"""
+	state_key = roll_up_state_key(window_ms)
+
+	def roll_up(candle: dict, state: State) -> list[dict]:
+		start_ms = candle["timestamp_ms"] - child_window_ms
+		end_ms = start_ms - start_ms % window_ms + window_ms
+		rolled_up = []
+		kline = state.get(state_key)
+		if kline is not None and kline["timestamp_ms"] != end_ms:
+			rolled_up.append(kline)
+			kline = None
+		kline = merge_ohlcv_candles(kline, candle, end_ms)
+		if candle["timestamp_ms"] == end_ms:
+			rolled_up.append(kline)
+			state.delete(state_key)
+		else:
+			state.set(state_key, kline)
+		return rolled_up
+
+	return roll_up
+
+
 if __name__ == "__main__":
 	logger.info("Starting trade_to_ohlcv")
 	kafka_options = KafkaOptions(
@@ -131,8 +968,39 @@ if __name__ == "__main__":
 		output_topic=settings.kafka.OHLCV_TOPIC,
 		consumer_group=settings.kafka.CONSUMER_GROUP,
 		auto_offset_reset=settings.kafka.AUTO_OFFSET_RESET,
+		output_topic_format=settings.kafka.OHLCV_TOPIC_FORMAT,
+		window_output_topics=settings.kafka.WINDOW_OHLCV_TOPICS,
+		partial_output_topic=settings.kafka.OHLCV_PARTIAL_TOPIC,
+		features_output_topic=settings.kafka.FEATURES_TOPIC,
+		topic_config=settings.kafka.topic_config(),
+		processing_guarantee=settings.kafka.PROCESSING_GUARANTEE,
 	)
-	trade_to_ohlcv(
-		kafka=kafka_options,
-		ohlcv_window_seconds=settings.OHLCV_WINDOW_SECONDS,
-	)
+	if settings.OHLCV_AGGREGATION_MODE == "batch":
+		trade_to_ohlcv_batched(
+			kafka=kafka_options,
+			ohlcv_window_seconds=settings.OHLCV_WINDOWS_SECONDS,
+			batch_size=settings.OHLCV_BATCH_SIZE,
+			batch_timeout_s=settings.OHLCV_BATCH_TIMEOUT_S,
+			state_dir=settings.OHLCV_STATE_DIR,
+			partial_min_interval_ms=settings.OHLCV_PARTIAL_MIN_INTERVAL_MS,
+			partial_min_price_change=settings.OHLCV_PARTIAL_MIN_PRICE_CHANGE,
+			fill_gaps=settings.OHLCV_FILL_GAPS,
+			fill_gaps_clock_lag_ms=settings.OHLCV_FILL_GAPS_CLOCK_LAG_MS,
+			extra_stats=settings.OHLCV_EXTRA_STATS,
+			features_window_seconds=settings.FEATURES_WINDOW_SECONDS,
+			grace_ms=settings.OHLCV_GRACE_MS,
+			state_ttl_ms=settings.OHLCV_STATE_TTL_MS,
+			stats_interval_s=settings.OHLCV_STATS_INTERVAL_S,
+			allow_state_loss=settings.OHLCV_ALLOW_STATE_LOSS,
+		)
+	else:
+		trade_to_ohlcv(
+			kafka=kafka_options,
+			ohlcv_window_seconds=settings.OHLCV_WINDOWS_SECONDS,
+			fill_gaps=settings.OHLCV_FILL_GAPS,
+			extra_stats=settings.OHLCV_EXTRA_STATS,
+			features_window_seconds=settings.FEATURES_WINDOW_SECONDS,
+			grace_ms=settings.OHLCV_GRACE_MS,
+			state_ttl_ms=settings.OHLCV_STATE_TTL_MS,
+			stats_interval_s=settings.OHLCV_STATS_INTERVAL_S,
+		)
@@ -0,0 +1,153 @@
+"""
+In-progress OHLCV candles, emitted while their windows are still open.
+
+A partial candle is the candle its window would close with if no more trades
+came in. Partial candles go to their own topic with `is_final` false, followed
+by the final candle with `is_final` true, so a consumer of that topic can react
+within a window; the OHLCV topics keep receiving the final candles only.
+"""
+
+from typing import Iterable
+
+from app.batch_aggregation import PartitionState
+from app.candle_grid import GRID_STATE_KEY, seed_open
+from app.candle_stats import merge_candle_stats
+
+
+def roll_up_state_key(window_ms: int) -> str:
+	"""State key of the candle being rolled up into a window of `window_ms`."""
+	return f"ohlcv_{window_ms}"
+
+
+def merge_ohlcv_candles(kline: dict | None, candle: dict, end_ms: int) -> dict:
+	"""
+	Adds a smaller candle to the candle of the larger window ending at `end_ms`,
+	with the statistics of app/candle_stats.py it has.
+	"""
+	if kline is None:
+		return {**candle, "timestamp_ms": end_ms}
+	return {
+		"symbol": kline["symbol"],
+		"timestamp_ms": end_ms,
+		"open": kline["open"],
+		"high": max(kline["high"], candle["high"]),
+		"low": min(kline["low"], candle["low"]),
+		"close": candle["close"],
+		"volume": kline["volume"] + candle["volume"],
+		**merge_candle_stats(kline, candle),
+	}
+
+
+class PartialCandles:
+	"""
+	Builds the partial candles of every window size and throttles them.
+
+	An update of a symbol and window is emitted at the first trade of the window,
+	then once `min_interval_ms` of trade time passed since the previous update,
+	or earlier when the close moved by `min_price_change` relative to it.
+	A held back update goes out with a later batch of the partition once it is
+	due, even when the symbol had no more trades.
+	"""
+
+	def __init__(
+		self,
+		windows_seconds: list[int],
+		min_interval_ms: int = 1000,
+		min_price_change: float = 0.0,
+		fill_gaps: bool = False,
+		stats_fields: list[str] | None = None,
+	):
+		"""
+		:param windows_seconds: Window sizes in seconds, the smallest first.
+		:param min_interval_ms: Trade time between two updates of a candle.
+		:param min_price_change: Relative change of the close emitted right away,
+			e.g. 0.001 for 0.1%, 0 to only throttle by time.
+		:param fill_gaps: Whether the candles open at the previous close,
+			see app/candle_grid.py.
+		:param stats_fields: Fields of the statistics of the candles,
+			see `app.candle_stats.get_stats_fields`.
+		"""
+		self._windows_seconds = windows_seconds
+		self._min_interval_ms = min_interval_ms
+		self._min_price_change = min_price_change
+		self._fill_gaps = fill_gaps
+		self._stats_fields = stats_fields or []
+		# the window end, the trade time and the close of the last update,
+		# by symbol and window
+		self._last_updates: dict[tuple[str, int], tuple[int, int, float]] = {}
+		# symbols with an update held back
+		self._held_back: set[str] = set()
+
+	def get_updates(
+		self, partition: PartitionState, symbols: Iterable[str]
+	) -> list[dict]:
+		"""The due updates of the open candles of the symbols, e.g. of a batch."""
+		aggregator = partition.aggregator
+		now_ms = aggregator.latest_timestamp_ms
+		symbols = dict.fromkeys(symbols)
+		symbols.update(dict.fromkeys(self._held_back))
+		updates = []
+		for candle in aggregator.get_open_candles(symbols):
+			symbol = candle["symbol"]
+			self._held_back.discard(symbol)
+			state = partition.get_symbol_state(symbol)
+			if self._fill_gaps and state.exists(GRID_STATE_KEY):
+				candle = seed_open(candle, state.get(GRID_STATE_KEY)["close"])
+			child_window_ms = None
+			for window_seconds in self._windows_seconds:
+				window_ms = window_seconds * 1000
+				if child_window_ms is not None:
+					# the finalized child candles of the window, plus the open one
+					start_ms = candle["timestamp_ms"] - child_window_ms
+					end_ms = start_ms - start_ms % window_ms + window_ms
+					kline = state.get(roll_up_state_key(window_ms))
+					if kline is not None and kline["timestamp_ms"] != end_ms:
+						kline = None
+					candle = merge_ohlcv_candles(kline, candle, end_ms)
+				if self._is_due(candle, window_seconds, now_ms):
+					updates.append(self._as_partial(candle, window_seconds, False))
+				child_window_ms = window_ms
+		return updates
+
+	def _is_due(self, candle: dict, window_seconds: int, now_ms: int) -> bool:
+		key = (candle["symbol"], window_seconds)
+		last_update = self._last_updates.get(key)
+		if last_update is not None:
+			end_ms, updated_at_ms, close = last_update
+			is_due = (
+				end_ms != candle["timestamp_ms"]
+				or now_ms - updated_at_ms >= self._min_interval_ms
+				or (
+					self._min_price_change > 0
+					and abs(candle["close"] - close)
+					>= self._min_price_change * abs(close)
+				)
+			)
+			if not is_due:
+				self._held_back.add(candle["symbol"])
+				return False
+		self._last_updates[key] = (candle["timestamp_ms"], now_ms, candle["close"])
+		return True
+
+	def finalize(self, candles: list[dict], window_seconds: int) -> list[dict]:
+		"""The final candles of a window size, as the last updates of their windows."""
+		for candle in candles:
+			self._last_updates.pop((candle["symbol"], window_seconds), None)
+			if window_seconds == self._windows_seconds[0]:
+				# no open candle to update until the next trade of the symbol
+				self._held_back.discard(candle["symbol"])
+		return [self._as_partial(candle, window_seconds, True) for candle in candles]
+
+	def _as_partial(self, candle: dict, window_seconds: int, is_final: bool) -> dict:
+		return {
+			"symbol": candle["symbol"],
+			"timestamp_ms": candle["timestamp_ms"],
+			"window_seconds": window_seconds,
+			"is_final": is_final,
+			"open": candle["open"],
+			"high": candle["high"],
+			"low": candle["low"],
+			"close": candle["close"],
+			"volume": candle["volume"],
+			**{field: candle[field] for field in self._stats_fields},
+		}
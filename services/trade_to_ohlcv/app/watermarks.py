@@ -0,0 +1,249 @@
+"""
+Lateness of the trades: the grace period of the windows, the late trades it
+drops and the open windows it keeps in the state.
+
+A window takes in the trades arriving until the latest trade timestamp of the
+partition, its watermark, passed the end of the window by `grace_ms`; a later
+trade of the window is dropped as late. A larger grace period makes the candles
+of a lagging connector complete, at the cost of windows kept open for longer.
+"""
+
+import bisect
+import heapq
+import time
+from itertools import compress
+
+import numpy as np
+import structlog
+from quixstreams import message_context
+
+from app.config import settings
+
+logger = structlog.get_logger(settings.LOGGER_NAME)
+
+
+class TradesReorderBuffer:
+	"""
+	Trades of one partition held back for the grace period, in the batch
+	aggregation mode, whose aggregator keeps a single open window per symbol.
+
+	Trades are released in timestamp order once the latest timestamp minus
+	`grace_ms` passed the end of their window, so the aggregator closes a window
+	only after its grace period, and the late trades never reach it. A window
+	still open may take in a trade earlier than one already passed by the
+	watermark, so its trades are only released together, once no trade can be
+	added to it. They are kept in a heap by timestamp and offset, so a batch
+	costs its own trades, not a sort of the whole buffer.
+
+	A snapshot holds no trades but the offsets of the oldest and of the last
+	one taken in, and the timestamp up to which the trades were released. The
+	restored buffer is filled again with the trades consumed again from the
+	oldest offset up to the last one, which were not released by then: those,
+	and only those, it held back.
+	"""
+
+	def __init__(self, window_ms: int, grace_ms: int, latest_timestamp_ms: int = 0):
+		"""
+		:param window_ms: Window size in milliseconds.
+		:param grace_ms: Grace period of the windows in milliseconds.
+		:param latest_timestamp_ms: Latest trade timestamp of the partition.
+		"""
+		self.window_ms = window_ms
+		self.grace_ms = grace_ms
+		self.latest_timestamp_ms = latest_timestamp_ms
+		self._heap: list[tuple[int, int, dict]] = []
+		# offset of the last trade taken in
+		self.last_offset: int | None = None
+		# the trades consumed again to restore a snapshot, by offset, and its
+		# watermark; there are no releases until they are taken in
+		self._replay_from_offset: int | None = None
+		self._replay_until_offset: int | None = None
+		self._replay_from_ms = 0
+		# dropped since the last stats
+		self.late_trades = 0
+
+	def __len__(self) -> int:
+		return len(self._heap)
+
+	@property
+	def watermark_ms(self) -> int:
+		"""Timestamp up to which the trades are released."""
+		return self.latest_timestamp_ms - self.grace_ms
+
+	@property
+	def released_until_ms(self) -> int:
+		"""
+		Timestamp before which the trades are released: the end of the latest
+		window the watermark passed.
+		"""
+		watermark_ms = self.watermark_ms
+		return watermark_ms - watermark_ms % self.window_ms
+
+	@property
+	def is_restoring(self) -> bool:
+		"""Whether the trades of the restored snapshot are still to come."""
+		return self._replay_until_offset is not None
+
+	@property
+	def oldest_offset(self) -> int | None:
+		"""Offset of the oldest trade held back, to consume again after a restart."""
+		if self.is_restoring:
+			return self._replay_from_offset
+		return min((offset for _, offset, _ in self._heap), default=None)
+
+	def push(self, trades: list[dict], offsets: list[int]) -> list[dict]:
+		"""
+		Adds trades in the order they were consumed, drops the late ones, and
+		returns the trades of the windows the watermark passed, ordered by
+		timestamp.
+
+		:param offsets: Offsets of the trades.
+		"""
+		heap = self._heap
+		if trades and self.is_restoring:
+			num_restored = bisect.bisect_right(offsets, self._replay_until_offset)
+			for offset, trade in zip(offsets[:num_restored], trades[:num_restored]):
+				if trade["timestamp_ms"] >= self._replay_from_ms:
+					heapq.heappush(heap, (trade["timestamp_ms"], offset, trade))
+			if offsets[-1] >= self._replay_until_offset:
+				self._replay_from_offset = self._replay_until_offset = None
+			trades, offsets = trades[num_restored:], offsets[num_restored:]
+		if trades:
+			timestamps_ms = np.fromiter(
+				(trade["timestamp_ms"] for trade in trades),
+				dtype=np.int64,
+				count=len(trades),
+			)
+			latest_after_ms = np.maximum.accumulate(
+				np.maximum(timestamps_ms, self.latest_timestamp_ms)
+			)
+			latest_before_ms = np.empty_like(latest_after_ms)
+			latest_before_ms[0] = self.latest_timestamp_ms
+			latest_before_ms[1:] = latest_after_ms[:-1]
+			self.latest_timestamp_ms = int(latest_after_ms[-1])
+			ends_ms = timestamps_ms - timestamps_ms % self.window_ms + self.window_ms
+			is_valid = ends_ms + self.grace_ms > latest_before_ms
+			self.late_trades += len(trades) - int(np.count_nonzero(is_valid))
+			is_valid = is_valid.tolist()
+			for entry in zip(
+				compress(timestamps_ms.tolist(), is_valid),
+				compress(offsets, is_valid),
+				compress(trades, is_valid),
+			):
+				heapq.heappush(heap, entry)
+			self.last_offset = offsets[-1]
+		if self.is_restoring:
+			return []
+
+		released_until_ms = self.released_until_ms
+		released = []
+		while heap and heap[0][0] < released_until_ms:
+			released.append(heapq.heappop(heap)[2])
+		return released
+
+	def to_snapshot(self) -> dict:
+		if self.is_restoring:
+			# the snapshot is restored once more, by the same trades
+			released_until_ms = self._replay_from_ms
+			last_offset = self._replay_until_offset
+		else:
+			released_until_ms = self.released_until_ms
+			last_offset = self.last_offset
+		return {
+			"window_ms": self.window_ms,
+			"latest_timestamp_ms": self.latest_timestamp_ms,
+			"released_until_ms": released_until_ms,
+			"oldest_offset": self.oldest_offset,
+			"last_offset": last_offset,
+		}
+
+	@classmethod
+	def from_snapshot(cls, snapshot: dict, grace_ms: int) -> "TradesReorderBuffer":
+		"""
+		The buffer takes the trades held back in again, from those consumed from
+		`oldest_offset` of the snapshot on.
+
+		:param grace_ms: Grace period of the windows, the held back trades are
+			released by the new one.
+		"""
+		reorder_buffer = cls(
+			window_ms=snapshot["window_ms"],
+			grace_ms=grace_ms,
+			latest_timestamp_ms=snapshot["latest_timestamp_ms"],
+		)
+		reorder_buffer.last_offset = snapshot["last_offset"]
+		if snapshot["oldest_offset"] is not None:
+			reorder_buffer._replay_from_offset = snapshot["oldest_offset"]
+			reorder_buffer._replay_until_offset = snapshot["last_offset"]
+			reorder_buffer._replay_from_ms = snapshot.get(
+				# the trades up to the watermark were released by former versions
+				"released_until_ms",
+				snapshot.get("watermark_ms", 0) + 1,
+			)
+		return reorder_buffer
+
+
+class WindowStateMetrics:
+	"""
+	Late trades and open windows of the tumbling window of the stream mode,
+	per partition, logged every `stats_interval_s`.
+
+	The windowed state isn't exposed, so it is mirrored from the trades going
+	into the window: the latest timestamp of every partition, and the windows of
+	every symbol until a trade of the symbol expires them, as quixstreams does.
+	The counts of a partition start over when the service restarts.
+	"""
+
+	def __init__(self, window_ms: int, grace_ms: int, stats_interval_s: float = 60.0):
+		"""
+		:param window_ms: Window size in milliseconds.
+		:param grace_ms: Grace period of the windows in milliseconds.
+		:param stats_interval_s: Interval of the metrics in the logs.
+		"""
+		self._window_ms = window_ms
+		self._grace_ms = grace_ms
+		self._stats_interval_s = stats_interval_s
+		self._logged_at = time.monotonic()
+		self._latest_timestamps_ms: dict[int, int] = {}
+		self._late_trades: dict[int, int] = {}
+		# the starts of the open windows, by partition and symbol
+		self._open_windows: dict[int, dict[str, set[int]]] = {}
+
+	def observe(self, trade: dict) -> None:
+		"""Counts a trade, before the tumbling window processes it."""
+		partition = message_context().partition
+		latest_ms = self._latest_timestamps_ms.get(partition, 0)
+		timestamp_ms = trade["timestamp_ms"]
+		start_ms = timestamp_ms - timestamp_ms % self._window_ms
+		open_windows = self._open_windows.setdefault(partition, {})
+		if start_ms + self._window_ms + self._grace_ms <= latest_ms:
+			self._late_trades[partition] = self._late_trades.get(partition, 0) + 1
+		else:
+			latest_ms = max(latest_ms, timestamp_ms)
+			self._latest_timestamps_ms[partition] = latest_ms
+			open_windows.setdefault(trade["symbol"], set()).add(start_ms)
+		# a late trade expires the windows of its symbol as well
+		starts_ms = open_windows.get(trade["symbol"])
+		if starts_ms:
+			expired_until_ms = latest_ms - self._window_ms - self._grace_ms
+			starts_ms.difference_update(
+				[start_ms for start_ms in starts_ms if start_ms <= expired_until_ms]
+			)
+			if not starts_ms:
+				del open_windows[trade["symbol"]]
+		if time.monotonic() - self._logged_at >= self._stats_interval_s:
+			self._logged_at = time.monotonic()
+			for partition in sorted(self._open_windows):
+				logger.info(f"Partition {partition}: {self.stats(partition)}")
+
+	def stats(self, partition: int) -> str:
+		"""The metrics of a partition, the late trades since the last stats."""
+		open_windows = self._open_windows.get(partition, {})
+		stats = (
+			f"late_trades={self._late_trades.get(partition, 0)} "
+			f"open_windows={sum(map(len, open_windows.values()))} "
+			f"symbols={len(open_windows)} "
+			f"latest_timestamp_ms={self._latest_timestamps_ms.get(partition, 0)}"
+		)
+		self._late_trades[partition] = 0
+		return stats
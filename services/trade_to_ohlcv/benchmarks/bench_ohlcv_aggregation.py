@@ -0,0 +1,106 @@
+"""
+Compares the aggregation of trades into OHLCV candles by the quixstreams
+tumbling window, one trade at a time through the RocksDB window state, with
+the NumPy micro-batches of `OhlcvBatchAggregator`, on a single core.
+Both must produce the same candles.
+
+Run from the service root:
+	python -m benchmarks.bench_ohlcv_aggregation
+"""
+
+import random
+import tempfile
+import time
+
+from quixstreams.dataframe.windows.definitions import TumblingWindowDefinition
+from quixstreams.state.rocksdb.windowed.partition import (
+	WindowedRocksDBStorePartition,
+)
+
+from app.batch_aggregation import OhlcvBatchAggregator
+from app.main import _init_ohlcv_candle, _update_ohlcv_candle
+
+TRADES = 200_000
+SYMBOLS = 50
+WINDOW_MS = 60_000
+BATCH_SIZE = 10_000
+REPEATS = 3
+
+
+def build_trades() -> list[dict]:
+	rng = random.Random(42)
+	symbols = [f"SYM{i}/USD" for i in range(SYMBOLS)]
+	timestamp_ms = 1704067200000
+	trades = []
+	for _ in range(TRADES):
+		timestamp_ms += rng.randint(0, 5)
+		trades.append(
+			{
+				"symbol": rng.choice(symbols),
+				"qty": rng.random(),
+				"price": 42000 + rng.uniform(-100, 100),
+				"timestamp_ms": timestamp_ms,
+			}
+		)
+	return trades
+
+
+def aggregate_by_window(trades: list[dict]) -> list[dict]:
+	window = TumblingWindowDefinition(
+		duration_ms=WINDOW_MS, grace_ms=0, dataframe=None
+	).reduce(reducer=_update_ohlcv_candle, initializer=_init_ohlcv_candle)
+	partition = WindowedRocksDBStorePartition(tempfile.mkdtemp())
+	# quixstreams keeps one transaction open between checkpoints
+	transaction = partition.begin()
+	candles = []
+	for trade in trades:
+		state = transaction.as_state(prefix=trade["symbol"].encode())
+		_, expired = window.process_window(trade, trade["timestamp_ms"], state)
+		for candle in expired:
+			candles.append({"timestamp_ms": candle["end"], **candle["value"]})
+	partition.close()
+	return candles
+
+
+def aggregate_in_batches(trades: list[dict]) -> list[dict]:
+	aggregator = OhlcvBatchAggregator(window_ms=WINDOW_MS)
+	candles = []
+	for i in range(0, len(trades), BATCH_SIZE):
+		batch = trades[i : i + BATCH_SIZE]
+		candles.extend(
+			aggregator.aggregate(
+				symbols=[trade["symbol"] for trade in batch],
+				timestamps_ms=[trade["timestamp_ms"] for trade in batch],
+				prices=[trade["price"] for trade in batch],
+				qtys=[trade["qty"] for trade in batch],
+			)
+		)
+	return candles
+
+
+def measure(func, trades: list[dict]) -> tuple[float, list[dict]]:
+	best_s = float("inf")
+	for _ in range(REPEATS):
+		started_at = time.perf_counter()
+		candles = func(trades)
+		best_s = min(best_s, time.perf_counter() - started_at)
+	return len(trades) / best_s, candles
+
+
+def _sort_key(candle: dict) -> tuple[str, int]:
+	return candle["symbol"], candle["timestamp_ms"]
+
+
+if __name__ == "__main__":
+	trades = build_trades()
+	window_rate, window_candles = measure(aggregate_by_window, trades)
+	batch_rate, batch_candles = measure(aggregate_in_batches, trades)
+	assert sorted(window_candles, key=_sort_key) == sorted(
+		batch_candles, key=_sort_key
+	), "the candles differ"
+	print(f"{len(batch_candles)} candles of {TRADES} trades")
+	print(f"tumbling window: {window_rate:12,.0f} trades/s")
+	print(
+		f"micro-batches:   {batch_rate:12,.0f} trades/s "
+		f"({batch_rate / window_rate:.1f}x)"
+	)
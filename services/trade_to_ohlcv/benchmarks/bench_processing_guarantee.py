@@ -0,0 +1,201 @@
+"""
+Measures the cost of the exactly-once processing guarantee against the
+at-least-once one, in both aggregation modes, on a Kafka broker, e.g. the
+redpanda of the local setup at KAFKA_BROKER_ADDRESS.
+
+Every run gets topics and a consumer group of its own. The throughput is that
+of a backlog of trades, from the first committed offset of the service to the
+last one, as a backfill consumes them. The end-to-end latency is that of the
+candles of trades written live at a steady rate, with the wall clock as their
+timestamps: from the end of a window, when its closing trade is written, to
+its candle being readable by a consumer of the committed messages.
+
+Run from the service root:
+	python -m benchmarks.bench_processing_guarantee
+"""
+
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import statistics
+import tempfile
+import time
+import uuid
+
+import structlog
+from confluent_kafka import OFFSET_END, TopicPartition
+from quixstreams import Application
+from quixstreams.models import TopicConfig
+
+from app.config import settings
+from app.main import KafkaOptions, trade_to_ohlcv, trade_to_ohlcv_batched
+from app.serializers import TRADE_V1, decode_record
+
+BACKLOG_TRADES = 200_000
+LIVE_TRADES_PER_S = 1_000
+LIVE_S = 30
+SYMBOLS = 20
+PARTITIONS = 2
+WINDOW_SECONDS = 1
+MODES = ["stream", "batch"]
+GUARANTEES = ["at-least-once", "exactly-once"]
+
+
+def run_service(kafka: KafkaOptions, mode: str) -> None:
+	# the state of quixstreams goes to the working directory
+	os.chdir(tempfile.mkdtemp())
+	structlog.configure(
+		wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+	)
+	if mode == "batch":
+		trade_to_ohlcv_batched(kafka, WINDOW_SECONDS, batch_timeout_s=0.1)
+	else:
+		trade_to_ohlcv(kafka, WINDOW_SECONDS)
+
+
+def get_trades(timestamps_ms: list[int]) -> list[dict]:
+	rng = random.Random(42)
+	symbols = [f"SYM{i}/USD" for i in range(SYMBOLS)]
+	return [
+		{
+			"symbol": rng.choice(symbols),
+			"qty": rng.random(),
+			"price": 42000 + rng.uniform(-100, 100),
+			"timestamp_ms": timestamp_ms,
+		}
+		for timestamp_ms in timestamps_ms
+	]
+
+
+def get_committed(consumer, topic: str) -> int:
+	"""The trades of the topic the consumer group committed."""
+	partitions = [TopicPartition(topic, partition) for partition in range(PARTITIONS)]
+	return sum(
+		max(committed.offset, 0)
+		for committed in consumer.committed(partitions, timeout=10)
+	)
+
+
+def measure(mode: str, processing_guarantee: str) -> tuple[float, list[float]]:
+	"""Returns the backlog throughput and the latencies of the live candles."""
+	run_id = uuid.uuid4().hex[:8]
+	kafka = KafkaOptions(
+		broker_address=settings.kafka.BROKER_ADDRESS,
+		input_topic=f"bench_trades_{run_id}",
+		output_topic=f"bench_ohlcv_{run_id}",
+		consumer_group=f"bench_trade_to_ohlcv_{run_id}",
+		auto_offset_reset="earliest",
+		output_topic_format="binary",
+		topic_config=TopicConfig(num_partitions=PARTITIONS, replication_factor=1),
+		processing_guarantee=processing_guarantee,
+	)
+	app = Application(
+		broker_address=kafka.broker_address,
+		consumer_group=f"bench_candles_{run_id}",
+	)
+	trades_topic = app.topic(kafka.input_topic, config=kafka.topic_config)
+	app.topic(kafka.output_topic, config=kafka.topic_config)
+	group = Application(
+		broker_address=kafka.broker_address, consumer_group=kafka.consumer_group
+	)
+
+	with (
+		app.get_producer() as producer,
+		app.get_consumer() as consumer,
+		group.get_consumer() as group_consumer,
+	):
+		# a backlog of trades ending before the live ones
+		started_ms = time.time_ns() // 1_000_000 - BACKLOG_TRADES * 3
+		for trade in get_trades([started_ms + i * 2 for i in range(BACKLOG_TRADES)]):
+			producer.produce(
+				topic=trades_topic.name,
+				value=TRADE_V1.encode(trade),
+				key=trade["symbol"],
+			)
+		producer.flush()
+
+		service = multiprocessing.get_context("spawn").Process(
+			target=run_service, args=(kafka, mode)
+		)
+		service.start()
+		try:
+			committed = get_committed(group_consumer, trades_topic.name)
+			while committed == 0:
+				time.sleep(0.05)
+				committed = get_committed(group_consumer, trades_topic.name)
+			started_at = time.perf_counter()
+			first_committed = committed
+			while committed < BACKLOG_TRADES:
+				time.sleep(0.05)
+				committed = get_committed(group_consumer, trades_topic.name)
+			throughput = (committed - first_committed) / (
+				time.perf_counter() - started_at
+			)
+
+			# the candles written from now on, without joining a group
+			consumer.incremental_assign(
+				[
+					TopicPartition(kafka.output_topic, partition, OFFSET_END)
+					for partition in range(PARTITIONS)
+				]
+			)
+			live_started_ms = time.time_ns() // 1_000_000
+			latencies_ms = []
+			interval_s = 1 / LIVE_TRADES_PER_S
+			next_at = time.perf_counter()
+			ends_at = next_at + LIVE_S
+			rng = random.Random(7)
+			symbols = [f"SYM{i}/USD" for i in range(SYMBOLS)]
+			# the candles of the last windows get a second to arrive
+			while time.perf_counter() < ends_at + 1:
+				if time.perf_counter() >= next_at and next_at < ends_at:
+					symbol = rng.choice(symbols)
+					producer.produce(
+						topic=trades_topic.name,
+						value=TRADE_V1.encode(
+							{
+								"symbol": symbol,
+								"qty": rng.random(),
+								"price": 42000 + rng.uniform(-100, 100),
+								"timestamp_ms": time.time_ns() // 1_000_000,
+							}
+						),
+						key=symbol,
+					)
+					next_at += interval_s
+				message = consumer.poll(
+					max(next_at - time.perf_counter(), 0) if next_at < ends_at else 0.1
+				)
+				if message is None or message.error():
+					continue
+				candle = decode_record(message.value())
+				if candle["timestamp_ms"] > live_started_ms:
+					latencies_ms.append(
+						time.time_ns() // 1_000_000 - candle["timestamp_ms"]
+					)
+		finally:
+			os.kill(service.pid, signal.SIGTERM)
+			service.join()
+	return throughput, latencies_ms
+
+
+if __name__ == "__main__":
+	structlog.configure(
+		wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+	)
+	print(
+		f"{BACKLOG_TRADES} backlog trades, {LIVE_TRADES_PER_S} live trades/s "
+		f"of {SYMBOLS} symbols for {LIVE_S}s, {WINDOW_SECONDS}s windows"
+	)
+	for mode in MODES:
+		for processing_guarantee in GUARANTEES:
+			throughput, latencies_ms = measure(mode, processing_guarantee)
+			quantiles = statistics.quantiles(latencies_ms, n=100)
+			print(
+				f"{mode:6} {processing_guarantee:13}: "
+				f"{throughput:10,.0f} trades/s, latency "
+				f"p50 {quantiles[49]:6,.0f}ms p99 {quantiles[98]:6,.0f}ms "
+				f"max {max(latencies_ms):6,.0f}ms"
+			)
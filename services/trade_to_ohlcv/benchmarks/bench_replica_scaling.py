@@ -0,0 +1,364 @@
+"""
+Scales the batch aggregation out to 1, 2 and 4 replicas of one consumer
+group, each a process consuming its share of the partitions of the trades
+topic, with a local stand-in of the broker.
+
+The trades of a few hot symbols dominate, as on the exchanges, so the
+throughput of the group depends on how the symbols are spread over the
+partitions: by a hash of the symbol, the `key` partitioning of trade_producer,
+or by weight, its `balanced` partitioning, see trade_producer/app/partitioner.py.
+The slowest replica bounds the group; its CPU time gives the throughput with a
+core per replica, the wall-clock one is bounded by the cores of the machine.
+
+The state of the partitions is saved to files, not to a changelog topic, so the
+replicas of a group share one state directory. The group is then rescaled
+halfway through the trades: the partitions move to other replicas, which resume
+from the state saved by the previous ones and must write the same candles as a
+group that was not rescaled. Replicas with a state directory each fail instead.
+
+Run from the service root:
+	python -m benchmarks.bench_replica_scaling
+"""
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import random
+import signal
+import tempfile
+import time
+import zlib
+from typing import Self
+from unittest import mock
+
+import structlog
+from confluent_kafka import OFFSET_INVALID, TopicPartition
+from quixstreams import Application
+
+from app.main import KafkaOptions, trade_to_ohlcv_batched
+from app.serializers import TRADE_V1
+
+TRADES = 400_000
+SYMBOLS = 200
+PARTITIONS = 8
+REPLICAS = [1, 2, 4]
+WINDOWS_SECONDS = [60, 300, 3600]
+BATCH_SIZE = 10_000
+TOPIC = "trades"
+
+
+class LocalMessage:
+	def __init__(self, partition: int, offset: int, value: bytes):
+		self._partition = partition
+		self._offset = offset
+		self._value = value
+
+	def error(self) -> None:
+		return None
+
+	def partition(self) -> int:
+		return self._partition
+
+	def offset(self) -> int:
+		return self._offset
+
+	def value(self) -> bytes:
+		return self._value
+
+
+class LocalConsumer:
+	"""Consumes the assigned partitions in turn, stopping the replica at their end."""
+
+	def __init__(
+		self,
+		partitions: dict[int, list[LocalMessage]],
+		assigned: list[int],
+		committed: dict[int, int],
+	):
+		self._partitions = partitions
+		self._assigned = assigned
+		# offsets committed by the group, shared with the next replicas
+		self.committed_offsets = committed
+		self._messages: list[LocalMessage] = []
+
+	def __enter__(self) -> Self:
+		return self
+
+	def __exit__(self, *args) -> None:
+		pass
+
+	def subscribe(self, topics: list[str], on_assign, on_revoke, on_lost) -> None:
+		topic_partitions = [TopicPartition(topics[0], p) for p in self._assigned]
+		on_assign(self, topic_partitions)
+		queues = [
+			self._partitions[tp.partition][max(tp.offset, 0) :]
+			for tp in topic_partitions
+		]
+		# interleaved by chunks, as the broker fetches them
+		for i in range(0, max(map(len, queues)), 500):
+			for queue in queues:
+				self._messages.extend(queue[i : i + 500])
+		self._messages.reverse()
+
+	def committed(self, topic_partitions: list[TopicPartition], timeout: float):
+		return [
+			TopicPartition(
+				tp.topic,
+				tp.partition,
+				self.committed_offsets.get(tp.partition, OFFSET_INVALID),
+			)
+			for tp in topic_partitions
+		]
+
+	def incremental_assign(self, topic_partitions: list[TopicPartition]) -> None:
+		pass
+
+	def poll(self, timeout: float) -> LocalMessage | None:
+		if not self._messages:
+			signal.raise_signal(signal.SIGTERM)
+			return None
+		return self._messages.pop()
+
+	def commit(self, offsets: list[TopicPartition], asynchronous: bool) -> None:
+		for tp in offsets:
+			self.committed_offsets[tp.partition] = tp.offset
+
+
+class LocalProducer:
+	def __init__(self):
+		self.candles = 0
+
+	def __enter__(self) -> Self:
+		return self
+
+	def __exit__(self, *args) -> None:
+		pass
+
+	def produce(self, topic: str, value: bytes, key: bytes, timestamp: int) -> None:
+		self.candles += 1
+
+	def flush(self) -> None:
+		pass
+
+
+def build_trades() -> tuple[list[dict], dict[str, float]]:
+	"""Trades of symbols with Zipf distributed rates, and the rates."""
+	rng = random.Random(42)
+	symbols = [f"SYM{i}/USD" for i in range(SYMBOLS)]
+	weights = [1 / (rank + 1) for rank in range(SYMBOLS)]
+	timestamp_ms = 1704067200000
+	trades = []
+	for symbol in rng.choices(symbols, weights=weights, k=TRADES):
+		timestamp_ms += rng.randint(0, 20)
+		trades.append(
+			{
+				"symbol": symbol,
+				"qty": rng.random(),
+				"price": 42000 + rng.uniform(-100, 100),
+				"timestamp_ms": timestamp_ms,
+			}
+		)
+	return trades, dict(zip(symbols, weights))
+
+
+def partition_by_key(symbols: list[str]) -> dict[str, int]:
+	return {symbol: zlib.crc32(symbol.encode()) % PARTITIONS for symbol in symbols}
+
+
+def partition_by_weight(weights: dict[str, float]) -> dict[str, int]:
+	"""The heaviest symbol first, each to the least loaded partition."""
+	loads = [(0.0, partition) for partition in range(PARTITIONS)]
+	partitions = {}
+	for symbol in sorted(weights, key=lambda s: (-weights[s], s)):
+		load, partition = heapq.heappop(loads)
+		partitions[symbol] = partition
+		heapq.heappush(loads, (load + weights[symbol], partition))
+	return partitions
+
+
+def produce(
+	trades: list[dict], partitions_by_symbol: dict[str, int]
+) -> dict[int, list[LocalMessage]]:
+	partitions: dict[int, list[LocalMessage]] = {p: [] for p in range(PARTITIONS)}
+	for trade in trades:
+		messages = partitions[partitions_by_symbol[trade["symbol"]]]
+		messages.append(
+			LocalMessage(
+				partitions_by_symbol[trade["symbol"]],
+				len(messages),
+				TRADE_V1.encode(trade),
+			)
+		)
+	return partitions
+
+
+def run_replica(
+	partitions: dict[int, list[LocalMessage]],
+	assigned: list[int],
+	state_dir: str,
+	committed: dict[int, int],
+	connection,
+) -> None:
+	"""
+	Sends the CPU time of the replica, the offsets it committed and the number
+	of candles it wrote, or the error it failed with.
+	"""
+	kafka = KafkaOptions(
+		broker_address="localhost:9092",
+		input_topic=TOPIC,
+		output_topic="ohlcv",
+		consumer_group="bench_replica_scaling",
+		auto_offset_reset="earliest",
+		output_topic_format="binary",
+	)
+	consumer = LocalConsumer(partitions, assigned, committed)
+	producer = LocalProducer()
+	started_at = time.process_time()
+	try:
+		with (
+			mock.patch.object(
+				Application, "get_consumer", lambda app, auto_commit_enable: consumer
+			),
+			mock.patch.object(Application, "get_producer", lambda app: producer),
+		):
+			trade_to_ohlcv_batched(
+				kafka,
+				WINDOWS_SECONDS,
+				batch_size=BATCH_SIZE,
+				batch_timeout_s=0,
+				state_dir=state_dir,
+			)
+	except RuntimeError as e:
+		connection.send(e)
+		return
+	connection.send(
+		(time.process_time() - started_at, consumer.committed_offsets, producer.candles)
+	)
+
+
+def run_group(
+	partitions: dict[int, list[LocalMessage]],
+	num_replicas: int,
+	state_dirs: list[str],
+	committed: dict[int, int] | None = None,
+) -> tuple[float, float, float, dict[int, int], int]:
+	"""
+	Runs the replicas, the i-th one with the state directory `i % len(state_dirs)`,
+	from the `committed` offsets of the group.
+
+	Returns the wall-clock time of the group, the CPU time of its slowest
+	replica, the share of the trades of its busiest one, the offsets it
+	committed and the number of candles it wrote.
+	"""
+	# the round-robin assignment of the partitions to the replicas
+	assignments = [
+		list(range(PARTITIONS))[replica::num_replicas]
+		for replica in range(num_replicas)
+	]
+	context = multiprocessing.get_context("fork")
+	started_at = time.perf_counter()
+	processes, connections = [], []
+	for replica, assigned in enumerate(assignments):
+		receiver, sender = context.Pipe(duplex=False)
+		process = context.Process(
+			target=run_replica,
+			args=(
+				partitions,
+				assigned,
+				state_dirs[replica % len(state_dirs)],
+				dict(committed or {}),
+				sender,
+			),
+		)
+		process.start()
+		processes.append(process)
+		connections.append(receiver)
+	results = [connection.recv() for connection in connections]
+	for process in processes:
+		process.join()
+	wall_s = time.perf_counter() - started_at
+	for result in results:
+		if isinstance(result, Exception):
+			raise result
+	busiest = max(sum(len(partitions[p]) for p in assigned) for assigned in assignments)
+	committed_offsets = {}
+	for _, replica_committed, _ in results:
+		committed_offsets.update(replica_committed)
+	return (
+		wall_s,
+		max(cpu_time_s for cpu_time_s, _, _ in results),
+		busiest / TRADES,
+		committed_offsets,
+		sum(candles for _, _, candles in results),
+	)
+
+
+def run_rescaled_group(
+	partitions: dict[int, list[LocalMessage]],
+	num_replicas: int,
+	rescaled_replicas: int,
+	state_dirs: list[str],
+) -> int:
+	"""
+	Runs the group on the first half of every partition, then the rescaled one
+	on the rest, and returns the number of candles they wrote.
+	"""
+	first_half = {
+		partition: messages[: len(messages) // 2]
+		for partition, messages in partitions.items()
+	}
+	*_, committed, candles = run_group(first_half, num_replicas, state_dirs)
+	*_, rescaled_candles = run_group(
+		partitions, rescaled_replicas, state_dirs, committed
+	)
+	return candles + rescaled_candles
+
+
+if __name__ == "__main__":
+	structlog.configure(
+		wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+	)
+	trades, weights = build_trades()
+	print(
+		f"{TRADES} trades of {SYMBOLS} symbols in {PARTITIONS} partitions, "
+		f"{multiprocessing.cpu_count()} cores"
+	)
+	for name, partitions_by_symbol in (
+		("key", partition_by_key(list(weights))),
+		("balanced", partition_by_weight(weights)),
+	):
+		partitions = produce(trades, partitions_by_symbol)
+		largest = max(map(len, partitions.values())) / TRADES
+		print(f"{name} partitioning, largest partition {largest:.0%} of the trades")
+		for num_replicas in REPLICAS:
+			wall_s, critical_s, busiest, *_ = run_group(
+				partitions, num_replicas, [tempfile.mkdtemp()]
+			)
+			print(
+				f"  {num_replicas} replicas: {TRADES / wall_s:12,.0f} trades/s, "
+				f"{TRADES / critical_s:12,.0f} trades/s with a core per replica, "
+				f"busiest replica {busiest:.0%} of the trades"
+			)
+
+	# the partitions move to other replicas when the group is rescaled
+	partitions = produce(trades, partition_by_key(list(weights)))
+	*_, candles = run_group(partitions, 1, [tempfile.mkdtemp()])
+	for num_replicas, rescaled_replicas in itertools.pairwise(REPLICAS):
+		rescaled_candles = run_rescaled_group(
+			partitions, num_replicas, rescaled_replicas, [tempfile.mkdtemp()]
+		)
+		print(
+			f"rescaled from {num_replicas} to {rescaled_replicas} replicas sharing "
+			f"the state directory: same candles as without rescaling "
+			f"{rescaled_candles == candles}"
+		)
+		try:
+			run_rescaled_group(
+				partitions,
+				num_replicas,
+				rescaled_replicas,
+				[tempfile.mkdtemp() for _ in range(rescaled_replicas)],
+			)
+		except RuntimeError as e:
+			print(f"  with a state directory per replica: {e}")
@@ -0,0 +1,6 @@
+import os
+
+# the settings of app.config are read on import
+os.environ.setdefault("KAFKA_TRADES_TOPIC", "trade")
+os.environ.setdefault("KAFKA_OHLCV_TOPIC", "ohlcv")
+os.environ.setdefault("KAFKA_CONSUMER_GROUP", "trade_to_ohlcv")
@@ -0,0 +1,276 @@
+"""
+The batch aggregation, its roll-ups and the backfill must produce the candles
+of the tumbling window of the streaming path, that of `_init_ohlcv_candle` and
+`_update_ohlcv_candle`, trade for trade.
+"""
+
+import json
+import random
+import tempfile
+import types
+from collections import defaultdict
+from itertools import pairwise
+
+import orjson
+import pytest
+from quixstreams.dataframe.windows import definitions, time_based
+from quixstreams.state.rocksdb.windowed.partition import WindowedRocksDBStorePartition
+
+from app.backfill import backfill_ohlcv
+from app.batch_aggregation import (
+	OhlcvBatchAggregator,
+	PartitionSnapshots,
+	PartitionState,
+	SymbolState,
+)
+from app.candle_grid import fill_ohlcv_gaps
+from app.candle_stats import classify_trade_side, get_stats_fields
+from app.main import _fill_candle_gaps, _get_ohlcv_reducers, _roll_up_ohlcv_candles
+
+WINDOWS_SECONDS = [1, 5, 60]
+STATS = ["vwap", "trade_count", "buy_sell_volume", "trade_timestamps"]
+OHLCV_FIELDS = ["open", "high", "low", "close", "volume"]
+
+
+@pytest.fixture(autouse=True)
+def message_context(monkeypatch):
+	# the windows read the partition of the message being processed
+	monkeypatch.setattr(
+		time_based,
+		"message_context",
+		lambda: types.SimpleNamespace(topic="trade", partition=0, offset=0),
+	)
+
+
+def get_trades(
+	seed: int, num_trades: int = 3000, late: bool = True, sides: bool = False
+) -> list[dict]:
+	"""
+	Trades of symbols first seen at random points, a few of them late by up to
+	70s when `late`, with duplicate timestamps and prices, and with the side the
+	exchange reported, if any, when `sides`.
+	"""
+	rng = random.Random(seed)
+	symbols = [f"S{i}/USD" for i in range(rng.randint(1, 30))]
+	timestamp_ms = 1_700_000_000_000
+	trades = []
+	for i in range(num_trades):
+		timestamp_ms += rng.choice([0, 1, 5, 50, 400, 3000])
+		delay_ms = rng.choice([0] * 8 + [1000, 20_000, 70_000]) if late else 0
+		# a symbol trades only from a random point on
+		active = symbols[: 1 + i * len(symbols) // num_trades]
+		trade = {
+			"symbol": rng.choice(active),
+			"price": round(rng.uniform(1, 100), rng.randint(0, 4)),
+			"qty": rng.random() * 10 ** rng.randint(-4, 3),
+			"timestamp_ms": timestamp_ms - delay_ms,
+		}
+		if sides:
+			trade["side"] = rng.choice([1, -1, 0, 0])
+		trades.append(trade)
+	return trades
+
+
+def get_tumbling_candles(
+	trades: list[dict],
+	windows_seconds: list[int],
+	stats_fields: list[str],
+	grace_ms: int = 0,
+) -> dict[int, list[dict]]:
+	"""The candles of the streaming path: a tumbling window and its roll-ups."""
+	reducer, initializer = _get_ohlcv_reducers(stats_fields)
+	window = definitions.TumblingWindowDefinition(
+		windows_seconds[0] * 1000, grace_ms, dataframe=None
+	).reduce(reducer, initializer)
+	roll_ups = {
+		window_seconds: _roll_up_ohlcv_candles(
+			window_seconds * 1000, child_seconds * 1000
+		)
+		for child_seconds, window_seconds in pairwise(windows_seconds)
+	}
+	tick_states = defaultdict(SymbolState)
+	roll_up_states = defaultdict(SymbolState)
+	candles = {window_seconds: [] for window_seconds in windows_seconds}
+	partition = WindowedRocksDBStorePartition(tempfile.mkdtemp())
+	for trade in trades:
+		if "buy_volume" in stats_fields:
+			trade = classify_trade_side(trade, tick_states[trade["symbol"]])
+		transaction = partition.begin()
+		state = transaction.as_state(prefix=trade["symbol"].encode())
+		_, expired = window.process_window(trade, trade["timestamp_ms"], state)
+		transaction.flush()
+		for window_candle in expired:
+			value = window_candle["value"]
+			closed = [
+				{
+					"symbol": value["symbol"],
+					"timestamp_ms": window_candle["end"],
+					**{field: value[field] for field in OHLCV_FIELDS + stats_fields},
+				}
+			]
+			for window_seconds in windows_seconds:
+				if window_seconds in roll_ups:
+					closed = [
+						candle
+						for child in closed
+						for candle in roll_ups[window_seconds](
+							child, roll_up_states[(window_seconds, child["symbol"])]
+						)
+					]
+				candles[window_seconds] += closed
+	partition.close()
+	return candles
+
+
+def by_symbol(candles: list[dict]) -> dict[str, list[dict]]:
+	candles_by_symbol = defaultdict(list)
+	for candle in candles:
+		candles_by_symbol[candle["symbol"]].append(candle)
+	return dict(candles_by_symbol)
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("snapshots", [False, True])
+def test_batch_aggregation_matches_the_tumbling_window(seed, snapshots):
+	trades = get_trades(seed, sides=seed % 4 == 3)
+	rng = random.Random(seed)
+	window_seconds = rng.choice(WINDOWS_SECONDS)
+	stats_fields = get_stats_fields(STATS) if seed % 2 else []
+	expected = get_tumbling_candles(trades, [window_seconds], stats_fields)
+
+	aggregator = OhlcvBatchAggregator(
+		window_seconds * 1000, capacity=2, stats_fields=stats_fields
+	)
+	candles = []
+	late_trades = 0
+	start = 0
+	while start < len(trades):
+		batch = trades[start : start + rng.randint(1, 300)]
+		start += len(batch)
+		candles += aggregator.aggregate(
+			symbols=[trade["symbol"] for trade in batch],
+			timestamps_ms=[trade["timestamp_ms"] for trade in batch],
+			prices=[trade["price"] for trade in batch],
+			qtys=[trade["qty"] for trade in batch],
+			sides=[trade.get("side", 0) for trade in batch],
+		)
+		if snapshots:
+			late_trades += aggregator.late_trades
+			snapshot = json.loads(json.dumps(PartitionState(aggregator).to_snapshot()))
+			aggregator = PartitionState.from_snapshot(snapshot).aggregator
+
+	assert late_trades + aggregator.late_trades > 0
+	assert by_symbol(candles) == by_symbol(expected[window_seconds])
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_roll_ups_match_the_tumbling_window(seed):
+	trades = get_trades(seed)
+	rng = random.Random(seed)
+	expected = get_tumbling_candles(trades, WINDOWS_SECONDS, [])
+
+	aggregator = OhlcvBatchAggregator(WINDOWS_SECONDS[0] * 1000, capacity=2)
+	roll_ups = {
+		window_seconds: _roll_up_ohlcv_candles(
+			window_seconds * 1000, child_seconds * 1000
+		)
+		for child_seconds, window_seconds in pairwise(WINDOWS_SECONDS)
+	}
+	states = defaultdict(SymbolState)
+	candles = {window_seconds: [] for window_seconds in WINDOWS_SECONDS}
+	start = 0
+	while start < len(trades):
+		batch = trades[start : start + rng.randint(1, 300)]
+		start += len(batch)
+		closed = aggregator.aggregate(
+			symbols=[trade["symbol"] for trade in batch],
+			timestamps_ms=[trade["timestamp_ms"] for trade in batch],
+			prices=[trade["price"] for trade in batch],
+			qtys=[trade["qty"] for trade in batch],
+		)
+		for window_seconds in WINDOWS_SECONDS:
+			if window_seconds in roll_ups:
+				closed = [
+					candle
+					for child in closed
+					for candle in roll_ups[window_seconds](
+						child, states[(window_seconds, child["symbol"])]
+					)
+				]
+			candles[window_seconds] += closed
+
+	for window_seconds in WINDOWS_SECONDS:
+		assert by_symbol(candles[window_seconds]) == by_symbol(expected[window_seconds])
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("keep_previous", [False, True])
+def test_snapshots_save_the_changed_symbols(tmp_path, seed, keep_previous):
+	trades = get_trades(seed, sides=True)
+	rng = random.Random(seed)
+	stats_fields = get_stats_fields(STATS)
+	fill_grid_gaps = fill_ohlcv_gaps(window_ms=1000, stats_fields=stats_fields)
+	roll_up = _roll_up_ohlcv_candles(60_000, 1000)
+	partition = PartitionState(
+		OhlcvBatchAggregator(1000, capacity=2, stats_fields=stats_fields)
+	)
+	snapshots = PartitionSnapshots(tmp_path, keep_previous, compaction_ratio=0.5)
+	saved = []
+	num_expired = 0
+	start = 0
+	while start < len(trades):
+		batch = trades[start : start + rng.randint(1, 100)]
+		start += len(batch)
+		# the grids of the symbols without trades move on as well
+		candles = _fill_candle_gaps(
+			partition, partition.aggregate(batch), fill_grid_gaps, stats_fields
+		)
+		expired_candles, expired_symbols = partition.expire_symbols(5000)
+		num_expired += len(expired_symbols)
+		for candle in candles + expired_candles:
+			roll_up(candle, partition.get_symbol_state(candle["symbol"]))
+		partition.delete_symbol_states(expired_symbols[::2])
+		partition.offset = start - 1
+		partition.version += 1
+		snapshots.save("trade", 0, partition)
+		saved.append(json.loads(json.dumps(partition.to_snapshot())))
+		if len(saved) > 1 and rng.random() < 0.1:
+			version = None
+			if keep_previous:
+				# a restart after the transaction of the batch failed
+				saved.pop()
+				version = saved[-1]["version"]
+			snapshot = PartitionSnapshots(tmp_path, keep_previous).load(
+				"trade", 0, version
+			)
+			assert snapshot == saved[-1]
+			partition = PartitionState.from_snapshot(snapshot)
+			start = partition.offset + 1
+
+	assert num_expired
+	snapshot = PartitionSnapshots(tmp_path).load("trade", 0)
+	assert snapshot == saved[-1]
+
+
+@pytest.mark.parametrize("extra_stats", [[], STATS])
+def test_backfill_matches_the_tumbling_window(tmp_path, extra_stats):
+	pq = pytest.importorskip("pyarrow.parquet")
+	# the backfill reads the trades in timestamp order, none of them late
+	trades = get_trades(seed=42, num_trades=20_000, late=False, sides=True)
+	stats_fields = get_stats_fields(extra_stats)
+	expected = get_tumbling_candles(trades, WINDOWS_SECONDS, stats_fields)
+	trades_path = tmp_path / "trades.jsonl"
+	trades_path.write_bytes(b"".join(orjson.dumps(trade) + b"\n" for trade in trades))
+
+	backfill_ohlcv(
+		[str(trades_path)],
+		WINDOWS_SECONDS,
+		"parquet",
+		parquet_dir=tmp_path / "ohlcv",
+		extra_stats=extra_stats,
+	)
+
+	for window_seconds in WINDOWS_SECONDS:
+		path = tmp_path / "ohlcv" / f"ohlcv_{window_seconds}s.parquet"
+		candles = pq.read_table(path).to_pylist()
+		assert by_symbol(candles) == by_symbol(expected[window_seconds])
@@ -0,0 +1,116 @@
+"""
+The indicators updated candle by candle must be those TA-Lib computes over the
+whole series, as `add_technical_indicators` of the price predictor calls it.
+"""
+
+import json
+import random
+
+import numpy as np
+import pytest
+
+from app.indicators import INDICATOR_COLUMNS, update_indicators
+
+talib = pytest.importorskip("talib")
+
+NUM_CANDLES = 400
+# candles from which on every indicator is warmed up
+WARM_UP = 100
+
+
+def get_candles(seed: int) -> list[dict]:
+	"""
+	A random walk of candles, with a flat stretch of candles without trades at
+	the previous close, as the dense candle grid fills the gaps.
+	"""
+	rng = random.Random(seed)
+	flat_start = rng.randint(WARM_UP, NUM_CANDLES - 60)
+	flat_end = flat_start + rng.randint(20, 50)
+	close = 100.0
+	candles = []
+	for i in range(NUM_CANDLES):
+		if flat_start <= i < flat_end:
+			candles.append(
+				{
+					"open": close,
+					"high": close,
+					"low": close,
+					"close": close,
+					"volume": 0.0,
+				}
+			)
+			continue
+		open_ = close
+		close = max(1.0, open_ * (1 + rng.gauss(0, 0.01)))
+		candles.append(
+			{
+				"open": open_,
+				"high": max(open_, close) * (1 + rng.random() * 0.005),
+				"low": min(open_, close) * (1 - rng.random() * 0.005),
+				"close": close,
+				"volume": rng.random() * 10,
+			}
+		)
+	return candles
+
+
+def get_ta_lib_indicators(candles: list[dict]) -> dict[str, np.ndarray]:
+	high, low, close, volume = (
+		np.array([candle[field] for candle in candles])
+		for field in ("high", "low", "close", "volume")
+	)
+	macd, macd_signal, macd_hist = talib.MACD(
+		close, fastperiod=12, slowperiod=26, signalperiod=9
+	)
+	bb_upper, bb_middle, bb_lower = talib.BBANDS(
+		close, timeperiod=14, nbdevup=2, nbdevdn=2, matype=0
+	)
+	stoch_k, stoch_d = talib.STOCH(
+		high, low, close, fastk_period=14, slowk_period=3, slowd_period=3
+	)
+	return {
+		"sma_7": talib.SMA(close, timeperiod=7),
+		"sma_14": talib.SMA(close, timeperiod=14),
+		"sma_28": talib.SMA(close, timeperiod=28),
+		"ema_7": talib.EMA(close, timeperiod=7),
+		"ema_14": talib.EMA(close, timeperiod=14),
+		"ema_28": talib.EMA(close, timeperiod=28),
+		"macd": macd,
+		"macd_signal": macd_signal,
+		"macd_hist": macd_hist,
+		"bb_upper": bb_upper,
+		"bb_middle": bb_middle,
+		"bb_lower": bb_lower,
+		"stoch_k": stoch_k,
+		"stoch_d": stoch_d,
+		"obv": talib.OBV(close, volume),
+		"atr": talib.ATR(high, low, close, timeperiod=14),
+		"cci": talib.CCI(high, low, close, timeperiod=14),
+		"rsi": talib.RSI(close, timeperiod=14),
+		"adx": talib.ADX(high, low, close, timeperiod=14),
+		"cmf": talib.ADOSC(high, low, close, volume, fastperiod=3, slowperiod=14),
+	}
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_indicators_match_ta_lib(seed):
+	candles = get_candles(seed)
+	expected = get_ta_lib_indicators(candles)
+
+	state = {}
+	rows = []
+	for candle in candles:
+		rows.append(update_indicators(state, candle))
+		# the state is saved as JSON between two candles
+		state = json.loads(json.dumps(state))
+
+	for column in INDICATOR_COLUMNS:
+		values = np.array([row[column] for row in rows])
+		assert not np.isnan(values[WARM_UP:]).any(), column
+		np.testing.assert_allclose(
+			values[WARM_UP:],
+			expected[column][WARM_UP:],
+			rtol=1e-7,
+			atol=1e-6 * np.nanmax(np.abs(expected[column])),
+			err_msg=column,
+		)
@@ -0,0 +1,80 @@
+"""
+The partial candles carry the statistics of the candles they are built from,
+and the partial candles with statistics are encoded without losing them.
+"""
+
+import random
+from collections import defaultdict
+
+import pytest
+
+from app.batch_aggregation import OhlcvBatchAggregator, PartitionState
+from app.candle_stats import get_stats_fields
+from app.main import _roll_up_ohlcv_candles
+from app.partial_candles import PartialCandles
+from app.serializers import OHLCV_PARTIAL_STATS_V1, decode_record
+from tests.test_batch_aggregation import STATS, get_trades
+
+WINDOWS_SECONDS = [1, 5]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_partial_candles_carry_the_statistics(seed):
+	trades = get_trades(seed, sides=True)
+	rng = random.Random(seed)
+	stats_fields = get_stats_fields(STATS)
+	partition = PartitionState(
+		OhlcvBatchAggregator(1000, capacity=2, stats_fields=stats_fields)
+	)
+	roll_up = _roll_up_ohlcv_candles(5000, 1000)
+	partial_candles = PartialCandles(
+		WINDOWS_SECONDS, min_interval_ms=0, stats_fields=stats_fields
+	)
+	finals = {window_seconds: [] for window_seconds in WINDOWS_SECONDS}
+	updates = []
+	start = 0
+	while start < len(trades):
+		batch = trades[start : start + rng.randint(1, 100)]
+		start += len(batch)
+		candles = partition.aggregate(batch)
+		open_candles = {
+			candle["symbol"]: candle
+			for candle in partition.aggregator.get_open_candles(
+				trade["symbol"] for trade in batch
+			)
+		}
+		finals[1] += partial_candles.finalize(candles, 1)
+		candles = [
+			rolled_up
+			for candle in candles
+			for rolled_up in roll_up(
+				candle, partition.get_symbol_state(candle["symbol"])
+			)
+		]
+		finals[5] += partial_candles.finalize(candles, 5)
+		batch_updates = partial_candles.get_updates(
+			partition, (trade["symbol"] for trade in batch)
+		)
+		for update in batch_updates:
+			if update["window_seconds"] == 1:
+				open_candle = open_candles[update["symbol"]]
+				assert {field: update[field] for field in stats_fields} == {
+					field: open_candle[field] for field in stats_fields
+				}
+		updates += batch_updates
+
+	# the statistics of a larger window add up those of its smaller ones
+	trade_counts = defaultdict(int)
+	for candle in finals[1]:
+		end_ms = candle["timestamp_ms"] - 1000
+		trade_counts[(candle["symbol"], end_ms - end_ms % 5000 + 5000)] += candle[
+			"trade_count"
+		]
+	for candle in finals[5]:
+		assert (
+			candle["trade_count"]
+			== trade_counts[(candle["symbol"], candle["timestamp_ms"])]
+		)
+	assert updates and finals[5]
+	for candle in updates + finals[1] + finals[5]:
+		assert decode_record(OHLCV_PARTIAL_STATS_V1.encode(candle)) == candle
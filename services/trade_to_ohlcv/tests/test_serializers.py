@@ -0,0 +1,53 @@
+"""
+app/serializers.py is copied to trade_producer and topic_to_feature_store,
+whose images are built on their own; the copies must define the same schemas.
+"""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+from app import serializers
+
+SERVICES_DIR = Path(__file__).resolve().parents[2]
+COPIES = ["trade_producer", "topic_to_feature_store"]
+
+
+def load_copy(service: str):
+	path = SERVICES_DIR / service / "app" / "serializers.py"
+	spec = importlib.util.spec_from_file_location(f"{service}_serializers", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def get_layouts(module) -> dict[int, tuple]:
+	return {
+		schema_id: (
+			schema.name,
+			schema.fields,
+			schema.defaults,
+			schema._struct.format,
+		)
+		for schema_id, schema in module.SCHEMAS.items()
+	}
+
+
+@pytest.mark.parametrize("service", COPIES)
+def test_copies_define_the_same_schemas(service):
+	copy = load_copy(service)
+	assert get_layouts(copy) == get_layouts(serializers)
+	assert copy.MAGIC == serializers.MAGIC
+
+
+@pytest.mark.parametrize("service", COPIES)
+def test_copies_decode_each_others_messages(service):
+	copy = load_copy(service)
+	for schema_id, schema in serializers.SCHEMAS.items():
+		record = {field: 1 for field in schema.fields}
+		record["symbol"] = "BTC/USD"
+		assert copy.decode_record(schema.encode(record)) == record
+		assert serializers.decode_record(copy.SCHEMAS[schema_id].encode(record)) == (
+			record
+		)
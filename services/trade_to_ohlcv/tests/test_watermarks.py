@@ -0,0 +1,226 @@
+"""
+The reorder buffer of the batch aggregation must drop the late trades the
+tumbling window with a grace period drops, and release the others so that the
+aggregator closes the same candles, also across a snapshot and the trades
+consumed again to restore it. The metrics of the stream mode must count the
+late trades and open windows of that tumbling window.
+"""
+
+import json
+import random
+import re
+import tempfile
+import types
+
+import pytest
+from quixstreams.dataframe.windows import definitions, time_based
+from quixstreams.state.rocksdb.windowed.partition import WindowedRocksDBStorePartition
+
+from app import watermarks
+from app.batch_aggregation import OhlcvBatchAggregator, PartitionState
+from app.main import _get_ohlcv_reducers
+from app.watermarks import TradesReorderBuffer, WindowStateMetrics
+from tests.test_batch_aggregation import by_symbol, get_trades, get_tumbling_candles
+
+WINDOW_MS = 1000
+GRACE_MS = [500, 2000, 30_000]
+
+
+@pytest.fixture(autouse=True)
+def message_context(monkeypatch):
+	# the windows and the metrics read the partition of the message being processed
+	context = types.SimpleNamespace(topic="trade", partition=0, offset=0)
+	monkeypatch.setattr(time_based, "message_context", lambda: context)
+	monkeypatch.setattr(watermarks, "message_context", lambda: context)
+
+
+def get_batches(trades: list[dict], seed: int) -> list[tuple[list[dict], list[int]]]:
+	"""The trades and their offsets, in batches of random sizes."""
+	rng = random.Random(seed)
+	batches = []
+	start = 0
+	while start < len(trades):
+		size = rng.randint(1, 300)
+		batches.append((trades[start : start + size], list(range(start, start + size))))
+		start += size
+	return batches
+
+
+def with_closing_trades(trades: list[dict], grace_ms: int) -> list[dict]:
+	"""
+	The trades, then two trades of every symbol far enough after them that the
+	first ones close all windows and the second ones release the first ones.
+	"""
+	end_ms = max(trade["timestamp_ms"] for trade in trades) + WINDOW_MS + grace_ms
+	symbols = sorted({trade["symbol"] for trade in trades})
+	return trades + [
+		{"symbol": symbol, "price": 1.0, "qty": 1.0, "timestamp_ms": timestamp_ms}
+		for timestamp_ms in (end_ms, end_ms + WINDOW_MS + grace_ms)
+		for symbol in symbols
+	]
+
+
+def get_late_offsets(trades: list[dict], grace_ms: int) -> set[int]:
+	"""Offsets of the trades the tumbling window with a grace period drops."""
+	reducer, initializer = _get_ohlcv_reducers([])
+	window = definitions.TumblingWindowDefinition(
+		WINDOW_MS, grace_ms, dataframe=None
+	).reduce(reducer, initializer)
+	partition = WindowedRocksDBStorePartition(tempfile.mkdtemp())
+	late_offsets = set()
+	for offset, trade in enumerate(trades):
+		transaction = partition.begin()
+		state = transaction.as_state(prefix=trade["symbol"].encode())
+		updated, _ = window.process_window(trade, trade["timestamp_ms"], state)
+		transaction.flush()
+		if not updated:
+			late_offsets.add(offset)
+	partition.close()
+	return late_offsets
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("grace_ms", GRACE_MS)
+def test_reorder_buffer_drops_the_late_trades_of_the_tumbling_window(seed, grace_ms):
+	trades = get_trades(seed)
+	late_offsets = get_late_offsets(trades, grace_ms)
+	assert late_offsets
+
+	offsets_by_trade = {id(trade): offset for offset, trade in enumerate(trades)}
+	reorder_buffer = TradesReorderBuffer(WINDOW_MS, grace_ms)
+	released_offsets = set()
+	for batch, offsets in get_batches(trades, seed):
+		released = reorder_buffer.push(batch, offsets)
+		released_offsets.update(offsets_by_trade[id(trade)] for trade in released)
+	held_offsets = {offset for _, offset, _ in reorder_buffer._heap}
+
+	assert set(range(len(trades))) - released_offsets - held_offsets == late_offsets
+	assert reorder_buffer.late_trades == len(late_offsets)
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("grace_ms", GRACE_MS)
+def test_reorder_buffer_releases_the_trades_in_timestamp_order(seed, grace_ms):
+	trades = get_trades(seed)
+	reorder_buffer = TradesReorderBuffer(WINDOW_MS, grace_ms)
+	released_timestamps_ms = []
+	for batch, offsets in get_batches(trades, seed):
+		released = reorder_buffer.push(batch, offsets)
+		released_timestamps_ms += [trade["timestamp_ms"] for trade in released]
+		# the trades of the windows the watermark passed, and all of them
+		assert all(
+			timestamp_ms - timestamp_ms % WINDOW_MS + WINDOW_MS
+			<= reorder_buffer.watermark_ms
+			for timestamp_ms in released_timestamps_ms[-len(released) :]
+		)
+		assert all(
+			timestamp_ms >= reorder_buffer.released_until_ms
+			for timestamp_ms, _, _ in reorder_buffer._heap
+		)
+
+	assert released_timestamps_ms
+	assert released_timestamps_ms == sorted(released_timestamps_ms)
+
+
+def aggregate(
+	partition: PartitionState, trades: list[dict], offsets: list[int]
+) -> list[dict]:
+	"""A batch of the batch aggregation mode, as `trade_to_ohlcv_batched` runs it."""
+	candles = partition.aggregate(partition.reorder_buffer.push(trades, offsets))
+	partition.offset = max(offsets[-1], partition.offset or 0)
+	return candles
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("grace_ms", GRACE_MS)
+def test_reorder_buffer_closes_the_candles_of_the_tumbling_window(seed, grace_ms):
+	trades = with_closing_trades(get_trades(seed), grace_ms)
+	# the trades the tumbling window takes in, aggregated in timestamp order
+	late_offsets = get_late_offsets(trades, grace_ms)
+	in_time_trades = sorted(
+		(trade for offset, trade in enumerate(trades) if offset not in late_offsets),
+		key=lambda trade: trade["timestamp_ms"],
+	)
+	# the last trade of every symbol only releases the ones before it
+	num_symbols = len({trade["symbol"] for trade in trades})
+	expected = get_tumbling_candles(
+		in_time_trades[:-num_symbols], [WINDOW_MS // 1000], []
+	)
+
+	partition = PartitionState(
+		OhlcvBatchAggregator(WINDOW_MS),
+		reorder_buffer=TradesReorderBuffer(WINDOW_MS, grace_ms),
+	)
+	candles = []
+	for batch, offsets in get_batches(trades, seed):
+		candles += aggregate(partition, batch, offsets)
+
+	assert by_symbol(candles) == by_symbol(expected[WINDOW_MS // 1000])
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("grace_ms", GRACE_MS)
+def test_restored_reorder_buffer_closes_the_same_candles(seed, grace_ms):
+	trades = with_closing_trades(get_trades(seed), grace_ms)
+	batches = get_batches(trades, seed)
+	partition = PartitionState(
+		OhlcvBatchAggregator(WINDOW_MS),
+		reorder_buffer=TradesReorderBuffer(WINDOW_MS, grace_ms),
+	)
+	expected = []
+	for batch, offsets in batches:
+		expected += aggregate(partition, batch, offsets)
+
+	rng = random.Random(seed)
+	partition = PartitionState(
+		OhlcvBatchAggregator(WINDOW_MS),
+		reorder_buffer=TradesReorderBuffer(WINDOW_MS, grace_ms),
+	)
+	candles = []
+	start = 0
+	restarts = 0
+	while start < len(trades):
+		batch_size = rng.randint(1, 300)
+		offsets = list(range(start, min(start + batch_size, len(trades))))
+		candles += aggregate(partition, trades[start : offsets[-1] + 1], offsets)
+		start = offsets[-1] + 1
+		if rng.random() < 0.2:
+			# a restart, also one while the held back trades are consumed again
+			snapshot = json.loads(json.dumps(partition.to_snapshot()))
+			partition = PartitionState.from_snapshot(snapshot, grace_ms=grace_ms)
+			start = partition.resume_offset
+			restarts += 1
+
+	assert restarts > 0
+	assert by_symbol(candles) == by_symbol(expected)
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("grace_ms", GRACE_MS)
+def test_window_state_metrics_match_the_tumbling_window(seed, grace_ms):
+	trades = get_trades(seed)
+	late_offsets = get_late_offsets(trades, grace_ms)
+	# the windows opened by a trade and not yet closed by a later one
+	open_windows = set()
+	for offset, trade in enumerate(trades):
+		if offset in late_offsets:
+			continue
+		timestamp_ms = trade["timestamp_ms"]
+		open_windows.add((trade["symbol"], timestamp_ms - timestamp_ms % WINDOW_MS))
+	expected = get_tumbling_candles(trades, [WINDOW_MS // 1000], [], grace_ms)
+	for candle in expected[WINDOW_MS // 1000]:
+		open_windows.remove((candle["symbol"], candle["timestamp_ms"] - WINDOW_MS))
+
+	metrics = WindowStateMetrics(WINDOW_MS, grace_ms, stats_interval_s=3600)
+	for trade in trades:
+		metrics.observe(trade)
+	stats = dict(re.findall(r"(\w+)=(\d+)", metrics.stats(partition=0)))
+
+	assert int(stats["late_trades"]) == len(late_offsets)
+	assert int(stats["open_windows"]) == len(open_windows)
+	assert int(stats["symbols"]) == len({symbol for symbol, _ in open_windows})
+	assert int(stats["latest_timestamp_ms"]) == max(
+		trade["timestamp_ms"] for trade in trades
+	)
+	# the late trades are counted since the last stats
+	assert re.search(r"late_trades=0 ", metrics.stats(partition=0))